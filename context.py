@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from validation import severity_level
+
+VALIDATION_MODES = ("inline", "deferred", "skip")
+
+##############################################################################
+# Parse context                                                              #
+##############################################################################
+
+class ParseContext(object):
+    """
+    State shared by all of the nodes constructed in one parse, which is
+    available as node.context (and so to Paths as Path().context, and to
+    validation, attribute and value functions through their node). A
+    context is created by the first definition constructed under a parent
+    without one, using the definition's context_class, and is inherited by
+    every node created below it.
+
+    options is a dictionary of settings for the parse. Facts
+    about the document that later parts of the structure depend on can be
+    cached by subclasses in node_started and node_ended, which are called
+    as each node is started and completed (node_discarded is called
+    instead for a node that is dropped when the source runs out part way
+    through it), so that they do not need to be found by searching the
+    tree.
+
+    The "min_severity" option (a validation exception class, its name or
+    its level; see validation.severity_level) sets min_level. Validation
+    rules raising issues below this level are not evaluated and such
+    issues are not recorded. To parse with options, set the context of the
+    parent node before constructing under it, e.g.
+        root.context = PNGContext({"min_severity": ValidationError})
+
+    The "validation" option sets validation_mode, which is one of:
+        "inline" - all validation rules are run during construction (the
+            default).
+        "deferred" - construction only runs the "pre" and
+            "pre_derivation" rules and the ValidationFatal rules, which
+            decide how the rest of the source is read. The other "per_child"
+            and "post" rules are run afterwards in one pass over the
+            finished tree by validate_deferred, which is called by
+            Node.issues if it has not been already.
+        "skip" - as "deferred", but the deferred rules are never run.
+    The deferred pass replays the construction of the tree: the children
+    of each node are detached and reattached in document order, with the
+    name index and the node_started and node_ended facts rebuilt as they
+    are, so that rules which depend on what came before (e.g. "PLTE must
+    appear before the first IDAT") see the same partial tree that they
+    would have during construction. Unlike during construction, the
+    attributes of the ancestors of a node have already been set.
+
+    The context also keeps a name index of the nodes created in its tree
+    (see index_node): the number of nodes with each name and the first of
+    them, in document order. This is used by compiled Paths (see
+    path.compile_path) in place of searching the tree. Nodes that are
+    later removed from the tree remain in the index, apart from those
+    dropped at the end of the source.
+    """
+    def __init__(self, options=None):
+        self.options = dict(options) if options else {}
+        self.min_level = severity_level(self.options.get("min_severity"))
+        self.validation_mode = self.options.get("validation", "inline")
+        if self.validation_mode not in VALIDATION_MODES:
+            raise ValueError("Unknown validation mode '{}'".format(
+                self.validation_mode))
+        # the (min_level, subset) key of the validation rules run during
+        # construction (see Definition.stages_for)
+        self.stages_key = (self.min_level, None if
+                           self.validation_mode == "inline" else "inline")
+        self.validation_pending = self.validation_mode == "deferred"
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the nodes indexed and the facts gathered so far, so that
+        the construction of the tree can be replayed (see
+        validate_deferred). Subclasses that cache facts reset them here.
+        """
+        self.top = None
+        self.name_counts = {}
+        self.first_nodes = {}
+        self.sequence = 0
+
+    def index_node(self, node):
+        """
+        Add node to the name index. This is called for each node created
+        with a parent in the tree (see Node) and for the top node of the
+        tree, which the index covers.
+        """
+        if self.top is None:
+            self.top = node
+        name = node._name
+        count = self.name_counts.get(name, 0)
+        if not count:
+            self.first_nodes[name] = (self.sequence, node)
+        self.name_counts[name] = count + 1
+        self.sequence += 1
+
+    def reports(self, error):
+        """
+        Return True if issues of the class (or instance) error are
+        recorded in this parse.
+        """
+        return error.level >= self.min_level
+
+    def node_started(self, node):
+        pass
+
+    def node_ended(self, node):
+        pass
+
+    def node_discarded(self, node):
+        for n in node:
+            name = n._name
+            if self.name_counts.get(name):
+                self.name_counts[name] -= 1
+                if self.first_nodes.get(name, (None, None))[1] is n:
+                    del self.first_nodes[name]
+
+    def node_released(self, node):
+        """
+        Forget node and the nodes under it as the first nodes of their
+        names, when a treeless ConstructionHandler releases it, so that the
+        index does not keep them alive. They are still counted.
+        """
+        for n in node:
+            if self.first_nodes.get(n._name, (None, None))[1] is n:
+                del self.first_nodes[n._name]
+
+    def covers(self, root):
+        """
+        Return True if the name index holds exactly the nodes in the tree
+        under root (possibly including root itself).
+        """
+        if root is self.top or root._context is self:
+            return True
+        return (root._context is None and len(root._children) == 1 and
+                root._children[0] is self.top)
+
+    def count_named(self, names):
+        """
+        Return the number of indexed nodes with any of the given names.
+        """
+        return sum(self.name_counts.get(name, 0) for name in names)
+
+    def first_named(self, names):
+        """
+        Return the first indexed node, in document order, with any of the
+        given names, or None if there is none or it is not known.
+        """
+        firsts = []
+        for name in names:
+            if self.name_counts.get(name):
+                if name not in self.first_nodes:
+                    return None
+                firsts.append(self.first_nodes[name])
+        return min(firsts, key=lambda first: first[0])[1] if firsts else None
+
+    def validate_deferred(self):
+        """
+        Run the validation rules deferred during construction (see
+        validation_mode) over the tree under self.top, recording their
+        issues on the nodes as usual. This does nothing if the rules have
+        already been run or validation is not deferred.
+        """
+        if not self.validation_pending or self.top is None:
+            return
+        self.validation_pending = False
+        top = self.top
+        children = {}
+        stack = [top]
+        while stack:
+            node = stack.pop()
+            children[node] = list(node._children)
+            del node._children[:]
+            stack.extend(children[node])
+        self.reset()
+        self.index_node(top)
+        self.replay(top, children)
+
+    def replay(self, node, children):
+        """
+        Reattach the children of node, given by the dictionary children,
+        in order, running the deferred "per_child" and "post" rules at the
+        points at which construction would have.
+        """
+        definition = node._metadata.get("definition")
+        self.node_started(node)
+        for child in children[node]:
+            node._children.append(child)
+            self.index_node(child)
+            self.replay(child, children)
+            if definition is not None:
+                definition.validate_stage(node, "per_child", child,
+                                          deferred=True)
+        if definition is not None:
+            definition.validate_stage(node, "post", deferred=True)
+        self.node_ended(node)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from encoder import CHANNELS, row_bytes, bytes_per_pixel, paeth_predictor
+from writer import find_png
+from node import Name
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+##############################################################################
+# Image data                                                                 #
+##############################################################################
+
+# (x start, y start, x step, y step) for each pass of Adam7 interlacing
+ADAM7 = [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4),
+         (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]
+
+class Image(object):
+    """
+    A decoded image. rows is a list containing, for each row, a list of
+    the samples of every pixel in that row (channels samples per pixel).
+    palette is a list of (red, green, blue) tuples and transparency is the
+    value of the tRNS payload, if present. Images decoded with NumPy
+    available also hold the samples as a 2-D array (a row per image row) in
+    samples, and rows is only made from it when it is first used.
+    """
+    def __init__(self, width, height, bit_depth, color_type, rows,
+                 palette=None, transparency=None, samples=None):
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self._rows = rows
+        self.palette = palette
+        self.transparency = transparency
+        self.samples = samples
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = self.samples.tolist()
+        return self._rows
+
+    @property
+    def channels(self):
+        return CHANNELS[self.color_type]
+
+def unfilter_row(filter_type, line, prev, bpp):
+    """
+    Return a bytearray containing the unfiltered bytes of line, which was
+    filtered with the given filter type. prev is the previous unfiltered
+    row and bpp is the number of bytes per complete pixel.
+    """
+    row = bytearray(line)
+    if filter_type == 0:
+        return row
+    # the filter type is tested once per row rather than once per byte
+    if filter_type == 1:
+        for i in range(bpp, len(row)):
+            row[i] = (row[i] + row[i - bpp]) & 0xff
+    elif filter_type == 2:
+        for i in range(len(row)):
+            row[i] = (row[i] + prev[i]) & 0xff
+    elif filter_type == 3:
+        for i in range(len(row)):
+            a = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((a + prev[i]) >> 1)) & 0xff
+    elif filter_type == 4:
+        for i in range(len(row)):
+            if i >= bpp:
+                row[i] = (row[i] + paeth_predictor(
+                    row[i - bpp], prev[i], prev[i - bpp])) & 0xff
+            else:
+                row[i] = (row[i] + prev[i]) & 0xff
+    else:
+        raise ValueError("Unknown filter type {}".format(filter_type))
+    return row
+
+def numpy_unfilter_rows(data, height, length, bpp):
+    """
+    Return a uint8 array of the height unfiltered rows of length bytes at
+    the start of data. The None, Sub and Up filters are undone with array
+    operations, while Average and Paeth rows, in which each byte depends on
+    the one before, are unfiltered by unfilter_row.
+    """
+    if len(data) < height * (length + 1):
+        raise EOFError()
+    lines = numpy.frombuffer(data, dtype=numpy.uint8,
+                             count=height * (length + 1))
+    lines = lines.reshape(height, length + 1)
+    rows = numpy.empty((height, length), dtype=numpy.uint8)
+    prev = numpy.zeros(length, dtype=numpy.uint8)
+    for y in range(height):
+        filter_type = lines[y, 0]
+        line = lines[y, 1:]
+        row = rows[y]
+        if filter_type == 0:
+            row[:] = line
+        elif filter_type == 1:
+            # the sums of each byte lane wrap at 256 in a uint8 cumsum
+            row[:] = line.reshape(-1, bpp).cumsum(
+                axis=0, dtype=numpy.uint8).reshape(-1)
+        elif filter_type == 2:
+            numpy.add(line, prev, out=row)
+        else:
+            row[:] = numpy.frombuffer(unfilter_row(
+                filter_type, line.tobytes(), prev.tobytes(), bpp),
+                dtype=numpy.uint8)
+        prev = row
+    return rows
+
+def numpy_samples(rows, width, bit_depth, color_type):
+    """
+    Return a 2-D array of the samples of the unfiltered rows (an array as
+    returned by numpy_unfilter_rows).
+    """
+    count = width * CHANNELS[color_type]
+    if bit_depth == 8:
+        return rows[:, :count]
+    if bit_depth == 16:
+        return rows.view(">u2")[:, :count].astype(numpy.uint16)
+    bits = numpy.unpackbits(rows, axis=1)[:, :count * bit_depth]
+    weights = 1 << numpy.arange(bit_depth - 1, -1, -1, dtype=numpy.uint8)
+    return (bits.reshape(len(rows), count, bit_depth) * weights).sum(
+        axis=2, dtype=numpy.uint8)
+
+def unpack_samples(row, bit_depth, count):
+    """
+    Return a list of the first count samples packed in row at the given
+    bit depth.
+    """
+    if bit_depth == 8:
+        return list(row[:count])
+    if bit_depth == 16:
+        return list(struct.unpack("!{}H".format(count), row[:count * 2]))
+    mask = (1 << bit_depth) - 1
+    samples = []
+    for byte in row:
+        for shift in range(8 - bit_depth, -1, -bit_depth):
+            samples.append((byte >> shift) & mask)
+    return samples[:count]
+
+def pack_samples(samples, bit_depth):
+    """
+    Return the bytes of a row containing samples packed at the given bit
+    depth.
+    """
+    if bit_depth == 8:
+        return bytes(samples)
+    if bit_depth == 16:
+        return struct.pack("!{}H".format(len(samples)), *samples)
+    per_byte = 8 // bit_depth
+    out = bytearray((len(samples) + per_byte - 1) // per_byte)
+    for i, sample in enumerate(samples):
+        out[i // per_byte] |= sample << (8 - bit_depth * (i % per_byte + 1))
+    return bytes(out)
+
+def decode_rows(data, width, height, bit_depth, color_type):
+    """
+    Return the unfiltered rows of samples of a non-interlaced image (or of
+    one interlace pass) from the start of data, and the number of bytes of
+    data used.
+    """
+    length = row_bytes(width, bit_depth, color_type)
+    if width == 0 or height == 0:
+        return [], 0
+    bpp = bytes_per_pixel(bit_depth, color_type)
+    count = width * CHANNELS[color_type]
+    prev = bytes(length)
+    rows = []
+    offset = 0
+    for y in range(height):
+        line = data[offset + 1:offset + 1 + length]
+        if len(line) < length:
+            raise EOFError()
+        prev = unfilter_row(data[offset], line, prev, bpp)
+        rows.append(unpack_samples(prev, bit_depth, count))
+        offset += length + 1
+    return rows, offset
+
+def numpy_decode_rows(data, width, height, bit_depth, color_type):
+    """
+    Return a 2-D array of the samples of a non-interlaced image (or of one
+    interlace pass) from the start of data, and the number of bytes of
+    data used.
+    """
+    length = row_bytes(width, bit_depth, color_type)
+    if width == 0 or height == 0:
+        return numpy.zeros((max(0, height), 0), dtype=numpy.uint8), 0
+    rows = numpy_unfilter_rows(data, height, length,
+                               bytes_per_pixel(bit_depth, color_type))
+    return (numpy_samples(rows, width, bit_depth, color_type),
+            height * (length + 1))
+
+def numpy_decode_image_data(data, width, height, bit_depth, color_type,
+                            interlace_method=0):
+    """
+    Return a 2-D array of the samples of the image in the decompressed
+    image data, undoing Adam7 interlacing if interlace_method is 1.
+    """
+    if interlace_method == 0:
+        return numpy_decode_rows(data, width, height, bit_depth,
+                                 color_type)[0]
+    channels = CHANNELS[color_type]
+    samples = numpy.zeros((height, width * channels),
+                          dtype=numpy.uint16 if bit_depth == 16
+                          else numpy.uint8)
+    pixels = samples.reshape(height, width, channels)
+    offset = 0
+    for xstart, ystart, xstep, ystep in ADAM7:
+        pass_width = (width - xstart + xstep - 1) // xstep
+        pass_height = (height - ystart + ystep - 1) // ystep
+        if pass_width <= 0 or pass_height <= 0:
+            continue
+        pass_samples, used = numpy_decode_rows(data[offset:], pass_width,
+            pass_height, bit_depth, color_type)
+        offset += used
+        pixels[ystart::ystep, xstart::xstep] = pass_samples.reshape(
+            pass_height, pass_width, channels)
+    return samples
+
+def decode_image_data(data, width, height, bit_depth, color_type,
+                      interlace_method=0):
+    """
+    Return the rows of samples of the image in the decompressed image
+    data, undoing Adam7 interlacing if interlace_method is 1.
+    """
+    if numpy is not None:
+        return numpy_decode_image_data(data, width, height, bit_depth,
+            color_type, interlace_method).tolist()
+    if interlace_method == 0:
+        return decode_rows(data, width, height, bit_depth, color_type)[0]
+    channels = CHANNELS[color_type]
+    rows = [[0] * (width * channels) for y in range(height)]
+    offset = 0
+    for xstart, ystart, xstep, ystep in ADAM7:
+        pass_width = (width - xstart + xstep - 1) // xstep
+        pass_height = (height - ystart + ystep - 1) // ystep
+        pass_rows, used = decode_rows(data[offset:], max(0, pass_width),
+            max(0, pass_height), bit_depth, color_type)
+        offset += used
+        for j, pass_row in enumerate(pass_rows):
+            row = rows[ystart + j * ystep]
+            for i in range(len(pass_row) // channels):
+                x = xstart + i * xstep
+                row[x * channels:(x + 1) * channels] = \
+                    pass_row[i * channels:(i + 1) * channels]
+    return rows
+
+def payload(root, name):
+    """
+    Return the first node in the tree containing root with the given name,
+    or None.
+    """
+    return root.first_descendent([Name(name)])
+
+def read_image(root):
+    """
+    Return an Image decoded from the image data of the PNG in the tree
+    containing root, as constructed by png.PNG.
+    """
+    png = find_png(root)
+    ihdr = payload(png, "IHDR_payload")
+    plte = payload(png, "PLTE_payload")
+    trns = payload(png, "tRNS_payload")
+    data = zlib.decompress(b"".join(
+        node.value for node in
+        png.gen_descendents([Name("IDAT_payload")])))
+    width = ihdr.width.value
+    height = ihdr.height.value
+    bit_depth = ihdr.bit_depth.value
+    color_type = ihdr.color_type.value
+    palette = list(plte.value) if plte else None
+    transparency = trns.value if trns else None
+    if numpy is not None:
+        samples = numpy_decode_image_data(data, width, height, bit_depth,
+            color_type, ihdr.interlace_method.value)
+        return Image(width, height, bit_depth, color_type, None, palette,
+                     transparency, samples)
+    rows = decode_image_data(data, width, height, bit_depth, color_type,
+                             ihdr.interlace_method.value)
+    return Image(width, height, bit_depth, color_type, rows, palette,
+                 transparency)
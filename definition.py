@@ -4,13 +4,109 @@
 from node import Node
 from validation import *
 from attribute import *
-from path import Path
+from path import Path, rebase_path
+from context import ParseContext
 
+import array
+import copy
 import itertools
 import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 DEBUG = False 
 
+def encode_node(node):
+    """
+    Return the bytes representing node, using the definition recorded in
+    its metadata. Nodes without a definition are encoded from their
+    bytestring value or, failing that, from their children.
+    """
+    definition = node.metadata.get("definition")
+    if definition is not None:
+        return definition.encode(node)
+    if "value" in node.attributes:
+        return bytes(node.attributes["value"])
+    return b"".join(encode_node(child) for child in node.children)
+
+#############################################################################
+# Construction events                                                       #
+#############################################################################
+
+class ConstructionHandler(object):
+    """
+    Base class for objects receiving events as nodes are constructed, which
+    can be passed to Definition.construct as the handler argument. The
+    on_* methods do nothing by default and are overridden to compute
+    results during a single read of the source:
+        on_node_start(definition, node, offset) - a node has been created
+            for the resolved definition at the given source offset.
+        on_value(node, value) - the value of node has been read.
+        on_issue(node, issue) - a validation issue was recorded on node.
+        on_node_end(node, offset) - node is complete (its attributes are
+            set and it has been validated), at the given source offset.
+        on_node_discarded(node) - node was started but removed from the
+            tree before it was complete (e.g. a sequence item at the end of
+            the source), so that it has no on_node_end. This is called for
+            the unfinished nodes below node first.
+
+    If treeless is True, nodes only keep their children while they are
+    being constructed, so that Paths and validations referring to siblings
+    still work but the tree is not accumulated. When a node ends its
+    children are released, other than those for which retain returns True
+    (by default when any of the functions in the retain argument return
+    True when called with the node). Validations that walk the rest of the
+    tree then only see the retained nodes, but counts of the nodes with
+    given names (root.count_descendents of Name criteria, which compiled
+    Paths answer from the name index of the ParseContext) include the
+    released nodes.
+    """
+    def __init__(self, treeless=False, retain=None):
+        self.treeless = treeless
+        self.retain_criteria = retain if retain else []
+
+    def on_node_start(self, definition, node, offset):
+        pass
+
+    def on_value(self, node, value):
+        pass
+
+    def on_issue(self, node, issue):
+        pass
+
+    def on_node_end(self, node, offset):
+        pass
+
+    def on_node_discarded(self, node):
+        pass
+
+    def retain(self, node):
+        """
+        Return True if node should be kept by its parent in treeless mode.
+        """
+        return any(criterion(node) for criterion in self.retain_criteria)
+
+    def end_node(self, node, offset):
+        """
+        Report the issues recorded on node and the end of node, then
+        release its children if in treeless mode.
+        """
+        for issue in iter_issues(node.metadata.get("validation", [])):
+            self.on_issue(node, issue)
+        self.on_node_end(node, offset)
+        if self.treeless:
+            kept = []
+            for child in node._children:
+                if self.retain(child):
+                    kept.append(child)
+                elif node._context is not None:
+                    node._context.node_released(child)
+            node._children[:] = kept
+
 #############################################################################
 # Definition base class                                                     #
 #############################################################################
@@ -22,6 +118,10 @@ class Definition(object):
     """
     value_error_msg = ("Expected list and dict in value_func argument, but" +
                        "found {} and {}")
+    # the class of ParseContext created when this definition is constructed
+    # under a parent without one
+    context_class = ParseContext
+
     def __init__(self, name, value_func=None, children=None, attributes=None,
                  validation=None, **kwargs):
         """
@@ -51,6 +151,7 @@ class Definition(object):
         self.children = children if children else []
         self.attributes = self._get_attributes(attributes)
         self.validation = self._get_validation(validation)
+        self.build_stages()
         self._set_kwargs(kwargs)
         if self.children and self.value_func:
             raise ValueError("Cannot define both children and a " +
@@ -96,6 +197,31 @@ class Definition(object):
                             method_names.add(k)
         return validation
 
+    def build_stages(self):
+        """
+        Set self.validation_stages to a dictionary mapping a (min_level,
+        subset) key to a dictionary mapping each stage with validation
+        methods in self.validation to a tuple of their compiled forms (see
+        validation.compile_stages and ParseContext.stages_key). Only the
+        key (0, None), for all rules, is compiled here; the others are
+        added by stages_for as they are used. This must be called again if
+        self.validation is changed.
+        """
+        self.validation_stages = {(0, None): compile_stages(self.validation)}
+
+    def stages_for(self, min_level, subset=None):
+        """
+        Return the compiled validation methods by stage without the rules
+        whose errors are below min_level, and limited to the given subset
+        ("inline" or "deferred"; see validation.compile_stages).
+        """
+        key = (min_level, subset)
+        stages = self.validation_stages.get(key)
+        if stages is None:
+            stages = compile_stages(self.validation, min_level, subset)
+            self.validation_stages[key] = stages
+        return stages
+
     def _set_value_func_values(self, value_func):
         """
         Set the instance attributes value_func, value_func_args and
@@ -189,35 +315,58 @@ class Definition(object):
             vals = vals
         )
 
-    def validate_stage(self, node, stage, descendent=None):
+    def validate_stage(self, node, stage, descendent=None, deferred=False):
         """
         Call the validation methods in self.validaton with the given
         node and descendent where the validation method's stage
-        attribute matches the given stage.
+        attribute matches the given stage. Stages without validation
+        methods return at once. Rules and issues below the min_level of the
+        node's ParseContext are skipped, as are the rules it defers (see
+        ParseContext.validation_mode). If deferred is True only the
+        deferred rules are called.
         """
+        context = node._context
+        if context is None:
+            key = (0, None)
+        elif deferred:
+            key = (context.min_level, "deferred")
+        else:
+            key = context.stages_key
+        stages = self.validation_stages.get(key)
+        if stages is None:
+            stages = self.stages_for(*key)
+        level = key[0]
+        rules = stages.get(stage)
+        if not rules:
+            return []
         issues = []
         if DEBUG:
             print("validate_stage", node, stage, descendent)
             print("validation is", [str(v) for v in self.validation])
-        for validation in (v for v in self.validation if v.stage == stage):
+        for validation in rules:
             if DEBUG:
                 print("validating against", validation)
             try:
                 validation(self, node, descendent)
             except (ValidationInfo, ValidationWarning, ValidationError) as err:
-                issues.append(err)
+                # validation methods and compound rules may raise issues
+                # below the level of the rule
+                if err.level >= level:
+                    issues.append(err)
             except (ValidationFatal):
                 raise
         if issues:
             node.add_data({"validation": issues}, meta=True)
         return issues
 
-    def construct(self, source, parent=None, _node=None):
+    def construct(self, source, parent=None, _node=None, handler=None):
         """
         Construct and return a node using the data from the given source.
         If parent is given, the node will be added as a child of the parent
         node. The _node argument is used internally and should generally be
-        omitted when calling construct externally.
+        omitted when calling construct externally. If handler is given, it
+        should be a ConstructionHandler, whose methods are called as each
+        node in the tree is started, read and completed.
 
         The node object (and its attributes) are added to the tree as soon
         as possible during the method, which allows nodes in the partially
@@ -245,20 +394,49 @@ class Definition(object):
             ))
         if _node is None:
             node = Node(self.name, parent)
+            if node._context is None:
+                node._context = self.context_class()
+                node._context.index_node(node)
             facade = object.__new__(self.__class__)
             facade.__dict__ = self.resolve_all(node)
-            return facade.construct(source, parent, node)
+            return facade.construct(source, parent, node, handler)
         # This must be a resolved copy of the definition, so do the actual
         # node construction work here.
         node = _node
         node.add_data({"definition": self}, meta=True)
+        node._context.node_started(node)
+        if handler:
+            handler.on_node_start(self, node, source.tell())
         self.validate_stage(node, "pre")
         node.add_data(source.get_preread_metadata(node), meta=True)
         if self.value_func:
-            node.add_data({"value":
-                self.value_func.__call__(self, node, source,
-                    *self.value_func_args, **self.value_func_kwargs)
-            })
+            value = self.value_func.__call__(self, node, source,
+                *self.value_func_args, **self.value_func_kwargs)
+            node.add_data({"value": value})
+            if handler:
+                handler.on_value(node, value)
+        self.construct_children(source, node, handler)
+        self.validate_stage(node, "pre_derivation")
+        for attr in self.attributes:
+            if DEBUG:
+                print("attribute:", attr)
+            try:
+                name, val = attr(node)
+                node.add_data({name: val})
+            except AttributeProcessingError as err:
+                node.add_data({"validation": [err]}, meta=True)
+        node.add_data(source.get_postread_metadata(node), meta=True)
+        self.validate_stage(node, "post")
+        node._context.node_ended(node)
+        if handler:
+            handler.end_node(node, source.tell())
+        return node
+
+    def construct_children(self, source, node, handler=None):
+        """
+        Construct the children of node from the given source, calling the
+        per_child validation stage after each child is constructed.
+        """
         if callable(self.children):
             children = self.children()
         else:
@@ -269,26 +447,23 @@ class Definition(object):
             while True:
                 try:
                     childdef = children.send(childnode)
-                    childnode = childdef.construct(source, node)
+                    childnode = childdef.construct(source, node,
+                                                   handler=handler)
                     self.validate_stage(node, "per_child", childnode)
                 except StopIteration:
                     break
         else:
             for childdef in children:
-                childnode = childdef.construct(source, node)
+                childnode = childdef.construct(source, node, handler=handler)
                 self.validate_stage(node, "per_child", childnode)
-        self.validate_stage(node, "pre_derivation")
-        for attr in self.attributes:
-            if DEBUG:
-                print("attribute:", attr)
-            try:
-                name, val = attr(node)
-                node.add_data({name: val})
-            except AttributeProcessingError as err:
-                node.add_data({"validation": [err]}, meta=True)
-        node.add_data(source.get_postread_metadata(node), meta=True)
-        self.validate_stage(node, "post")
-        return node
+
+    def encode(self, node):
+        """
+        Return the bytes representing node in the underlying file. This
+        concatenates the encoded children of node; definitions that read a
+        value override it to encode the value instead.
+        """
+        return b"".join(encode_node(child) for child in node.children)
 
 
     @staticmethod
@@ -335,6 +510,12 @@ class StaticDef(Definition):
         """
         return source.read(len(self.staticbytes))
 
+    def encode(self, node):
+        """
+        Return the bytestring value of node.
+        """
+        return bytes(node.attributes["value"])
+
 class IntegerDef(Definition):
     """
     Definition class for nodes representing a single integer. The
@@ -354,6 +535,12 @@ class IntegerDef(Definition):
         size = struct.calcsize(self.structformat)
         return struct.unpack(self.structformat, source.read(size))[0]
 
+    def encode(self, node):
+        """
+        Return the integer value of node packed using self.structformat.
+        """
+        return struct.pack(self.structformat, node.attributes["value"])
+
 
 class IntegerSequenceDef(IntegerDef):
     """
@@ -364,19 +551,25 @@ class IntegerSequenceDef(IntegerDef):
     subsequences in the sequence. The subseq_length argument provides the
     length of the subsequences (default 1). If subseq_length is 1, then
     a tuple of integers is returns. If subseq_length is greater than 1,
-    then a tuple of tuples is returned.
+    then a tuple of tuples is returned. If as_array is True, then the
+    integers are instead returned in native byte order as a NumPy array if
+    NumPy is available, with a row of subseq_length integers for each item
+    if subseq_length is not 1, and otherwise as a flat array.array of all
+    of the integers, whose items start every subseq_length integers.
     """
     def __init__(self, name, structformat, items, subseq_length=1,
-                 attributes=None, validation=None):
+                 attributes=None, validation=None, as_array=False):
         self.items = items
         self.subseq_length = subseq_length
+        self.as_array = as_array
         super().__init__(name, structformat, attributes=attributes,
                          validation=validation)
 
     def get_value(self, node, source, *args, **kwargs):
         """
-        Read bytes from the source and return a tuple of integers or a
-        tuple containing tuples which contain subseq_length integers.
+        Read the bytes for the whole sequence from the source in one go and
+        return a tuple of integers, a tuple containing tuples which contain
+        subseq_length integers or the equivalent array (see decode_array).
         """
         if self.items < 0:
             raise ValidationFatal(
@@ -386,19 +579,125 @@ class IntegerSequenceDef(IntegerDef):
             raise ValidationFatal(
                 "subseq_length is less than 0"
             )
-        seq = []
-        for i in range(self.items):
-            subseq = []
-            for j in range(self.subseq_length):
-                subseq.append(IntegerDef.get_value(self, node, source))
-            if len(subseq) == 1:
-                seq.append(subseq[0])
-            else:
-                seq.append(tuple(subseq))
-        return tuple(seq)
+        count = self.items * self.subseq_length
+        data = source.read(count * struct.calcsize(self.structformat))
+        if self.as_array:
+            return self.decode_array(data)
+        values = self.decode_values(data, count)
+        if self.subseq_length == 1:
+            return values
+        return tuple(zip(*[iter(values)] * self.subseq_length)
+                     if self.subseq_length else [()] * self.items)
+
+    def decode_values(self, data, count):
+        """
+        Return a tuple of the count integers contained in data.
+        """
+        fmt = self.structformat
+        if len(fmt) == 2 and fmt[0] in "@=<>!":
+            return struct.unpack(fmt[0] + str(count) + fmt[1], data)
+        return tuple(v[0] for v in struct.iter_unpack(fmt, data))
+
+    def decode_array(self, data):
+        """
+        Return an array containing the integers in data in native byte
+        order: a NumPy array of shape (self.items, self.subseq_length), or
+        of shape (self.items,) if subseq_length is 1, if NumPy is available
+        and otherwise a flat array.array.
+        """
+        fmt = self.structformat
+        code = fmt[-1]
+        size = struct.calcsize(fmt)
+        if numpy is not None and size in (1, 2, 4, 8):
+            byte_order = {"<": "<", ">": ">", "!": ">"}.get(fmt[0], "=")
+            dtype = numpy.dtype(byte_order + ("i" if code.islower() else "u")
+                                + str(size))
+            values = numpy.frombuffer(data, dtype=dtype).astype(
+                dtype.newbyteorder("="))
+            if self.subseq_length != 1:
+                values = values.reshape(self.items, self.subseq_length)
+            return values
+        typecodes = "bhilq" if code.islower() else "BHILQ"
+        for typecode in typecodes:
+            if array.array(typecode).itemsize == size:
+                break
+        else:
+            return array.array("q" if code.islower() else "Q",
+                               self.decode_values(data, len(data) // size))
+        values = array.array(typecode, data)
+        byte_order = fmt[0] if fmt[0] in "@=<>!" else "@"
+        if (byte_order in "!>" and sys.byteorder == "little" or
+            byte_order == "<" and sys.byteorder == "big"):
+            values.byteswap()
+        return values
+
+    def encode(self, node):
+        """
+        Return the integers in the value of node, flattened and packed
+        using self.structformat.
+        """
+        values = node.attributes["value"]
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            values = values.ravel().tolist()
+        elif isinstance(values, array.array):
+            values = values.tolist()
+        elif self.subseq_length != 1:
+            values = [v for subseq in values for v in subseq]
+        fmt = self.structformat
+        if len(fmt) == 2 and fmt[0] in "@=<>!":
+            return struct.pack(fmt[0] + str(len(values)) + fmt[1], *values)
+        return b"".join(struct.pack(fmt, v) for v in values)
                 
 
 
+class RecordSequenceDef(Definition):
+    """
+    Definition class for nodes representing a sequence of fixed size
+    records of integers, which are decoded in one go rather than as a node
+    per field. The fields argument is a list of (name, structformat) pairs
+    which share a byte order, and the items argument gives the number of
+    records. If NumPy is available the value is a structured array with a
+    field for each name, otherwise it is a tuple of tuples.
+    """
+    def __init__(self, name, fields, items, attributes=None,
+                 validation=None):
+        self.fields = fields
+        self.items = items
+        byte_order = fields[0][1][0]
+        self.layout = struct.Struct(
+            byte_order + "".join(fmt[1:] for _, fmt in fields))
+        self.dtype = None
+        if numpy is not None:
+            self.dtype = numpy.dtype([
+                (field, ("<" if fmt[0] == "<" else ">") +
+                        ("u" if fmt[1].isupper() else "i") +
+                        str(struct.calcsize(fmt)))
+                for field, fmt in fields])
+        super().__init__(name, self.__class__.get_value,
+                         attributes=attributes, validation=validation)
+
+    def get_value(self, node, source, *args, **kwargs):
+        """
+        Read self.items records from source and return them as a
+        structured array, or a tuple of tuples if NumPy is unavailable.
+        """
+        if self.items < 0:
+            raise ValidationFatal("items is less than 0")
+        data = source.read(self.items * self.layout.size)
+        if self.dtype is not None:
+            return numpy.frombuffer(data, dtype=self.dtype)
+        return tuple(self.layout.iter_unpack(data))
+
+    def encode(self, node):
+        """
+        Return the records in the value of node packed using self.layout.
+        """
+        values = node.attributes["value"]
+        if self.dtype is not None and isinstance(values, numpy.ndarray):
+            return values.astype(self.dtype).tobytes()
+        return b"".join(self.layout.pack(*record) for record in values)
+
+
 class BytestringDef(Definition):
     """
     Definition class for nodes representing a bytestring. The length
@@ -419,6 +718,12 @@ class BytestringDef(Definition):
             )
         return source.read(self.length)
 
+    def encode(self, node):
+        """
+        Return the bytestring value of node.
+        """
+        return bytes(node.attributes["value"])
+
 
 class StringDef(Definition):
     """
@@ -443,6 +748,12 @@ class StringDef(Definition):
             raise ValidationFatal("length is less than 0")
         return self.decode_value(node, source.read(self.length))
 
+    def encode(self, node):
+        """
+        Return the string value of node encoded using self.encoding.
+        """
+        return node.attributes["value"].encode(self.encoding)
+
     def decode_value(self, node, val):
         """
         Return a string produced from decoding val using self.encoding.
@@ -450,7 +761,7 @@ class StringDef(Definition):
         try:
             return val.decode(self.encoding, errors="strict")
         except (ValueError, UnicodeDecodeError) as err:
-            node.add_data({"validation": ValidationError(str(err))},
+            node.add_data({"validation": [ValidationError(str(err))]},
                           meta=True)
             return val.decode(self.encoding, errors="replace")
 
@@ -480,6 +791,13 @@ class NullTerminatedStringDef(StringDef):
         return self.decode_value(
             node, bytearray(b''.join(b for b in iter(source.read, b'\x00'))))
 
+    def encode(self, node):
+        """
+        Return the string value of node encoded using self.encoding and
+        followed by a null byte.
+        """
+        return super().encode(node) + b'\x00'
+
 ##############################################################################
 # Definition container classes                                               #
 ##############################################################################
@@ -493,6 +811,81 @@ class DefinedChildrenDef(Definition):
     def __init__(self, name, children, attributes=None, validation=None):
         super().__init__(name, None, children=children, attributes=attributes,
                          validation=validation)
+        self.layout = self.compile_layout(self.children)
+
+    @staticmethod
+    def compile_layout(children):
+        """
+        If every child definition is a plain IntegerDef with a static
+        structformat and a common byte order, return a tuple of a
+        struct.Struct that unpacks all of the children in one go and a
+        list of the (start, end) offsets of each child within it.
+        Otherwise return None.
+        """
+        if not isinstance(children, list) or not children:
+            return None
+        byte_order = None
+        codes = []
+        for child in children:
+            if type(child) is not IntegerDef:
+                return None
+            if any(hasattr(v, "resolve_path")
+                   for v in child.__dict__.values()):
+                return None
+            fmt = child.structformat
+            if not isinstance(fmt, str) or len(fmt) != 2:
+                return None
+            if fmt[0] not in "=<>!" or fmt[1] not in "bBhHiIlLqQ":
+                return None
+            if byte_order not in (None, fmt[0]):
+                return None
+            byte_order = fmt[0]
+            codes.append(fmt[1])
+        offsets = []
+        start = 0
+        for code in codes:
+            end = start + struct.calcsize(byte_order + code)
+            offsets.append((start, end))
+            start = end
+        return (struct.Struct(byte_order + "".join(codes)), offsets)
+
+    def construct_children(self, source, node, handler=None):
+        """
+        Construct the children of node. Fixed layouts of integers are read
+        with a single read and unpack, after which a node is created for
+        each field and validated in the same way as if it had been
+        constructed individually.
+        """
+        if self.layout is None:
+            return super().construct_children(source, node, handler)
+        layout, offsets = self.layout
+        start = source.tell()
+        values = layout.unpack(source.read(layout.size))
+        for childdef, value, (first, last) in zip(self.children, values,
+                                                   offsets):
+            childnode = Node(childdef.name, node)
+            childnode.add_data({"definition": childdef}, meta=True)
+            childnode._context.node_started(childnode)
+            if handler:
+                handler.on_node_start(childdef, childnode, start + first)
+            childdef.validate_stage(childnode, "pre")
+            childnode.add_data(source.get_span_metadata(
+                childnode, start + first, start + last), meta=True)
+            childnode.add_data({"value": value})
+            if handler:
+                handler.on_value(childnode, value)
+            childdef.validate_stage(childnode, "pre_derivation")
+            for attr in childdef.attributes:
+                try:
+                    name, val = attr(childnode)
+                    childnode.add_data({name: val})
+                except AttributeProcessingError as err:
+                    childnode.add_data({"validation": [err]}, meta=True)
+            childdef.validate_stage(childnode, "post")
+            childnode._context.node_ended(childnode)
+            if handler:
+                handler.end_node(childnode, start + last)
+            self.validate_stage(node, "per_child", childnode)
 
 
 class NodeSequenceDef(Definition):
@@ -510,10 +903,11 @@ class NodeSequenceDef(Definition):
         stop = stop if stop else lambda node: False
         super().__init__(name, None, attributes=attributes,
                          validation=validation,
-                         children=self.child_generator(childdef), items=items,
+                         children=lambda: self.child_generator(childdef),
+                         items=items,
                          stop=stop)
 
-    def construct(self, source, parent, _node=None):
+    def construct(self, source, parent, _node=None, handler=None):
         # if neither self.stop nor self.items is defined then the only
         # way that construction can end is by running out of file, in which
         # case an EOFError will be generated. This is OK as long as the most
@@ -521,7 +915,7 @@ class NodeSequenceDef(Definition):
         if DEBUG:
             print("Constructing {}".format(self.name))
         try:
-            return super().construct(source, parent, _node)
+            return super().construct(source, parent, _node, handler)
         except EOFError:
             reraise = True
             if self.items is None:
@@ -531,17 +925,25 @@ class NodeSequenceDef(Definition):
                         # get rid of the last node - it was created but
                         # when trying to read from source to get its data
                         # we hit end of file
+                        children[-1]._context.node_discarded(children[-1])
+                        if handler:
+                            for discarded in reversed(list(children[-1])):
+                                handler.on_node_discarded(discarded)
                         del children[-1]
                         reraise = False
+                        if handler:
+                            handler.end_node(parent.children[-1],
+                                             source.tell())
             if reraise:
                 raise
 
     def child_generator(self, childdef):
         node = (yield None)
-        if isinstance(self.items, Path):
-            items = self.items.resolve_path(node)
-        else:
-            items = self.items
+        # node is constructed by the resolved copy of this definition (see
+        # Definition.construct), whose items has already been resolved
+        items = node._metadata.get("definition", self).items
+        if isinstance(items, Path):
+            items = items.resolve_path(node)
         if items is not None and items < 0:
             raise ValidationFatal("items is less than 0")
         for i in itertools.count() if not items else range(items+1):
@@ -561,43 +963,159 @@ class DelegatingDef(Definition):
     construction time. The defdict argument is a dictionary mapping keys to
     definition instances while keyfunc is a function that should return a
     key mapping to the desired definition when called with the parent node.
+
+    A key may also map to another key (e.g. 3: 2), and keys without a
+    definition fall back to the "default" key. These aliases are flattened
+    into a lookup table when the DelegatingDef is created or a definition
+    is registered, so that dispatch is a single dictionary lookup.
+
+    keyfunc and the "pre" stage validation are written as if resolved
+    against the node being constructed. Where they are Paths that can be
+    rebased (see path.rebase_path) they are resolved against the parent
+    instead. Otherwise a placeholder node is added to the parent while
+    they are resolved.
     """
     def __init__(self, defdict, keyfunc, validation=None):
         self.name = "DelegatingDef"
         self.keyfunc = keyfunc
         self.defdict = defdict
         self.validation = self._get_validation(validation)
+        self.build_stages()
+        try:
+            self.parent_keyfunc = rebase_path(keyfunc)
+            self.parent_validation = [
+                self.rebase_validation(v)
+                for v in self.validation if v.stage == "pre"]
+        except (ValueError, AttributeError):
+            self.parent_keyfunc = None
+            self.parent_validation = None
+        # compiled parent_validation rules by minimum error level
+        self.parent_rules = {}
+        self.build_table()
+
+    @classmethod
+    def rebase_validation(cls, validation):
+        """
+        Return a copy of validation which gives the same result when called
+        with the parent of a node as validation does with the node itself.
+        Raise ValueError if this is not possible.
+        """
+        rebased = copy.copy(validation)
+        if isinstance(validation, Validation):
+            # issues from the rebased rule are counted as the original's
+            rebased._rule_id = validation.rule_id
+        if isinstance(validation, CompoundValidation):
+            rebased.v1 = cls.rebase_validation(validation.v1)
+            rebased.v2 = cls.rebase_validation(validation.v2)
+        elif isinstance(validation, Validation):
+            rebased.value = cls.rebase_operand(validation.value)
+            rebased.comparison = cls.rebase_operand(validation.comparison)
+        else:
+            raise ValueError("Cannot rebase {}".format(validation))
+        return rebased
 
+    @classmethod
+    def rebase_operand(cls, operand):
+        if isinstance(operand, Path):
+            return rebase_path(operand)
+        if isinstance(operand, (tuple, list)):
+            return type(operand)(cls.rebase_operand(v) for v in operand)
+        if isinstance(operand, str):
+            # strings name attributes of the node
+            raise ValueError("Cannot rebase {}".format(operand))
+        return operand
 
-    def construct(self, source, parent):
+    def lookup(self, key):
+        """
+        Return the definition that key maps to in self.defdict, following
+        aliases and falling back to the "default" key, or None.
+        """
+        default = self.defdict.get("default")
+        delegated = self.defdict.get(key, default)
+        seen = set()
+        while delegated is not None and not isinstance(delegated,
+                                                       Definition):
+            if delegated in seen:
+                return None
+            seen.add(delegated)
+            delegated = self.defdict.get(delegated, default)
+        return delegated
+
+    def build_table(self):
+        """
+        Set self.table to a dictionary mapping each key of self.defdict
+        directly to its definition, and self.default to the definition used
+        for other keys.
+        """
+        self.table = {key: self.lookup(key) for key in self.defdict}
+        self.default = self.lookup("default")
+
+    def construct(self, source, parent, handler=None):
         if DEBUG:
             print("Constructing {}".format(self.name))
             print("validating stage - pre")
-        # create a fake node so that Path semantics work properly
-        fakenode = Node(self.name, parent)
-        self.validate_stage(fakenode, "pre")
-        if hasattr(self.keyfunc, "resolve_path"):
-            key = self.keyfunc.resolve_path(fakenode)
+        if self.parent_keyfunc is not None:
+            self.validate_parent(parent)
+            key = self.parent_keyfunc.resolve_path(parent)
         else:
-            key = self.keyfunc(fakenode)
-        delegated = self.defdict.get(key, self.defdict.get("default"))
-        while not isinstance(delegated, Definition):
-            delegated = self.defdict.get(
-                delegated, self.defdict.get("default"))
-            if delegated is None:
-                break
-        # delete the fake node before constructing the real one
-        del fakenode.parent.children[-1]
+            # create a fake node so that Path semantics work properly
+            fakenode = Node(self.name, parent)
+            self.validate_stage(fakenode, "pre")
+            if hasattr(self.keyfunc, "resolve_path"):
+                key = self.keyfunc.resolve_path(fakenode)
+            else:
+                key = self.keyfunc(fakenode)
+            # delete the fake node before constructing the real one, moving
+            # its issues to the parent as validate_parent records them
+            issues = list(iter_issues(fakenode._metadata.get("validation",
+                                                             [])))
+            detach_issues(fakenode)
+            for issue in issues:
+                if (isinstance(issue, ValidationException) and
+                        issue.offset is None):
+                    issue._offset = parent._metadata.get("start_index")
+            del fakenode.parent.children[-1]
+            if fakenode._context is not None:
+                fakenode._context.node_discarded(fakenode)
+            if issues:
+                parent.add_data({"validation": issues}, meta=True)
+        delegated = self.table.get(key, self.default)
         if delegated:
-            return delegated.construct(source, parent)
-        else:
+            return delegated.construct(source, parent, handler=handler)
+        elif parent._context is None or parent._context.reports(
+                ValidationWarning):
             parent.add_data({"validation":[
                 ValidationWarning(
                      "Failed to find a definition to delegate to."
                 )
             ]}, meta=True)
 
+    def validate_parent(self, parent):
+        """
+        Call the rebased "pre" stage validation methods with the parent of
+        the node to be constructed, recording any issues on the parent.
+        Rules and issues below the min_level of the parent's ParseContext
+        are skipped.
+        """
+        context = parent._context
+        level = context.min_level if context is not None else 0
+        rules = self.parent_rules.get(level)
+        if rules is None:
+            rules = compile_stages(self.parent_validation,
+                                   level).get("pre", ())
+            self.parent_rules[level] = rules
+        issues = []
+        for validation in rules:
+            try:
+                validation(self, parent)
+            except (ValidationInfo, ValidationWarning, ValidationError) as err:
+                if err.level >= level:
+                    issues.append(err)
+        if issues:
+            parent.add_data({"validation": issues}, meta=True)
+
     def register(self, definition, name=None):
         self.defdict[name if name else definition.name] = definition
+        self.build_table()
         return definition
 
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from node import Node
+from definition import *
+from validation import *
+from writer import encode_chunk, SIGNATURE
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os
+import png
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+##############################################################################
+# Image parameters                                                           #
+##############################################################################
+
+# number of channels for each color_type
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# ancillary chunks which must appear before the PLTE chunk
+BEFORE_PLTE = ("cHRM", "gAMA", "iCCP", "sBIT", "sRGB")
+
+def row_bytes(width, bit_depth, color_type):
+    """
+    Return the number of bytes in an unfiltered row of an image with the
+    given width, bit_depth and color_type.
+    """
+    return (width * CHANNELS[color_type] * bit_depth + 7) // 8
+
+def bytes_per_pixel(bit_depth, color_type):
+    """
+    Return the distance in bytes between corresponding bytes of adjacent
+    pixels, as used by the filter algorithms (at least 1).
+    """
+    return max(1, (CHANNELS[color_type] * bit_depth) // 8)
+
+##############################################################################
+# Payload encoding                                                           #
+##############################################################################
+
+def build_payload(definition, value, parent=None):
+    """
+    Create and return a node tree for the given definition holding value.
+    For definitions with children, value should be a dictionary mapping
+    the names of the child definitions to their values.
+    """
+    node = Node(definition.name, parent)
+    node.add_data({"definition": definition}, meta=True)
+    if definition.value_func:
+        node.add_data({"value": value})
+    else:
+        for childdef in definition.children:
+            build_payload(childdef, value[childdef.name], node)
+    return node
+
+def payload_bytes(chunk_type, value):
+    """
+    Return the payload bytes for a chunk of the given type. value may be
+    the payload as bytes, or the value(s) to be encoded using the payload
+    definition registered in png.PNGPayloads: a dictionary of field values
+    for definitions with children, or a single value otherwise.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    definition = png.PNGPayloads.defdict.get(chunk_type + "_payload")
+    if not isinstance(definition, Definition) or isinstance(
+            definition, DelegatingDef):
+        raise ValueError(
+            "No fixed definition for {} payload; provide bytes".format(
+                chunk_type))
+    node = build_payload(definition, value)
+    issues = []
+    # only field level rules are checked, as the chunk level rules refer to
+    # the rest of the document
+    for child in node.children:
+        child.definition.validate_stage(child, "post")
+        issues.extend(child.metadata.get("validation", []))
+    if issues:
+        raise ValueError(str(issues[0]))
+    return encode_node(node)
+
+##############################################################################
+# Filtering                                                                  #
+##############################################################################
+
+def paeth_predictor(a, b, c):
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    elif pb <= pc:
+        return b
+    return c
+
+FILTER_TYPES = (0, 1, 2, 3, 4)
+
+def filter_row(filter_type, row, prev, bpp):
+    """
+    Return the bytes of row filtered using the given filter type (0-4),
+    preceded by the filter type byte. prev is the previous unfiltered row
+    (all zeroes for the first row) and bpp is the number of bytes per
+    complete pixel.
+    """
+    if filter_type == 0:
+        return bytes([0]) + row
+    if filter_type not in FILTER_TYPES:
+        raise ValueError("Unknown filter type {}".format(filter_type))
+    if numpy is not None:
+        return bytes([filter_type]) + numpy_filters(
+            row, prev, bpp, (filter_type,))[0].tobytes()
+    out = bytearray(len(row) + 1)
+    out[0] = filter_type
+    for i in range(len(row)):
+        a = row[i - bpp] if i >= bpp else 0
+        b = prev[i]
+        if filter_type == 1:
+            pred = a
+        elif filter_type == 2:
+            pred = b
+        elif filter_type == 3:
+            pred = (a + b) // 2
+        else:
+            pred = paeth_predictor(a, b, prev[i - bpp] if i >= bpp else 0)
+        out[i + 1] = (row[i] - pred) & 0xff
+    return bytes(out)
+
+def numpy_filters(row, prev, bpp, filter_types=FILTER_TYPES):
+    """
+    Return a 2D uint8 NumPy array containing row filtered with each of the
+    given filter types, computed for the whole row at once.
+    """
+    x = numpy.frombuffer(row, dtype=numpy.uint8).astype(numpy.int16)
+    b = numpy.frombuffer(prev, dtype=numpy.uint8).astype(numpy.int16)
+    a = numpy.zeros_like(x)
+    a[bpp:] = x[:-bpp]
+    c = numpy.zeros_like(x)
+    c[bpp:] = b[:-bpp]
+    out = numpy.empty((len(filter_types), len(x)), dtype=numpy.int16)
+    for i, filter_type in enumerate(filter_types):
+        if filter_type == 0:
+            out[i] = x
+        elif filter_type == 1:
+            out[i] = x - a
+        elif filter_type == 2:
+            out[i] = x - b
+        elif filter_type == 3:
+            out[i] = x - ((a + b) >> 1)
+        else:
+            pa = numpy.abs(b - c)
+            pb = numpy.abs(a - c)
+            pc = numpy.abs(a + b - 2 * c)
+            out[i] = x - numpy.where((pa <= pb) & (pa <= pc), a,
+                                     numpy.where(pb <= pc, b, c))
+    return (out & 0xff).astype(numpy.uint8)
+
+def adaptive_filter_row(row, prev, bpp):
+    """
+    Return the bytes of row filtered with the filter type that gives the
+    minimum sum of absolute differences (treating the filtered bytes as
+    signed), preceded by the filter type byte.
+    """
+    if numpy is not None:
+        candidates = numpy_filters(row, prev, bpp)
+        values = candidates.astype(numpy.int32)
+        best = int(numpy.minimum(values, 256 - values).sum(axis=1).argmin())
+        return bytes([best]) + candidates[best].tobytes()
+    best = None
+    for filter_type in FILTER_TYPES:
+        filtered = filter_row(filter_type, row, prev, bpp)
+        score = sum(v if v < 128 else 256 - v for v in filtered[1:])
+        if best is None or score < best[0]:
+            best = (score, filtered)
+    return best[1]
+
+def brute_filter_row(row, prev, bpp, compressor):
+    """
+    Return the bytes of row filtered with the filter type that adds the
+    fewest bytes to the output of the zlib compressor, which is trialled
+    on copies of compressor and then updated with the chosen row.
+    """
+    if numpy is not None:
+        candidates = [bytes([filter_type]) + filtered.tobytes()
+                      for filter_type, filtered in
+                      enumerate(numpy_filters(row, prev, bpp))]
+    else:
+        candidates = [filter_row(filter_type, row, prev, bpp)
+                      for filter_type in FILTER_TYPES]
+    best = None
+    for filtered in candidates:
+        trial = compressor.copy()
+        size = len(trial.compress(filtered) + trial.flush(zlib.Z_SYNC_FLUSH))
+        if best is None or size < best[0]:
+            best = (size, filtered)
+    compressor.compress(best[1])
+    return best[1]
+
+##############################################################################
+# Parallel compression                                                       #
+##############################################################################
+
+ADLER_BASE = 65521
+
+def adler32_combine(adler1, adler2, len2):
+    """
+    Return the Adler-32 checksum of two concatenated bytestrings given the
+    checksums of each and the length of the second (as zlib's
+    adler32_combine).
+    """
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xffff) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) +
+            ADLER_BASE - rem) % ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+def zlib_header(level, strategy=zlib.Z_DEFAULT_STRATEGY):
+    """
+    Return the two byte zlib stream header that zlib itself would write
+    for the given compression level and strategy.
+    """
+    if strategy >= zlib.Z_HUFFMAN_ONLY or 0 <= level < 2:
+        level_flags = 0
+    elif level < 6:
+        level_flags = 1
+    elif level in (6, -1):
+        level_flags = 2
+    else:
+        level_flags = 3
+    header = (0x78 << 8) | (level_flags << 6)
+    header += 31 - header % 31
+    return struct.pack("!H", header)
+
+def compress_block(block, dictionary, level, strategy, final):
+    """
+    Return the raw deflate data for block, compressed using dictionary as
+    the preset dictionary and ended with a sync flush (or a finish if final
+    is True), and the Adler-32 checksum of block.
+    """
+    kwargs = {"zdict": dictionary} if dictionary else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, strategy,
+                                  **kwargs)
+    data = compressor.compress(block)
+    data += compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return data, zlib.adler32(block)
+
+
+class ParallelCompressor(object):
+    """
+    Compressor producing a single zlib stream, with the same compress and
+    flush methods as zlib.compressobj, which compresses blocks of
+    block_size bytes in a pool of threads in the manner of pigz. Each block
+    uses the last 32 KB of the previous block as its preset dictionary and
+    ends with a sync flush so that the raw deflate outputs can be
+    concatenated, and the block checksums are combined into the Adler-32
+    checksum of the stream.
+    """
+    window_size = 2**15
+
+    def __init__(self, level=6, threads=None, block_size=2**17,
+                 strategy=zlib.Z_DEFAULT_STRATEGY):
+        self.level = level
+        self.strategy = strategy
+        self.block_size = block_size
+        self.threads = threads if threads else os.cpu_count()
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.adler = 1
+        self.header_written = False
+
+    def submit(self, block, final=False):
+        self.pending.append((len(block), self.executor.submit(
+            compress_block, block, self.dictionary, self.level,
+            self.strategy, final)))
+        self.dictionary = bytes(block[-self.window_size:])
+
+    def collect(self, wait=False):
+        """
+        Return the compressed output of the pending blocks which are
+        complete, in order. If wait is True, wait for all pending blocks.
+        """
+        out = []
+        if not self.header_written:
+            out.append(zlib_header(self.level, self.strategy))
+            self.header_written = True
+        while self.pending and (wait or self.pending[0][1].done() or
+                                len(self.pending) > 2 * self.threads):
+            length, future = self.pending.popleft()
+            data, adler = future.result()
+            self.adler = adler32_combine(self.adler, adler, length)
+            out.append(data)
+        return b''.join(out)
+
+    def compress(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return self.collect()
+
+    def flush(self):
+        self.submit(bytes(self.buffer), final=True)
+        del self.buffer[:]
+        out = self.collect(wait=True) + struct.pack("!I", self.adler)
+        self.executor.shutdown()
+        return out
+
+
+def make_compressor(level=6, threads=None, block_size=2**17,
+                    strategy=zlib.Z_DEFAULT_STRATEGY):
+    """
+    Return a zlib compressor for the given level and strategy, which
+    compresses in parallel if threads is greater than 1.
+    """
+    if threads is not None and threads > 1:
+        return ParallelCompressor(level, threads, block_size, strategy)
+    return zlib.compressobj(level, zlib.DEFLATED, 15, 8, strategy)
+
+##############################################################################
+# Encoder                                                                    #
+##############################################################################
+
+class PNGEncoder(object):
+    """
+    Incremental PNG encoder. Rows are filtered, compressed and written to
+    the file object fp as IDAT chunks of idat_size bytes as they are added,
+    so only one row and one IDAT chunk are held in memory. Rows may be
+    bytes, bytearray, memoryview or NumPy arrays, containing the samples
+    of one row packed as in the PNG specification. NumPy arrays with more
+    than one byte per item hold one 16 bit sample per item, in any byte
+    order. Interlaced output is not supported.
+
+    palette is a list of (red, green, blue) tuples for the PLTE chunk, and
+    chunks is a list of (chunk_type, value) tuples for ancillary chunks to
+    be written before the image data (see payload_bytes). If threads is
+    greater than 1, the image data is compressed in parallel blocks of
+    block_size bytes (see ParallelCompressor).
+
+    filter_type is either a filter type (0-4) used for every row,
+    "adaptive" to choose a filter for each row with the minimum sum of
+    absolute differences heuristic, or "brute" to choose the filter for
+    each row which compresses smallest.
+    """
+    def __init__(self, fp, width, height, bit_depth=8, color_type=2,
+                 palette=None, chunks=None, filter_type="adaptive", level=6,
+                 idat_size=2**16, threads=None, block_size=2**17,
+                 strategy=zlib.Z_DEFAULT_STRATEGY):
+        self.fp = fp
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.palette = palette
+        self.chunks = chunks if chunks else []
+        self.filter_type = filter_type
+        self.idat_size = idat_size
+        self.compressor = make_compressor(level, threads, block_size,
+                                          strategy)
+        self.trial_compressor = None
+        if filter_type == "brute":
+            self.trial_compressor = zlib.compressobj(
+                level, zlib.DEFLATED, 15, 8, strategy)
+        self.row_length = row_bytes(width, bit_depth, color_type)
+        self.bpp = bytes_per_pixel(bit_depth, color_type)
+        self.prev = bytes(self.row_length)
+        self.rows = 0
+        self.buffer = bytearray()
+        self.header_written = False
+
+    def write_chunk(self, chunk_type, value):
+        self.fp.write(
+            encode_chunk(chunk_type, payload_bytes(chunk_type, value)))
+
+    def write_header(self):
+        """
+        Write the signature, IHDR, PLTE and ancillary chunks.
+        """
+        self.fp.write(SIGNATURE)
+        self.write_chunk("IHDR", {
+            "width": self.width,
+            "height": self.height,
+            "bit_depth": self.bit_depth,
+            "color_type": self.color_type,
+            "compression_method": 0,
+            "filter_method": 0,
+            "interlace_method": 0
+        })
+        for chunk_type, value in self.chunks:
+            if chunk_type in BEFORE_PLTE:
+                self.write_chunk(chunk_type, value)
+        if self.palette is not None:
+            self.write_chunk("PLTE", tuple(tuple(p) for p in self.palette))
+        for chunk_type, value in self.chunks:
+            if chunk_type not in BEFORE_PLTE:
+                self.write_chunk(chunk_type, value)
+        self.header_written = True
+
+    def filter(self, row):
+        """
+        Return the filtered bytes for row, which follows self.prev.
+        """
+        if self.filter_type == "adaptive":
+            return adaptive_filter_row(row, self.prev, self.bpp)
+        if self.filter_type == "brute":
+            return brute_filter_row(row, self.prev, self.bpp,
+                                    self.trial_compressor)
+        return filter_row(self.filter_type, row, self.prev, self.bpp)
+
+    def compress(self, data):
+        """
+        Return the compressed bytes produced for data.
+        """
+        return self.compressor.compress(data)
+
+    def flush_compressor(self):
+        """
+        Return the remaining compressed bytes at the end of the image.
+        """
+        return self.compressor.flush()
+
+    def write_idat(self, data, final=False):
+        """
+        Add compressed data to the buffer and write out as many complete
+        IDAT chunks as possible (and the remainder if final is True).
+        """
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.idat_size:
+            self.fp.write(encode_chunk(
+                "IDAT", bytes(self.buffer[:self.idat_size])))
+            del self.buffer[:self.idat_size]
+        if final and self.buffer:
+            self.fp.write(encode_chunk("IDAT", bytes(self.buffer)))
+            del self.buffer[:]
+
+    def write_row(self, row):
+        """
+        Filter, compress and write a single row.
+        """
+        if not self.header_written:
+            self.write_header()
+        if getattr(row, "dtype", None) is not None and row.dtype.itemsize > 1:
+            # samples are written big-endian, whatever the native order
+            row = row.astype(">u2", copy=False)
+        row = row.tobytes() if hasattr(row, "tobytes") else bytes(row)
+        if len(row) != self.row_length:
+            raise ValueError("Expected row of {} bytes but found {}".format(
+                self.row_length, len(row)))
+        if self.rows >= self.height:
+            raise ValueError("More than {} rows written".format(self.height))
+        self.write_idat(self.compress(self.filter(row)))
+        self.prev = row
+        self.rows += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        """
+        Finish the image data and write the IEND chunk.
+        """
+        if self.rows != self.height:
+            raise ValueError("Expected {} rows but {} were written".format(
+                self.height, self.rows))
+        self.write_idat(self.flush_compressor(), final=True)
+        self.fp.write(encode_chunk("IEND", b''))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def encode(fp, rows, width, height, **kwargs):
+    """
+    Write a PNG image with the given rows to the file object fp. The
+    keyword arguments are those of PNGEncoder.
+    """
+    encoder = PNGEncoder(fp, width, height, **kwargs)
+    encoder.write_rows(rows)
+    encoder.close()
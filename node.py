@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import abc
 import itertools
 import copy
 import struct
@@ -9,6 +10,173 @@ from validation import *
 from path import Path
 
 
+def _preview(value, length=None):
+    """
+    Return str(value) cut to length characters. Sequences (anything with a
+    length that can be sliced, e.g. array.arrays and NumPy arrays) are
+    sliced before being formatted so that large values are never
+    formatted in full.
+    """
+    if length is None:
+        return str(value)
+    if hasattr(value, "__len__") and not isinstance(value, dict):
+        try:
+            value = value[:length]
+        except (TypeError, KeyError, IndexError, ValueError):
+            pass
+    return str(value)[:length]
+
+
+##############################################################################
+# Query criteria                                                             #
+##############################################################################
+
+class Criterion(abc.ABC):
+    """
+    Base class for declarative criteria, which may be used wherever a
+    criteria function is accepted (e.g. Node.matches) since calling one
+    with a node returns whether the node matches. Unlike a lambda, a
+    criterion can be inspected, compared and pickled. Criteria that only
+    test node names have a names attribute holding the set of names they
+    match (None otherwise), which lets queries avoid calling them and use
+    name indexes. Criteria can be combined with &, | and ~. Subclasses
+    must define __call__.
+    """
+    names = None
+
+    @abc.abstractmethod
+    def __call__(self, node):
+        pass
+
+    def __and__(self, other):
+        return All(self, other)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __hash__(self):
+        return hash((type(self), repr(self)))
+
+class Name(Criterion):
+    """
+    Criterion matching nodes with the given name.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.names = frozenset([name])
+
+    def __call__(self, node):
+        return node._name == self.name
+
+    def __repr__(self):
+        return "Name({!r})".format(self.name)
+
+class NameIn(Criterion):
+    """
+    Criterion matching nodes whose name is one of the given names.
+    """
+    def __init__(self, *names):
+        self.names = frozenset(names)
+
+    def __call__(self, node):
+        return node._name in self.names
+
+    def __repr__(self):
+        return "NameIn({})".format(", ".join(map(repr, sorted(self.names))))
+
+class AttrEquals(Criterion):
+    """
+    Criterion matching nodes with an attribute (not metadata) of the given
+    name equal to value.
+    """
+    def __init__(self, attr, value):
+        self.attr = attr
+        self.value = value
+
+    def __call__(self, node):
+        return (self.attr in node._attributes and
+                node._attributes[self.attr] == self.value)
+
+    def __repr__(self):
+        return "AttrEquals({!r}, {!r})".format(self.attr, self.value)
+
+class All(Criterion):
+    """
+    Criterion matching nodes that match all of the given criteria.
+    """
+    def __init__(self, *criteria):
+        self.criteria = criteria
+        names = [getattr(c, "names", None) for c in criteria]
+        if criteria and None not in names:
+            self.names = frozenset.intersection(*names)
+
+    def __call__(self, node):
+        return all(criterion(node) for criterion in self.criteria)
+
+    def __repr__(self):
+        return "All({})".format(", ".join(map(repr, self.criteria)))
+
+class Any(Criterion):
+    """
+    Criterion matching nodes that match any of the given criteria.
+    """
+    def __init__(self, *criteria):
+        self.criteria = criteria
+        names = [getattr(c, "names", None) for c in criteria]
+        if criteria and None not in names:
+            self.names = frozenset.union(*names)
+
+    def __call__(self, node):
+        return any(criterion(node) for criterion in self.criteria)
+
+    def __repr__(self):
+        return "Any({})".format(", ".join(map(repr, self.criteria)))
+
+class Not(Criterion):
+    """
+    Criterion matching nodes that do not match the given criterion.
+    """
+    def __init__(self, criterion):
+        self.criterion = criterion
+
+    def __call__(self, node):
+        return not self.criterion(node)
+
+    def __repr__(self):
+        return "Not({!r})".format(self.criterion)
+
+def attached(node, ancestor):
+    """
+    Return True if node is still in the tree below ancestor.
+    """
+    while node is not ancestor:
+        parent = node._parent
+        if parent is None or node not in parent._children:
+            return False
+        node = parent
+    return True
+
+def criteria_name_set(criteria):
+    """
+    Return the set of names matched by criteria if every criterion is a
+    name test with a names attribute, otherwise None.
+    """
+    if not criteria:
+        return None
+    names = None
+    for criterion in criteria:
+        matched = getattr(criterion, "names", None)
+        if matched is None:
+            return None
+        names = matched if names is None else names & matched
+    return names
+
 ##############################################################################
 # Node object                                                                #
 ##############################################################################
@@ -27,8 +195,11 @@ class Node(object):
         self._attributes = {}
         self._metadata = {}
         self._parent = parent
+        self._context = parent._context if parent else None
         if self._parent:
             self._parent._children.append(self)
+        if self._context is not None:
+            self._context.index_node(self)
 
     def __str__(self):
         #return "Node({}, {})".format(self._name, repr(self._parent))
@@ -43,7 +214,9 @@ class Node(object):
             if node._parent:
                 siblings = [sib for sib in node._parent._children
                             if sib._name == node._name]
-                if len(siblings) > 1:
+                # a node removed from its parent's children (e.g. released
+                # by a streaming parse) is named without an index
+                if len(siblings) > 1 and any(sib is node for sib in siblings):
                     n.append("[")
                     n.append(str(siblings.index(node)))
                     n.append("]")
@@ -67,21 +240,40 @@ class Node(object):
         ))
 
     def tree_string(self):
-        s = []
+        return "\n".join(self._gen_tree_lines(value_len=32))
+
+    def write_tree(self, fp, max_depth=None, max_value_len=32):
+        """
+        Write the tree rooted at this node to the file object fp, one line
+        at a time, so that large trees can be dumped without building the
+        whole string in memory. Nodes deeper than max_depth (relative to
+        this node) are omitted. Attribute and metadata values are cut to
+        max_value_len characters (no limit if None).
+        """
+        for line in self._gen_tree_lines(max_depth, max_value_len,
+                                         max_value_len):
+            fp.write(line)
+            fp.write("\n")
+
+    def _gen_tree_lines(self, max_depth=None, value_len=None, meta_len=None):
+        """
+        Return a generator yielding the lines of the tree representation
+        of this node and its descendents.
+        """
         stack = [(self,0)]
         while stack:
             node, depth = stack.pop()
             indent = "  " * depth
-            s.append(indent + "Node("+ node._name + ")")
+            yield indent + "Node("+ node._name + ")"
             for k,v in sorted(node.metadata.items()):
                 if k != "definition":
-                    s.append(("  " * (depth + 1)) + k + ": " + str(v))
+                    yield (("  " * (depth + 1)) + k + ": " +
+                           _preview(v, meta_len))
             for k,v in sorted(node.attributes.items()):
-                s.append(("  " * (depth + 1)) + k + ":" + str(v)[:32])
-            for child in reversed(node.children):
-                stack.append((child, depth + 1))
-        return "\n".join(s)
-
+                yield ("  " * (depth + 1)) + k + ":" + _preview(v, value_len)
+            if max_depth is None or depth < max_depth:
+                for child in reversed(node.children):
+                    stack.append((child, depth + 1))
 
     def add_data(self, d, meta=False):
         """
@@ -101,6 +293,21 @@ class Node(object):
             else:
                 attrdict[k] = v
 
+    def set_value(self, value):
+        """
+        Replace the value of this node and mark it as modified.
+        """
+        self._attributes["value"] = value
+        self.mark_modified()
+
+    def mark_modified(self):
+        """
+        Mark this node and its ancestors as modified, so that they are
+        re-encoded rather than copied from the source when written.
+        """
+        for node in self.gen_ancestors(or_self=True):
+            node._metadata["modified"] = True
+
     @property
     def root(self):
         """
@@ -111,6 +318,18 @@ class Node(object):
             node = ancestor
         return node
 
+    @property
+    def context(self):
+        """
+        Return the ParseContext of the parse that created this node, or
+        None.
+        """
+        return self._context
+
+    @context.setter
+    def context(self, context):
+        self._context = context
+
     @property
     def siblings(self):
         """
@@ -180,20 +399,71 @@ class Node(object):
         this node, for which all the criteria functions return True.
         If no criteria are given, all descendent nodes are yielded.
         If or_self is True, then this node is also included if it
-        meets the criteria.
+        meets the criteria. Where the criteria only test names and the name
+        index of the node's ParseContext covers the node, the index is used
+        to return early when there are no matching nodes or to go straight
+        to the only one, if it is still attached below this node.
         """
-        stack = [self] if or_self else list(reversed(self._children))
+        names = criteria_name_set(criteria)
+        if or_self:
+            if (self._name in names if names is not None
+                    else self.matches(criteria)):
+                yield self
+        context = self._context
+        if names is not None and context is not None and context.covers(self):
+            count = context.count_named(names)
+            if count == 0:
+                return
+            if count == 1:
+                first = context.first_named(names)
+                if (first is not None and first is not self and
+                        attached(first, self)):
+                    yield first
+                    return
+        stack = list(reversed(self._children))
         while stack:
             node = stack.pop()
-            if node.matches(criteria):
+            if (node._name in names if names is not None
+                    else node.matches(criteria)):
                 yield node
-            stack.extend(list(reversed(node._children)))
+            stack.extend(reversed(node._children))
 
     def descendents(self, criteria=None, or_self=False):
         return [node for node in self.gen_descendents(criteria, or_self)]
 
     def count_descendents(self, criteria=None, or_self=False):
-        return len(self.descendents(criteria, or_self))
+        return sum(1 for node in self.gen_descendents(criteria, or_self))
+
+    def first_descendent(self, criteria=None, or_self=False):
+        """
+        Return the first descendent node (in document order) for which all
+        the criteria functions return True, or None. The search stops at
+        the first match.
+        """
+        for node in self.gen_descendents(criteria, or_self):
+            return node
+        return None
+
+    def has_descendent(self, criteria=None, or_self=False):
+        """
+        Return True if any descendent node meets the criteria, stopping at
+        the first match.
+        """
+        return self.first_descendent(criteria, or_self) is not None
+
+    def issues(self):
+        """
+        Return a list of the validation issues recorded on this node and
+        its descendents, in document order. If the validation of the tree
+        was deferred (see ParseContext.validation_mode), the deferred rules
+        are run first.
+        """
+        for node in [self] + self._children:
+            context = node._context
+            if context is not None and context.validation_pending:
+                context.validate_deferred()
+        return [issue for node in self
+                for issue in iter_issues(node._metadata.get("validation", []))]
 
     def __iter__(self):
         for node in self.descendents(or_self=True):
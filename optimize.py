@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from node import Node, Name
+from source import FileSource
+from definition import encode_node
+from writer import source_span, read_span
+from decoder import read_image, pack_samples
+from encoder import PNGEncoder
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import namedtuple
+import io
+import os
+import shutil
+import struct
+import zlib
+import png
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+##############################################################################
+# Chunk selection                                                            #
+##############################################################################
+
+# ancillary chunks whose contents depend on the color type, bit depth or
+# palette of the image. tRNS is regenerated from the pixels, while the others
+# are copied when the optimized image has the same encoding and otherwise
+# adapted to it where possible (see adapt_chunks).
+COLOR_DEPENDENT = ("tRNS", "bKGD", "sBIT", "hIST")
+
+# ancillary chunks that affect how the image is displayed, which are kept
+# when stripping metadata
+COLOR_MANAGEMENT = ("cHRM", "gAMA", "iCCP", "sRGB")
+
+def ancillary_chunks(root, strip=False, keep_unsafe=False):
+    """
+    Return a list of (chunk_type, payload) tuples for the ancillary chunks
+    (other than tRNS) of the PNG in the tree containing root that should be
+    copied to the optimized image. Payloads are copied verbatim from the
+    source file unless they have been modified. If strip is True only the
+    color management chunks are kept. strip may also be a collection of
+    chunk types to remove. Unknown chunks that are not safe to copy (whose
+    type has an uppercase fourth letter) may depend on the image data,
+    which is re-encoded, so they are dropped unless keep_unsafe is True.
+    """
+    chunks = []
+    sources = {}
+    try:
+        for chunk in root.gen_descendents([Name("chunk")]):
+            chunk_type = chunk.chunk_type
+            if not chunk_type.ancillary or chunk_type.value == "tRNS":
+                continue
+            if strip is True and chunk_type.value not in COLOR_MANAGEMENT:
+                continue
+            if strip not in (True, False) and chunk_type.value in strip:
+                continue
+            if (not keep_unsafe and not chunk_type.safe_to_copy and
+                    chunk_type.value + "_payload" not in
+                    png.PNGPayloads.defdict):
+                continue
+            chunks.append((chunk_type.value,
+                           raw_payload(chunk.children[2], sources)))
+    finally:
+        for f in sources.values():
+            f.close()
+    return chunks
+
+def raw_payload(node, sources):
+    """
+    Return the bytes of the payload node as read from its source, or
+    re-encoded if it has been modified or was not read from a source.
+    sources is a dictionary of the files opened so far, by path.
+    """
+    span = source_span(node)
+    if span is None:
+        return encode_node(node)
+    return read_span(span, sources)
+
+def rgba_palette(palette, transparency):
+    """
+    Return the palette entries as (red, green, blue, alpha) tuples given
+    the PLTE entries and the tRNS alpha values (or None).
+    """
+    alphas = list(transparency) if transparency else []
+    return [tuple(entry) + (alphas[i] if i < len(alphas) else 255,)
+            for i, entry in enumerate(palette or [])]
+
+def scale_sample(value, bit_depth, to_depth):
+    """
+    Return the sample value at bit_depth rescaled to to_depth, or None if
+    it cannot be represented exactly.
+    """
+    value = value * (2**16 - 1) // (2**bit_depth - 1)
+    step = (2**16 - 1) // (2**to_depth - 1)
+    return value // step if value % step == 0 else None
+
+def adapt_bKGD(payload, image, candidate, entries):
+    if image.color_type == 3:
+        if not payload or payload[0] >= len(image.palette or []):
+            return None
+        rgb = tuple(image.palette[payload[0]])
+        bit_depth = 8
+    elif image.color_type in (0, 4):
+        rgb = struct.unpack("!H", payload[:2]) * 3
+        bit_depth = image.bit_depth
+    else:
+        rgb = struct.unpack("!3H", payload[:6])
+        bit_depth = image.bit_depth
+    # palette entries are 8 bit samples
+    depth = 8 if candidate.color_type == 3 else candidate.bit_depth
+    rgb = tuple(scale_sample(v, bit_depth, depth) for v in rgb)
+    if None in rgb:
+        return None
+    if candidate.color_type == 3:
+        for i, entry in enumerate(entries):
+            if entry[:3] == rgb:
+                return bytes([i])
+        return None
+    if candidate.color_type in (0, 4):
+        return struct.pack("!H", rgb[0]) if rgb[0] == rgb[1] == rgb[2] \
+            else None
+    return struct.pack("!3H", *rgb)
+
+def adapt_sBIT(payload, image, candidate, entries):
+    channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}[image.color_type]
+    if len(payload) != channels:
+        return None
+    bits = list(payload)
+    if image.color_type in (0, 4):
+        bits[:1] = bits[:1] * 3
+    if len(bits) == 3:
+        bits.append(8 if image.color_type == 3 else image.bit_depth)
+    depth = 8 if candidate.color_type == 3 else candidate.bit_depth
+    bits = [min(b, depth) for b in bits]
+    if candidate.color_type in (0, 4):
+        bits[:3] = [max(bits[:3])]
+    if candidate.color_type in (0, 2, 3):
+        bits = bits[:-1]
+    return bytes(bits)
+
+def adapt_hIST(payload, image, candidate, entries):
+    if image.color_type != 3 or candidate.color_type != 3:
+        return None
+    old_entries = rgba_palette(image.palette, image.transparency)
+    if len(payload) != 2 * len(old_entries):
+        return None
+    frequencies = {}
+    for entry, (frequency,) in zip(old_entries,
+                                   struct.iter_unpack("!H", payload)):
+        frequencies[entry] = frequencies.get(entry, 0) + frequency
+    return b"".join(struct.pack("!H", min(frequencies.get(entry, 0),
+                                          2**16 - 1))
+                    for entry in entries)
+
+ADAPTERS = {"bKGD": adapt_bKGD, "sBIT": adapt_sBIT, "hIST": adapt_hIST}
+
+def adapt_chunks(chunks, image, candidate):
+    """
+    Return the list of (chunk_type, payload) chunks for the optimized image
+    encoding candidate. Color dependent chunks are kept unchanged if the
+    candidate has the color type, bit depth and palette of image, and are
+    otherwise rewritten for the candidate, or dropped if they cannot be.
+    """
+    entries = rgba_palette(candidate.palette, candidate.transparency)
+    if (candidate.color_type == image.color_type and
+            candidate.bit_depth == image.bit_depth and
+            (image.color_type != 3 or entries ==
+             rgba_palette(image.palette, image.transparency))):
+        return list(chunks)
+    result = []
+    for chunk_type, payload in chunks:
+        if chunk_type in ADAPTERS:
+            payload = ADAPTERS[chunk_type](payload, image, candidate,
+                                           entries)
+            if payload is None:
+                continue
+        result.append((chunk_type, payload))
+    return result
+
+##############################################################################
+# Pixel analysis                                                             #
+##############################################################################
+
+# A candidate encoding of the image. rows is a list of packed rows, and
+# palette and transparency are the PLTE value and tRNS payload (or None).
+Candidate = namedtuple("Candidate", ["color_type", "bit_depth", "rows",
+                                     "palette", "transparency"])
+
+def rgba_rows(image):
+    """
+    Return the sample depth (8 or 16) of the image and its pixels as a list
+    of rows of (red, green, blue, alpha) tuples at that depth. Palette and
+    low bit depth greyscale images are expanded to 8 bits.
+    """
+    depth = 16 if image.bit_depth == 16 else 8
+    top = 2**depth - 1
+    scale = top // (2**image.bit_depth - 1) if image.color_type == 0 else 1
+    trns = image.transparency
+    if image.color_type == 2 and trns is not None:
+        trns = tuple(trns[0])
+    alphas = list(trns) if image.color_type == 3 and trns else []
+    palette = [tuple(entry) + (alphas[i] if i < len(alphas) else 255,)
+               for i, entry in enumerate(image.palette or [])]
+    out = []
+    for row in image.rows:
+        if image.color_type == 0:
+            pixels = [(v * scale,) * 3 + (0 if v == trns else top,)
+                      for v in row]
+        elif image.color_type == 2:
+            pixels = [tuple(row[i:i + 3]) +
+                      (0 if tuple(row[i:i + 3]) == trns else top,)
+                      for i in range(0, len(row), 3)]
+        elif image.color_type == 3:
+            pixels = [palette[v] if v < len(palette) else (0, 0, 0, 255)
+                      for v in row]
+        elif image.color_type == 4:
+            pixels = [(row[i],) * 3 + (row[i + 1],)
+                      for i in range(0, len(row), 2)]
+        else:
+            pixels = [tuple(row[i:i + 4]) for i in range(0, len(row), 4)]
+        out.append(pixels)
+    return depth, out
+
+def numpy_rgba(image):
+    """
+    Return the sample depth (8 or 16) of the image and its pixels as an
+    array of shape (height, width, 4), as rgba_rows does for lists.
+    """
+    depth = 16 if image.bit_depth == 16 else 8
+    top = 2**depth - 1
+    dtype = numpy.uint16 if depth == 16 else numpy.uint8
+    samples = image.samples
+    if samples is None:
+        samples = numpy.array(image.rows, dtype=dtype).reshape(
+            image.height, image.width * image.channels)
+    samples = samples.reshape(image.height, image.width, image.channels)
+    trns = image.transparency
+    out = numpy.empty((image.height, image.width, 4), dtype=dtype)
+    if image.color_type == 0:
+        grey = samples[..., 0]
+        out[..., :3] = (grey * (top // (2**image.bit_depth - 1)))[..., None]
+        out[..., 3] = numpy.where(grey == trns, 0, top) \
+            if trns is not None else top
+    elif image.color_type == 2:
+        out[..., :3] = samples
+        out[..., 3] = top
+        if trns is not None:
+            out[..., 3][(samples == trns[0]).all(axis=2)] = 0
+    elif image.color_type == 3:
+        # indexes beyond the palette are opaque black, as in rgba_rows
+        lut = numpy.zeros((256, 4), dtype=numpy.uint8)
+        lut[:, 3] = 255
+        for i, entry in enumerate(rgba_palette(image.palette or [], trns)):
+            lut[i] = entry
+        out[...] = lut[samples[..., 0]]
+    elif image.color_type == 4:
+        out[..., :3] = samples[..., :1]
+        out[..., 3] = samples[..., 1]
+    else:
+        out[...] = samples
+    return depth, out
+
+def numpy_pack(samples, bit_depth):
+    """
+    Return a list of the bytes of each row of the 2-D array of samples,
+    packed at the given bit depth as pack_samples does.
+    """
+    if bit_depth == 16:
+        return [row.tobytes() for row in samples.astype(">u2")]
+    samples = samples.astype(numpy.uint8)
+    if bit_depth < 8:
+        per_byte = 8 // bit_depth
+        height, width = samples.shape
+        padded = numpy.zeros((height, -(-width // per_byte) * per_byte),
+                             dtype=numpy.uint8)
+        padded[:, :width] = samples
+        padded = padded.reshape(height, -1, per_byte)
+        samples = numpy.zeros(padded.shape[:2], dtype=numpy.uint8)
+        for i in range(per_byte):
+            samples |= padded[..., i] << (bit_depth * (per_byte - 1 - i))
+    return [row.tobytes() for row in samples]
+
+def numpy_candidates(image):
+    """
+    Return the same list of Candidate encodings as candidates, working on
+    the whole image with array operations.
+    """
+    depth, pixels = numpy_rgba(image)
+    if depth == 16 and not (pixels % 257).any():
+        depth = 8
+        pixels = (pixels // 257).astype(numpy.uint8)
+    top = 2**depth - 1
+    height, width = pixels.shape[:2]
+    grey = bool(((pixels[..., 0] == pixels[..., 1]) &
+                 (pixels[..., 1] == pixels[..., 2])).all())
+    opaque = bool((pixels[..., 3] == top).all())
+    channels = 3 if opaque else 4
+    result = [Candidate(2 if opaque else 6, depth,
+        numpy_pack(pixels[..., :channels].reshape(height, -1), depth),
+        None, None)]
+    if grey:
+        bit_depth = depth
+        if opaque and depth == 8:
+            bit_depth = low_bit_depth(numpy.unique(pixels[..., 0]).tolist())
+        if opaque:
+            samples = pixels[..., 0] >> (depth - bit_depth)
+        else:
+            samples = pixels[..., [0, 3]].reshape(height, -1)
+        result.append(Candidate(0 if opaque else 4, bit_depth,
+            numpy_pack(samples, bit_depth), None, None))
+    if depth == 8:
+        codes = pixels.astype(numpy.uint32)
+        codes = (codes[..., 0] << 24 | codes[..., 1] << 16 |
+                 codes[..., 2] << 8 | codes[..., 3])
+        colors, index = numpy.unique(codes, return_inverse=True)
+        if len(colors) <= 256:
+            # entries with transparency first, so that tRNS is short; the
+            # codes sort in the same order as the (r, g, b, a) tuples
+            order = numpy.lexsort((colors, (colors & 0xff) == 255))
+            rank = numpy.empty(len(colors), dtype=numpy.uint8)
+            rank[order] = numpy.arange(len(colors))
+            entries = [((c >> 24) & 0xff, (c >> 16) & 0xff, (c >> 8) & 0xff,
+                        c & 0xff) for c in colors[order].tolist()]
+            alphas = bytes(p[3] for p in entries if p[3] != 255)
+            bit_depth = palette_bit_depth(len(entries))
+            result.append(Candidate(3, bit_depth,
+                numpy_pack(rank[index.reshape(height, width)], bit_depth),
+                [p[:3] for p in entries], alphas if alphas else None))
+    return result
+
+def low_bit_depth(values):
+    """
+    Return the smallest bit depth at which all of the 8 bit greyscale
+    values can be represented exactly.
+    """
+    for bit_depth in (1, 2, 4):
+        step = 255 // (2**bit_depth - 1)
+        if all(v % step == 0 for v in values):
+            return bit_depth
+    return 8
+
+def palette_bit_depth(entries):
+    for bit_depth in (1, 2, 4, 8):
+        if entries <= 2**bit_depth:
+            return bit_depth
+
+def candidates(image):
+    """
+    Return a list of the lossless Candidate encodings of image: truecolor,
+    greyscale if the image has no color, and palette if it has no more
+    than 256 colors. Alpha is dropped if every pixel is opaque, and 16 bit
+    samples are reduced to 8 bits where no precision is lost. The image is
+    analysed with NumPy (see numpy_candidates) when it is available.
+    """
+    if numpy is not None:
+        return numpy_candidates(image)
+    depth, rows = rgba_rows(image)
+    if depth == 16 and all(v % 257 == 0 for row in rows
+                           for pixel in row for v in pixel):
+        depth = 8
+        rows = [[tuple(v // 257 for v in pixel) for pixel in row]
+                for row in rows]
+    top = 2**depth - 1
+    grey = all(p[0] == p[1] == p[2] for row in rows for p in row)
+    opaque = all(p[3] == top for row in rows for p in row)
+    channels = 3 if opaque else 4
+    result = [Candidate(2 if opaque else 6, depth,
+        [pack_samples([v for p in row for v in p[:channels]], depth)
+         for row in rows], None, None)]
+    if grey:
+        bit_depth = depth
+        if opaque and depth == 8:
+            bit_depth = low_bit_depth(set(p[0] for row in rows for p in row))
+        shift = depth - bit_depth
+        if opaque:
+            samples = [[p[0] >> shift for p in row] for row in rows]
+        else:
+            samples = [[v for p in row for v in (p[0], p[3])] for row in rows]
+        result.append(Candidate(0 if opaque else 4, bit_depth,
+            [pack_samples(row, bit_depth) for row in samples], None, None))
+    if depth == 8:
+        colors = set()
+        for row in rows:
+            colors.update(row)
+            if len(colors) > 256:
+                break
+        else:
+            # entries with transparency first, so that tRNS is short
+            entries = sorted(colors, key=lambda p: (p[3] == 255, p))
+            index = {p: i for i, p in enumerate(entries)}
+            alphas = bytes(p[3] for p in entries if p[3] != 255)
+            bit_depth = palette_bit_depth(len(entries))
+            result.append(Candidate(3, bit_depth,
+                [pack_samples([index[p] for p in row], bit_depth)
+                 for row in rows],
+                [p[:3] for p in entries], alphas if alphas else None))
+    return result
+
+##############################################################################
+# Trial compression                                                          #
+##############################################################################
+
+def encode_candidate(candidate, width, height, chunks, filter_type, level,
+                     strategy):
+    """
+    Return the bytes of the PNG image encoding candidate with the given
+    filter strategy and zlib level and strategy.
+    """
+    chunks = list(chunks)
+    if candidate.transparency is not None:
+        chunks.append(("tRNS", candidate.transparency))
+    fp = io.BytesIO()
+    encoder = PNGEncoder(fp, width, height, candidate.bit_depth,
+                         candidate.color_type, palette=candidate.palette,
+                         chunks=chunks, filter_type=filter_type,
+                         level=level, strategy=strategy)
+    encoder.write_rows(candidate.rows)
+    encoder.close()
+    return fp.getvalue()
+
+def optimize(path, out=None, strip=False, filters=(0, 1, 2, 3, 4, "adaptive"),
+             zlib_settings=((9, zlib.Z_DEFAULT_STRATEGY),
+                            (9, zlib.Z_FILTERED)),
+             workers=None, processes=False, keep_unsafe=False):
+    """
+    Losslessly recompress the PNG file at path, writing the result to out
+    (by default path itself). Each candidate encoding of the pixels (see
+    candidates) is compressed with every filter strategy in filters (see
+    PNGEncoder) and every (level, strategy) pair in zlib_settings, in a
+    pool of workers threads (or processes if processes is True), and the
+    smallest output is kept. Ancillary chunks are copied as described by
+    ancillary_chunks (given strip and keep_unsafe) and adapt_chunks.
+    Interlaced images are written without interlacing. If no trial is
+    smaller than the original, the original is kept. Return a tuple of the
+    original and optimized sizes.
+    """
+    out = out if out else path
+    root = Node("root", None)
+    source = FileSource(path)
+    try:
+        png.PNG.construct(source, root)
+    finally:
+        source.f.close()
+    image = read_image(root)
+    chunks = ancillary_chunks(root, strip, keep_unsafe)
+    original_size = os.path.getsize(path)
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    best = None
+    with pool(workers) as executor:
+        trials = [executor.submit(encode_candidate, candidate, image.width,
+                                  image.height,
+                                  adapt_chunks(chunks, image, candidate),
+                                  filter_type, level, strategy)
+                  for candidate in candidates(image)
+                  for filter_type in filters
+                  for level, strategy in zlib_settings]
+        for trial in trials:
+            data = trial.result()
+            if best is None or len(data) < len(best):
+                best = data
+    if len(best) < original_size:
+        with open(out, "wb") as f:
+            f.write(best)
+        return (original_size, len(best))
+    if out != path:
+        shutil.copyfile(path, out)
+    return (original_size, original_size)
+
+def main():
+    import sys
+    for fn in sys.argv[1:]:
+        before, after = optimize(fn)
+        print("{}: {} -> {} bytes".format(fn, before, after))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import dis
+
 DEBUG = False 
 
 class Path(object):
@@ -10,14 +12,24 @@ class Path(object):
         self.__call = call
         self.__args = args if args else []
         self.__kwargs = kwargs if kwargs else {}
+        self.__compiled = None
 
     def resolve_path(self, obj, node=None):
+        if node is None and not DEBUG:
+            # resolve with the compiled form of the path (see compile_path),
+            # which is created the first time the path is resolved
+            if self.__compiled is None:
+                self.__compiled = compile_path(self)
+            return self.__compiled(obj)
+        return self.__resolve(obj, node)
+
+    def __resolve(self, obj, node=None):
         if DEBUG:
             print("resolve path", str(self))
         if node is None:
             node = obj
         if self.__parent is not None:
-            obj = self.__parent.resolve_path(obj, node)
+            obj = self.__parent.__resolve(obj, node)
             if self.__call:
                 args = []
                 for arg in self.__args:
@@ -253,3 +265,193 @@ def test():
 
 if __name__ == "__main__":
     test()
+
+# first steps of a Path that give the same result from a node and from its
+# parent
+PARENT_INVARIANT = ("root", "context")
+
+def rebase_path(path):
+    """
+    Return a Path that gives the same result when resolved against the
+    parent of a node as path does when resolved against the node itself.
+    This is possible for paths starting with .parent, .root or .context
+    whose arguments are constants or also possible to rebase. Raise
+    ValueError for any other path.
+    """
+    steps = []
+    while path._Path__parent is not None:
+        steps.append(path)
+        path = path._Path__parent
+    steps.reverse()
+    if not steps or steps[0]._Path__call:
+        raise ValueError("Cannot rebase {}".format(path))
+    if steps[0]._Path__name == "parent":
+        steps = steps[1:]
+    elif steps[0]._Path__name not in PARENT_INVARIANT:
+        raise ValueError("Cannot rebase {}".format(steps[-1]))
+    rebased = Path()
+    for step in steps:
+        args = [rebase_path(arg) if isinstance(arg, Path) else arg
+                for arg in step._Path__args]
+        kwargs = {k: rebase_path(v) if isinstance(v, Path) else v
+                  for k, v in step._Path__kwargs.items()}
+        rebased = Path(rebased, step._Path__name, step._Path__call, args,
+                       kwargs)
+    return rebased
+
+##############################################################################
+# Path compilation                                                           #
+##############################################################################
+
+# Criteria shapes recognised as name tests. A criterion may declare that it
+# only tests node names by having a names attribute (a set of the names it
+# matches); otherwise lambdas of the form "lambda n: n._name == 'X'" and
+# "lambda n: n._name in ('X', 'Y')" are recognised from their bytecode.
+IGNORED_OPCODES = ("RESUME", "NOP", "CACHE", "PRECALL")
+
+def criterion_names(criterion):
+    """
+    Return the set of names matched by criterion if it only tests the
+    name of a node, otherwise None.
+    """
+    names = getattr(criterion, "names", None)
+    if names is not None:
+        return frozenset(names)
+    code = getattr(criterion, "__code__", None)
+    if (code is None or code.co_argcount != 1 or criterion.__closure__ or
+            code.co_names != ("_name",)):
+        return None
+    ops = [(i.opname, i.argval) for i in dis.get_instructions(code)
+           if i.opname not in IGNORED_OPCODES]
+    if (len(ops) != 5 or not ops[0][0].startswith("LOAD_FAST") or
+            ops[0][1] != code.co_varnames[0] or
+            ops[1] != ("LOAD_ATTR", "_name") or ops[2][0] != "LOAD_CONST" or
+            ops[4][0] != "RETURN_VALUE"):
+        return None
+    const = ops[2][1]
+    if (ops[3][0] == "COMPARE_OP" and "==" in str(ops[3][1]) and
+            isinstance(const, str)):
+        return frozenset([const])
+    if (ops[3] == ("CONTAINS_OP", 0) and isinstance(const, tuple) and
+            all(isinstance(name, str) for name in const)):
+        return frozenset(const)
+    return None
+
+def criteria_names(criteria):
+    """
+    Return the set of names matched by a list of criteria (all of which
+    must match) if they only test node names, otherwise None.
+    """
+    if not isinstance(criteria, (list, tuple)) or not criteria:
+        return None
+    names = None
+    for criterion in criteria:
+        matched = criterion_names(criterion)
+        if matched is None:
+            return None
+        names = matched if names is None else names & matched
+    return names
+
+def path_steps(path):
+    """
+    Return a list of (name, call, args, kwargs) tuples for the steps of
+    path, starting from the node it is resolved against.
+    """
+    steps = []
+    while path._Path__parent is not None:
+        steps.append((path._Path__name, path._Path__call, path._Path__args,
+                      path._Path__kwargs))
+        path = path._Path__parent
+    steps.reverse()
+    return steps
+
+def _step_op(name, call, args, kwargs):
+    """
+    Return a function (obj, node) -> value performing one step of a path.
+    """
+    if not call:
+        return lambda obj, node: getattr(obj, name)
+    def op(obj, node):
+        a = [arg.resolve_path(node) if isinstance(arg, Path) else arg
+             for arg in args]
+        k = {key: v.resolve_path(node) if isinstance(v, Path) else v
+             for key, v in kwargs.items()}
+        if name:
+            return getattr(obj, name)(*a, **k)
+        return obj(*a, **k)
+    return op
+
+def _index_op(kind, names, fallback):
+    """
+    Return a function (obj, node) -> value giving the result of
+    obj.root.count_descendents(criteria) (kind "count"),
+    obj.root.descendents(criteria) (kind "descendents") or
+    obj.root.descendents(criteria)[0] (kind "first") where criteria match
+    the given names, answered from the name index of the ParseContext
+    where it covers the whole tree. Otherwise the fallback ops are used.
+    """
+    def op(obj, node):
+        context = getattr(obj, "_context", None)
+        root = obj.root if context is not None else None
+        if context is not None and context.covers(root):
+            # descendents do not include the root itself
+            count = context.count_named(names)
+            if root is context.top and root._name in names:
+                count -= 1
+            if kind == "count":
+                return count
+            if count == 0:
+                if kind == "first":
+                    raise IndexError("list index out of range")
+                return []
+            if kind == "first" and root._name not in names:
+                first = context.first_named(names)
+                if first is not None:
+                    return first
+        for fallback_op in fallback:
+            obj = fallback_op(obj, node)
+        return obj
+    return op
+
+def compile_path(path):
+    """
+    Return a function which takes a node and returns the result of
+    resolving path against it. The steps of the path are performed in a
+    loop rather than by recursion, and tree scans of the forms
+    root.count_descendents(criteria), root.descendents(criteria) and
+    root.descendents(criteria)[0] whose criteria only test node names (see
+    criteria_names) are rewritten as lookups in the name index of the
+    node's ParseContext.
+    """
+    steps = path_steps(path)
+    ops = []
+    i = 0
+    while i < len(steps):
+        name, call, args, kwargs = steps[i]
+        shape = steps[i + 1:i + 3]
+        if (name == "root" and not call and len(shape) == 2 and
+                shape[0][0] in ("descendents", "count_descendents") and
+                not shape[0][1] and shape[1][0] is None and shape[1][1] and
+                len(shape[1][2]) == 1 and not shape[1][3] and
+                criteria_names(shape[1][2][0]) is not None):
+            names = criteria_names(shape[1][2][0])
+            used = steps[i:i + 3]
+            if shape[0][0] == "count_descendents":
+                kind = "count"
+            elif steps[i + 3:i + 4] == [("__getitem__", True, [0], {})]:
+                kind = "first"
+                used = steps[i:i + 4]
+            else:
+                kind = "descendents"
+            ops.append(_index_op(kind, names,
+                                 [_step_op(*step) for step in used]))
+            i += len(used)
+            continue
+        ops.append(_step_op(name, call, args, kwargs))
+        i += 1
+    def resolve(node):
+        obj = node
+        for op in ops:
+            obj = op(obj, node)
+        return obj
+    return resolve
@@ -5,7 +5,10 @@ from definition import *
 from validation import *
 from attribute import *
 from path import Path
+from node import Name, NameIn
 from source import FileSource
+from context import ParseContext
+import array
 import zlib
 
 ##############################################################################
@@ -29,6 +32,50 @@ def decompress(node, value):
 # Payloads                                                                   #
 ##############################################################################
 
+class PNGContext(ParseContext):
+    """
+    ParseContext for a PNG, caching the values of the IHDR fields (in the
+    ihdr dictionary, or None until the IHDR chunk has been read) and the
+    number of entries in the palette (0 until the PLTE chunk has been
+    read), which the tRNS and hIST rules check their lengths against.
+
+    If the "compact_sPLT" option is true, the palette entries of sPLT chunks
+    are parsed into a single sPLT_entry node holding a structured array
+    rather than into a palette node per entry, e.g.
+        root.context = PNGContext({"compact_sPLT": True})
+
+    If the "integer_arrays" option is true, the values of PLTE, hIST and
+    (other than for greyscale images) tRNS payloads are arrays rather than
+    tuples (see the as_array argument of IntegerSequenceDef).
+    """
+    def reset(self):
+        super().reset()
+        self.ihdr = None
+        self.palette_length = 0
+
+    @property
+    def color_type(self):
+        return self.ihdr.get("color_type") if self.ihdr else None
+
+    @property
+    def compact_sPLT(self):
+        return bool(self.options.get("compact_sPLT"))
+
+    @property
+    def integer_arrays(self):
+        return bool(self.options.get("integer_arrays"))
+
+    def node_ended(self, node):
+        name = node._name
+        if name == "IHDR_payload":
+            self.ihdr = {child._name: child.attributes.get("value")
+                         for child in node._children}
+        elif name == "PLTE_payload":
+            value = node.attributes.get("value", ())
+            # a flat array.array holds the three samples of each entry
+            self.palette_length = len(value) // 3 if isinstance(
+                value, array.array) else len(value)
+
 PNGPayloads = DelegatingDef({}, Path().parent.chunk_type.value + "_payload")
 
 # An unknown chunk payload is treated as a bytestring, using the length given
@@ -82,14 +129,12 @@ PNGPayloads.register(
         validation = [
             Validation(
                 Path().root.count_descendents(
-                    [lambda n: n._name == 'IHDR_payload']),
+                    [Name("IHDR_payload")]),
                 "==", 1, stage="pre",
                 error=ValidationError,
                 description="IHDR chunk can only appear once"),
             Validation(
-                Path().root.descendents([
-                    lambda node: node._name == "chunks"
-                ])[0].children.index(Path().parent), "==", 0,
+                Path().root.count_descendents([Name("chunk")]), "==", 1,
                 description="IHDR chunk must be the first chunk")
         ]
     )
@@ -100,23 +145,23 @@ PNGPayloads.register(
 PNGPayloads.register(
     IntegerSequenceDef("PLTE_payload", "!B",
         Path().siblings[0].attributes["value"] // 3, 3,
+        as_array=Path().context.integer_arrays,
         validation=[
             Validation(Path().parent.children[0].value % 3, "==", 0,
                     description="PLTE length must be divisible by 3"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda n: n._name == "PLTE_payload"]),
+                    [Name("PLTE_payload")]),
                     "==", 1, stage="pre", error=ValidationError,
                     description="PLTE chunk can only appear once"),
             Validation(
-                Path().root.descendents([
-                    lambda n: n._name == "IDAT_payload"]), "==", [],
+                Path().root.count_descendents(
+                    [Name("IDAT_payload")]), "==", 0,
                     description="PLTE chunk must appear before first IDAT " +
                                 "chunk"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name in
-                    ("bKGD_payload", "hIST_payload", "tRNS_payload")]
+                    [NameIn("bKGD_payload", "hIST_payload", "tRNS_payload")]
                 ), "==", 0,
                 description="PLTE chunk must appear before bKGD, hIST and " +
                             "tRNS chunks")
@@ -131,7 +176,7 @@ PNGPayloads.register(
         validation = [
             Validation(
                 Path().root.count_descendents([
-                    lambda node: node._name == "IDAT_payload"
+                    Name("IDAT_payload")
                 ]), "==", 1) |
             Validation(
                 Path().parent.parent.children[-2].attributes["type"],
@@ -156,22 +201,31 @@ PNGPayloads.register(
 PNGPayloads.register(
     DelegatingDef({
             0:  IntegerDef("tRNS_payload", "!H"),
-            2:  IntegerSequenceDef("tRNS_payload", "!H", 1, 3),
+            2:  IntegerSequenceDef("tRNS_payload", "!H", 1, 3,
+                    as_array=Path().context.integer_arrays),
+            3:  IntegerSequenceDef("tRNS_payload", "!B",
+                    Path().siblings[0].value,
+                    as_array=Path().context.integer_arrays,
+                    validation=[
+                        Validation(Path().parent.children[0].value, "<=",
+                            Path().context.palette_length,
+                            error=ValidationError,
+                            description="tRNS chunk has more entries than " +
+                                        "the palette")
+                    ]),
             "default":  IntegerSequenceDef("tRNS_payload", "!B",
-                             Path().siblings[0].value)
+                             Path().siblings[0].value,
+                             as_array=Path().context.integer_arrays)
         },
-        Path().root.descendents(
-            [lambda node: node._name=="IHDR_payload"])[0].color_type.value,
+        Path().context.color_type,
         validation=[
-            Validation(
-                Path().root.descendents(
-                    [lambda node: node._name=="IHDR_payload"]), 
-                "!=", [], stage="pre", error=ValidationFatal,
+            Validation(Path().context.ihdr, "!=", None, stage="pre",
+                error=ValidationFatal,
                 description="tRNS chunk requires IHDR chunk"
             ),
             Validation(
                 Path().root.count_descendents(
-                    [lambda n: n._name == "tRNS_payload"]),
+                    [Name("tRNS_payload")]),
                     "==", 0, stage="pre", error=ValidationError,
                     description="tRNS chunk can only appear once"),
         ]
@@ -193,13 +247,12 @@ PNGPayloads.register(
         ],
         validation=[
             Validation(Path().root.count_descendents(
-                    [lambda n: n._name == 'cHRM_payload']),
+                    [Name("cHRM_payload")]),
                 "==", 1, stage="pre", error=ValidationError,
                 description="cHRM chunk can only appear once"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name in
-                    ("IDAT_payload", "PLTE_payload")]
+                    [NameIn("IDAT_payload", "PLTE_payload")]
                 ), "==", 0,
                 description="cHRM chunk must appear before PLTE and IDAT " +
                             "chunks")
@@ -213,13 +266,12 @@ PNGPayloads.register(
     IntegerDef("gAMA_payload", "!I",
         validation=[
             Validation(Path().root.count_descendents(
-                    [lambda n: n._name == 'gAMA_payload']),
+                    [Name("gAMA_payload")]),
                 "==", 1, stage="pre", error=ValidationError,
                 description="gAMA chunk can only appear once"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name in
-                    ("IDAT_payload", "PLTE_payload")]
+                    [NameIn("IDAT_payload", "PLTE_payload")]
                 ), "==", 0,
                 description="gAMA chunk must appear before PLTE and IDAT " +
                             "chunks"
@@ -245,19 +297,18 @@ PNGPayloads.register(
         ],
         validation=[
              Validation(Path().root.count_descendents(
-                    [lambda n: n._name == 'iCCP_payload']),
+                    [Name("iCCP_payload")]),
                 "==", 1, stage="pre", error=ValidationError,
                 description="iCCP chunk can only appear once"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name in
-                    ("IDAT_payload", "PLTE_payload")]
+                    [NameIn("IDAT_payload", "PLTE_payload")]
                 ), "==", 0,
                 description="iCCP chunk must appear before PLTE and IDAT " +
                             "chunks"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name == "sRGB_payload"]
+                    [Name("sRGB_payload")]
                 ), "==", 0, error=ValidationWarning,
                 description="iCCP chunk should not appear when sRGB chunk " +
                             "present"
@@ -290,20 +341,18 @@ PNGPayloads.register(
                 IntegerDef("significant_alpha_bits", "!B")
            ]),
         "default": BytestringDef("sBIT_payload", 
-                       Path().parent.siblings[0].attributes["value"]
+                       Path().siblings[0].attributes["value"]
                    )
         },
-        Path().root.descendents(
-            [lambda node: node._name=="IHDR_payload"])[0].color_type.value,
+        Path().context.color_type,
         validation = [
             Validation(Path().root.count_descendents(
-                    [lambda n: n._name == 'sBIT_payload']),
+                    [Name("sBIT_payload")]),
                 "==", 0, stage="pre", error=ValidationError,
                 description="sBIT chunk can only appear once"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name in
-                     ("IDAT_payload", "PLTE_payload")]
+                    [NameIn("IDAT_payload", "PLTE_payload")]
                 ), "==", 0,
                 description="sBIT chunk must appear before PLTE and " +
                             "IDAT chunks")
@@ -320,18 +369,18 @@ PNGPayloads.register(
             Validation("value", "in", (0,1,2,3),
                         description="Invalid sRGB value"),
             Validation(Path().root.count_descendents(
-                [lambda n: n._name == 'sRGB_payload']),
+                [Name("sRGB_payload")]),
                 "==", 1, stage="pre", error=ValidationError,
                 description="sRGB chunk can only appear once"),
             Validation(
                 Path().root.count_descendents(
-                [lambda node: node._name in ("IDAT_payload", "PLTE_payload")]
+                [NameIn("IDAT_payload", "PLTE_payload")]
                 ), "==", 0,
                 description="sRGB chunk must appear before PLTE and IDAT " +
                             "chunks"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name == "iCCP_payload"]
+                    [Name("iCCP_payload")]
                 ), "==", 0, error=ValidationWarning,
                 description="sRGB chunk should not appear when iCCP chunk " +
                             "present"
@@ -390,14 +439,15 @@ PNGPayloads.register(
                  Path().parent.language_tag.length +
                  Path().parent.translated_keyword.length + 2),
                 "utf-8"),
-            1: StringDef("text",
+            # compressed text is kept as bytes, and decompressed_text holds
+            # the UTF-8 bytes of the text, as for zTXt
+            1: BytestringDef("text",
                 Path().parent.parent.children[0].value -
                 (Path().parent.keyword.length +
                  Path().parent.language_tag.length +
                  Path().parent.translated_keyword.length + 2),
-                "utf-8",
                 attributes = [Attribute("decompressed_text", decompress,
-                                        Path().value)
+                                        [Path().value])
                 ]),
             "default": 0
             },
@@ -423,20 +473,18 @@ PNGPayloads.register(
                          Path().siblings[0].attributes["value"]
                    )
         },
-        Path().root.descendents(
-            [lambda node: node._name=="IHDR_payload"])[0].color_type.value,
+        Path().context.color_type,
         validation = [
-            Validation(Path().root.descendents(
-                [lambda node: node._name=="IHDR_payload"]),
-                "not in", [[],()], stage="pre", error=ValidationFatal,
+            Validation(Path().context.ihdr, "!=", None, stage="pre",
+                error=ValidationFatal,
                 description="bKDG chunk requires IHDR chunk"),
             Validation(Path().root.count_descendents(
-                [lambda n: n._name == 'bKGD_payload']),
+                [Name("bKGD_payload")]),
                 "==", 0, stage="pre", error=ValidationError,
                 description="bKGD chunk can only appear once"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name == ("IDAT_payload")]
+                    [Name("IDAT_payload")]
                 ), "==", 0,
                 description="bKGD chunk must appear before IDAT chunks")
         ]
@@ -448,14 +496,19 @@ PNGPayloads.register(
 # http://www.w3.org/TR/PNG/#11hIST
 PNGPayloads.register(
     IntegerSequenceDef("hIST_payload", "!H", Path().siblings[0].value // 2,
+    as_array=Path().context.integer_arrays,
     validation = [
         Validation(Path().root.count_descendents(
-            [lambda n: n._name == 'hIST_payload']),
+            [Name("hIST_payload")]),
             "==", 1, stage="pre", error=ValidationError,
             description="hIST chunk can only appear once"),
+        Validation(Path().parent.children[0].value // 2, "==",
+            Path().context.palette_length, error=ValidationError,
+            description="hIST chunk must have an entry for each palette " +
+                        "entry"),
         Validation(
             Path().root.count_descendents(
-                [lambda node: node._name == ("IDAT_payload")]
+                [Name("IDAT_payload")]
             ), "==", 0,
             description="hIST chunk must appear before IDAT chunks")
         ]
@@ -474,12 +527,12 @@ PNGPayloads.register(
         ],
         validation = [
             Validation(Path().root.count_descendents(
-                [lambda n: n._name == 'pHYs_payload']),
+                [Name("pHYs_payload")]),
                 "==", 1, stage="pre", error=ValidationError,
                 description="pHYs chunk can only appear once"),
             Validation(
                 Path().root.count_descendents(
-                    [lambda node: node._name == ("IDAT_payload")]
+                    [Name("IDAT_payload")]
                 ), "==", 0,
                 description="pHYs chunk must appear before IDAT chunks")
         ]
@@ -488,8 +541,15 @@ PNGPayloads.register(
 
 # sPLT - Suggested palette
 # http://www.w3.org/TR/PNG/#11sPLT
-PNGPayloads.register(
-    DefinedChildrenDef("sPLT_payload", [
+sPLT_validation = [
+    Validation(
+        Path().root.count_descendents(
+            [Name("IDAT_payload")]
+        ), "==", 0,
+        description="sPLT chunk must appear before IDAT chunks")
+]
+
+sPLT_payload = DefinedChildrenDef("sPLT_payload", [
         NullTerminatedStringDef("palette_name", "latin1"),
         IntegerDef("sample_depth", "!B"),
         NodeSequenceDef("sPLT_entry",
@@ -516,14 +576,52 @@ PNGPayloads.register(
                 (Path().parent.palette_name.length + 1)) //
                 (((Path().parent.sample_depth.value // 8) * 4) + 2))
         )],
-        validation = [
-            Validation(
-                Path().root.count_descendents(
-                    [lambda node: node._name == ("IDAT_payload")]
-                ), "==", 0,
-                description="sPLT chunk must appear before IDAT chunks")
-        ]
+        validation = list(sPLT_validation)
+    )
+
+# Compact form of sPLT, in which the palette entries are decoded into a
+# single node holding a structured array rather than a node per entry
+sPLT_compact_payload = DefinedChildrenDef("sPLT_payload", [
+        NullTerminatedStringDef("palette_name", "latin1"),
+        IntegerDef("sample_depth", "!B"),
+        DelegatingDef({
+            1: 8,
+            2: 8,
+            4: 8,
+            8: RecordSequenceDef("sPLT_entry", [
+                    ("red", "!B"),
+                    ("green", "!B"),
+                    ("blue", "!B"),
+                    ("alpha", "!B"),
+                    ("frequency", "!H")
+                ], ((Path().parent.parent.children[0].value -
+                    (Path().parent.palette_name.length + 1)) //
+                    (((Path().parent.sample_depth.value // 8) * 4) + 2))
+               ),
+            16: RecordSequenceDef("sPLT_entry", [
+                    ("red", "!H"),
+                    ("green", "!H"),
+                    ("blue", "!H"),
+                    ("alpha", "!H"),
+                    ("frequency", "!H")
+                ], ((Path().parent.parent.children[0].value -
+                    (Path().parent.palette_name.length + 1)) //
+                    (((Path().parent.sample_depth.value // 8) * 4) + 2))
+               )
+            }, Path().parent.sample_depth.value
+        )],
+        validation = list(sPLT_validation)
     )
+
+# the form of sPLT is chosen for each parse by the "compact_sPLT" option (see
+# PNGContext)
+PNGPayloads.register(
+    DelegatingDef({
+            False: sPLT_payload,
+            True: sPLT_compact_payload
+        },
+        Path().context.compact_sPLT
+    ), "sPLT_payload"
 )
 
 # tIME - Image last modification time
@@ -553,7 +651,7 @@ PNGPayloads.register(
         )],
         validation = [
             Validation(Path().root.count_descendents(
-                    [lambda n: n._name == 'tIME_payload']),
+                    [Name("tIME_payload")]),
                     "==", 1, stage="pre", error=ValidationError,
                     description="tIME chunk can only appear once"
             )
@@ -567,6 +665,22 @@ PNGPayloads.register(
 ##############################################################################
 
 
+# chunks that later chunks refer to when they are validated
+RETAINED_CHUNKS = ("IHDR", "PLTE")
+
+def is_retained(node):
+    """
+    Return False if node is, or is part of, a chunk whose type is not in
+    RETAINED_CHUNKS, and True otherwise. Used as a retain criterion for a
+    treeless ConstructionHandler, this keeps the PNG and chunks nodes and
+    the retained chunks.
+    """
+    for chunk in node.gen_ancestors([Name("chunk")], True):
+        children = chunk._children
+        return (len(children) > 1 and
+                children[1].attributes.get("value") in RETAINED_CHUNKS)
+    return True
+
 # Chunk structure
 PNGChunk = DefinedChildrenDef("chunk", [
         IntegerDef("length", "!I",
@@ -608,6 +722,9 @@ PNG = DefinedChildrenDef("PNG", [
     ]
 )
 
+PNG.context_class = PNGContext
+PNGChunk.context_class = PNGContext
+
 def main():
     import sys, node
     for fn in sys.argv[1:]:
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from node import NameIn
+from collections import namedtuple
+import functools
+import itertools
+import re
+
+##############################################################################
+# Selector syntax                                                            #
+##############################################################################
+
+# A selector is a sequence of steps separated by "/", evaluated from a node:
+#     name        children of the current nodes with the given name
+#     *           all children of the current nodes
+#     //name      descendents of the current nodes with the given name
+#     ..  .       the parents of the current nodes, or the nodes themselves
+#     @attr       the value of an attribute (or metadata) of the current
+#                 nodes; this must be the last step
+# A leading "/" starts from the root of the tree. Name steps may be followed
+# by predicates in square brackets, which are applied in order:
+#     [key=value] [key!=value]  attribute (or metadata) comparisons, where
+#                 value may be quoted and is compared both as written and,
+#                 if it looks like an integer, as an integer
+#     [key]       the attribute (or metadata) is present
+#     [n]         the nth (from 0, negative from the end) remaining match
+#                 among the children or descendents of each current node
+# e.g. "chunks/chunk[type=tEXt]/tEXt_payload/keyword/@value"
+
+TOKEN_RE = re.compile(r"""
+    (?P<descendent>//) | (?P<separator>/) | (?P<parent>\.\.) | (?P<self>\.) |
+    (?P<attribute>@\w+) | (?P<name>\*|[A-Za-z_][\w.-]*) |
+    (?P<predicate>\[(?:[^\]'"]|"[^"]*"|'[^']*')*\]) | (?P<space>\s+)
+    """, re.VERBOSE)
+
+PREDICATE_RE = re.compile(r"""
+    ^\s*(?:(?P<index>-?\d+) |
+    (?P<key>\w+)\s*(?:(?P<op>!?=)\s*(?P<value>"[^"]*"|'[^']*'|[^\]]*?))?)\s*$
+    """, re.VERBOSE)
+
+# axis is one of "root", "child", "descendent", "parent", "self" and
+# "attribute"; names is a set of names (None for any name) or, for the
+# attribute axis, the attribute name; predicates is a list of functions
+# and integer positions
+Step = namedtuple("Step", ["axis", "names", "predicates"])
+
+MISSING = object()
+
+def lookup(node, key):
+    """
+    Return the attribute of node with the given key, or its metadata, or
+    MISSING.
+    """
+    value = node._attributes.get(key, MISSING)
+    if value is MISSING:
+        value = node._metadata.get(key, MISSING)
+    return value
+
+def compile_predicate(text, selector):
+    """
+    Return an integer position or a function node -> bool for the text of
+    a predicate (without the brackets).
+    """
+    match = PREDICATE_RE.match(text)
+    if not match:
+        raise ValueError("Invalid predicate [{}] in selector {!r}".format(
+            text, selector))
+    if match.group("index") is not None:
+        return int(match.group("index"))
+    key = match.group("key")
+    if match.group("op") is None:
+        return lambda node: lookup(node, key) is not MISSING
+    raw = match.group("value")
+    if raw[:1] in "'\"" and raw[:1] == raw[-1:] and len(raw) > 1:
+        raw = raw[1:-1]
+        values = (raw,)
+    elif re.match(r"^-?\d+$", raw):
+        values = (raw, int(raw))
+    else:
+        values = (raw,)
+    def equal(node):
+        value = lookup(node, key)
+        if value is MISSING:
+            return False
+        return value in values or str(value) == raw
+    if match.group("op") == "=":
+        return equal
+    return lambda node: not equal(node)
+
+def parse_selector(selector):
+    """
+    Return the list of Steps of selector, raising ValueError if it is not
+    valid.
+    """
+    steps = []
+    axis = "child"
+    expect_step = True
+    pos = 0
+    if selector.startswith("/") and not selector.startswith("//"):
+        steps.append(Step("root", None, []))
+        pos = 1
+    while pos < len(selector):
+        match = TOKEN_RE.match(selector, pos)
+        if not match:
+            raise ValueError("Invalid selector {!r} at position {}".format(
+                selector, pos))
+        kind, text = match.lastgroup, match.group()
+        pos = match.end()
+        if kind == "space":
+            continue
+        if kind in ("separator", "descendent"):
+            if expect_step and (kind == "separator" or steps):
+                raise ValueError("Empty step in selector {!r}".format(
+                    selector))
+            axis = "child" if kind == "separator" else "descendent"
+            expect_step = True
+            continue
+        if kind == "predicate":
+            if expect_step or steps[-1].axis not in ("child", "descendent"):
+                raise ValueError("Misplaced predicate in selector {!r}".format(
+                    selector))
+            steps[-1].predicates.append(
+                compile_predicate(text[1:-1], selector))
+            continue
+        if not expect_step:
+            raise ValueError("Missing / before {!r} in selector {!r}".format(
+                text, selector))
+        if steps and steps[-1].axis == "attribute":
+            raise ValueError("Attribute step must be last in selector " +
+                             "{!r}".format(selector))
+        if kind in ("parent", "self"):
+            if axis == "descendent":
+                raise ValueError("Invalid selector {!r}".format(selector))
+            steps.append(Step(kind, None, []))
+        elif kind == "attribute":
+            steps.append(Step("attribute", text[1:], []))
+        else:
+            steps.append(Step(axis, None if text == "*" else
+                              frozenset([text]), []))
+        expect_step = False
+    if expect_step and (steps or axis == "descendent"):
+        raise ValueError("Selector {!r} ends with /".format(selector))
+    return steps
+
+##############################################################################
+# Evaluation                                                                 #
+##############################################################################
+
+def gen_children(node, names):
+    for child in node._children:
+        if names is None or child._name in names:
+            yield child
+
+def gen_descendents(node, names):
+    """
+    Yield the descendents of node with one of the given names (any name if
+    names is None) in document order, using the name index where possible
+    (see Node.gen_descendents).
+    """
+    return node.gen_descendents([NameIn(*names)] if names is not None
+                                else None)
+
+def apply_predicates(nodes, predicates):
+    for predicate in predicates:
+        if isinstance(predicate, int):
+            if predicate >= 0:
+                nodes = itertools.islice(nodes, predicate, predicate + 1)
+            else:
+                nodes = list(nodes)[predicate:][:1]
+        else:
+            nodes = filter(predicate, nodes)
+    return nodes
+
+def step_op(step):
+    """
+    Return a function mapping an iterable of nodes to an iterable of the
+    results of step.
+    """
+    axis, names, predicates = step
+    if axis == "root":
+        return lambda nodes: (node.root for node in nodes)
+    if axis == "self":
+        return lambda nodes: nodes
+    if axis == "parent":
+        return lambda nodes: (node._parent for node in nodes
+                              if node._parent is not None)
+    if axis == "attribute":
+        return lambda nodes: (value for value in
+                              (lookup(node, names) for node in nodes)
+                              if value is not MISSING)
+    candidates = gen_children if axis == "child" else gen_descendents
+    def op(nodes):
+        seen = set()
+        for node in nodes:
+            for match in apply_predicates(candidates(node, names),
+                                          predicates):
+                if axis == "descendent":
+                    # overlapping subtrees would otherwise repeat nodes
+                    if id(match) in seen:
+                        continue
+                    seen.add(id(match))
+                yield match
+    return op
+
+class Selector(object):
+    """
+    A compiled selector (see the syntax above). select yields the matching
+    nodes (or attribute values) for a node lazily, so that taking the first
+    result does not evaluate the rest.
+    """
+    def __init__(self, selector):
+        self.selector = selector
+        self.steps = parse_selector(selector)
+        self.ops = [step_op(step) for step in self.steps]
+
+    def __repr__(self):
+        return "Selector({!r})".format(self.selector)
+
+    def select(self, node):
+        results = iter([node])
+        for op in self.ops:
+            results = op(results)
+        return results
+
+    def first(self, node, default=None):
+        return next(self.select(node), default)
+
+@functools.lru_cache(maxsize=256)
+def compile_selector(selector):
+    """
+    Return the compiled Selector for the selector string, which is cached
+    so that repeated queries reuse the same plan.
+    """
+    return Selector(selector)
+
+def select(node, selector):
+    """
+    Return a list of the nodes (or attribute values) selected by selector
+    from node.
+    """
+    return list(compile_selector(selector).select(node))
+
+def select_first(node, selector, default=None):
+    """
+    Return the first node (or attribute value) selected by selector from
+    node, or default. Evaluation stops at the first match.
+    """
+    return compile_selector(selector).first(node, default)
+
+def select_many(roots, selector):
+    """
+    Return a list containing, for each node in roots, the list of nodes (or
+    attribute values) selected by selector from it, using one compiled plan
+    for the whole batch.
+    """
+    compiled = compile_selector(selector)
+    return [list(compiled.select(root)) for root in roots]
@@ -1,3 +1,4 @@
+import asyncio
 
 
 class FileSource(object):
@@ -14,6 +15,12 @@ class FileSource(object):
         return {"end_index": end,
                 "length": end - node._metadata["start_index"]}
 
+    def get_span_metadata(self, node, start, end):
+        return {"source": self.path,
+                "start_index": start,
+                "end_index": end,
+                "length": end - start}
+
     def read(self, n=1):
         data = self.f.read(n)
         if len(data) < n:
@@ -23,3 +30,100 @@ class FileSource(object):
     def tell(self):
         return self.f.tell()
 
+
+
+class BytesSource(object):
+    """
+    Source reading from a bytes-like object held in memory. offset gives the
+    position of the start of data within the underlying stream, so that the
+    recorded indexes are stream positions. The source itself is recorded as
+    the source of the nodes, so that the bytes of unmodified nodes can be
+    copied from it (see read_span), and is formatted as name.
+    """
+    def __init__(self, data, offset=0, name=None):
+        self.data = data
+        self.offset = offset
+        self.name = name
+        self.pos = 0
+
+    def get_preread_metadata(self, node):
+        return {"source": self,
+                "start_index": self.tell()}
+
+    def get_postread_metadata(self, node):
+        end = self.tell()
+        return {"end_index": end,
+                "length": end - node._metadata["start_index"]}
+
+    def get_span_metadata(self, node, start, end):
+        return {"source": self,
+                "start_index": start,
+                "end_index": end,
+                "length": end - start}
+
+    def read(self, n=1):
+        data = self.data[self.pos:self.pos + n]
+        if len(data) < n:
+            raise EOFError()
+        self.pos += n
+        return data
+
+    def tell(self):
+        return self.offset + self.pos
+
+    def read_span(self, start, end):
+        """
+        Return the bytes between the stream positions start and end.
+        """
+        return bytes(self.data[start - self.offset:end - self.offset])
+
+    def __str__(self):
+        return "<bytes>" if self.name is None else str(self.name)
+
+
+##############################################################################
+# Asynchronous sources                                                       #
+##############################################################################
+
+# An asynchronous source has a coroutine method read(n), which returns up to
+# n bytes. Fewer than n bytes are only returned at the end of the stream.
+
+class AsyncStreamSource(object):
+    """
+    Asynchronous source reading from an asyncio.StreamReader.
+    """
+    def __init__(self, reader, name=None):
+        self.reader = reader
+        self.name = name
+
+    async def read(self, n=1):
+        try:
+            return await self.reader.readexactly(n)
+        except asyncio.IncompleteReadError as err:
+            return err.partial
+
+
+class AsyncFileSource(object):
+    """
+    Asynchronous source reading from a file, with each read done in a
+    thread by the given executor (the event loop's default executor if
+    None) so that the event loop is not blocked.
+    """
+    def __init__(self, path, executor=None):
+        self.path = path
+        self.name = path
+        self.executor = executor
+        self.f = None
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def read(self, n=1):
+        if self.f is None:
+            self.f = await self.run(open, self.path, "rb")
+        return await self.run(self.f.read, n)
+
+    async def close(self):
+        if self.f is not None:
+            await self.run(self.f.close)
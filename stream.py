@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from node import Node
+from validation import *
+from definition import ConstructionHandler
+from source import BytesSource, FileSource
+from png import PNG, PNGChunk, RETAINED_CHUNKS, is_retained
+from collections import namedtuple
+import struct
+import zlib
+
+# the default limit on the declared length of a chunk buffered by a
+# PushParser, as data arriving over a network may claim any length (libpng
+# similarly limits chunks to 8 MB by default)
+MAX_CHUNK_LENGTH = 2**23
+
+##############################################################################
+# Push parser                                                                #
+##############################################################################
+
+class PushParser(object):
+    """
+    Incremental parser for PNG data which arrives in fragments, e.g. from a
+    socket. Each call to feed adds a fragment of any size and constructs as
+    many complete chunks as are available, so that each chunk is parsed
+    only once and a bad signature or a fatal chunk is reported as soon as
+    its bytes have arrived. The tree is built under self.root in the same
+    shape as that produced by PNG.construct.
+
+    ValidationFatal exceptions are raised from feed. Other validation
+    issues are recorded on the nodes as usual and collected in self.issues
+    as (node, issue) tuples. The CRC of each chunk is checked against the
+    bytes read, giving the chunk a crc_valid attribute and a
+    ValidationError if it does not match. Chunks declaring a length greater
+    than max_chunk_length (MAX_CHUNK_LENGTH by default) are rejected with a
+    ValidationFatal rather than buffered. handler is an
+    optional ConstructionHandler which is passed to each construct call.
+    options is a dictionary of options for the ParseContext of the parse,
+    e.g. {"min_severity": ValidationError}. Issues from validation rules
+    deferred by the "validation" option are not collected in self.issues,
+    but are returned with the others by self.root.issues().
+    """
+    def __init__(self, name=None, max_chunk_length=MAX_CHUNK_LENGTH,
+                 chunkdef=PNGChunk, handler=None, options=None):
+        self.name = name
+        self.options = options
+        self.max_chunk_length = max_chunk_length
+        self.chunkdef = chunkdef
+        self.handler = handler
+        self.root = Node("root", None)
+        self.png = None
+        self.chunks = None
+        self.buffer = bytearray()
+        self.offset = 0
+        self.issues = []
+
+    def feed(self, data):
+        """
+        Add data to the parser and return a list of the chunk nodes that
+        were completed by it.
+        """
+        self.buffer.extend(data)
+        if self.png is None and not self.parse_signature():
+            return []
+        completed = []
+        while len(self.buffer) >= 8:
+            length = struct.unpack("!I", self.buffer[:4])[0]
+            if length > self.max_chunk_length:
+                raise ValidationFatal(
+                    "Chunk length {} at offset {} exceeds limit {}".format(
+                        length, self.offset, self.max_chunk_length))
+            size = length + 12
+            if len(self.buffer) < size:
+                break
+            crc_valid = zlib.crc32(self.buffer[4:size - 4]) == \
+                struct.unpack("!I", self.buffer[size - 4:size])[0]
+            chunk = self.parse(self.chunkdef, self.chunks, size)
+            chunk.add_data({"crc_valid": crc_valid})
+            if not crc_valid and self.png.context.reports(ValidationError):
+                issue = ValidationError("CRC mismatch in chunk {}".format(
+                    chunk))
+                chunk.add_data({"validation": [issue]}, meta=True)
+                self.issues.append((chunk, issue))
+            completed.append(chunk)
+        return completed
+
+    def parse(self, definition, parent, size):
+        """
+        Construct a node from the first size bytes of the buffer using
+        definition, and remove them from the buffer.
+        """
+        source = BytesSource(bytes(self.buffer[:size]), self.offset,
+                             self.name)
+        node = definition.construct(source, parent, handler=self.handler)
+        del self.buffer[:size]
+        self.offset += size
+        for n in node:
+            for issue in iter_issues(n.metadata.get("validation", [])):
+                self.issues.append((n, issue))
+        return node
+
+    def parse_signature(self):
+        """
+        Construct the PNG and signature nodes once enough data has arrived,
+        returning True if this has been done. Data that cannot be the start
+        of the signature is rejected immediately.
+        """
+        sigdef = PNG.children[0]
+        expected = sigdef.staticbytes
+        available = bytes(self.buffer[:len(expected)])
+        if not expected.startswith(available):
+            raise ValidationFatal("Invalid PNG signature")
+        if len(available) < len(expected):
+            return False
+        self.png = Node(PNG.name, self.root)
+        self.png.context = PNG.context_class(self.options)
+        self.png.context.index_node(self.png)
+        self.png.add_data({"definition": PNG, "source": self.name,
+                           "start_index": 0}, meta=True)
+        self.parse(sigdef, self.png, len(expected))
+        self.chunks = Node(PNG.children[1].name, self.png)
+        self.chunks.add_data({"source": self.name,
+                              "start_index": self.offset}, meta=True)
+        return True
+
+    def close(self):
+        """
+        Signal the end of the data, raising EOFError if it ended part way
+        through the signature or a chunk, and return the root node.
+        """
+        if self.buffer or self.png is None:
+            raise EOFError()
+        for node in (self.png, self.chunks):
+            node.add_data({"end_index": self.offset,
+                           "length": self.offset - node.start_index},
+                          meta=True)
+        return self.root
+
+##############################################################################
+# Pull-style iteration                                                       #
+##############################################################################
+
+def iterchunks(source, detach=False, max_chunk_length=2**31 - 1):
+    """
+    Return a generator yielding each chunk node of the PNG read from source
+    (a FileSource or a path) as soon as it has been constructed and
+    validated, so that the caller can stop early. Chunk nodes have the
+    usual type attribute, offsets and payload nodes, and a crc_valid
+    attribute. If detach is True, each yielded chunk (other than those in
+    RETAINED_CHUNKS) is removed from the tree once the next chunk has been
+    constructed, so that it can be garbage collected once the caller has
+    finished with it. Validations that look at earlier chunks then only
+    see the retained ones and the chunk before the current one. A file
+    opened from a path is closed when the generator finishes or is closed.
+    max_chunk_length defaults to the largest length PNG allows, since the
+    size of a file is known, rather than to MAX_CHUNK_LENGTH.
+    """
+    opened = isinstance(source, str)
+    if opened:
+        source = FileSource(source)
+    try:
+        parser = PushParser(getattr(source, "path", None), max_chunk_length)
+        parser.feed(source.read(len(PNG.children[0].staticbytes)))
+        previous = None
+        while True:
+            start = source.tell()
+            try:
+                header = source.read(8)
+            except EOFError:
+                if source.tell() == start:
+                    break
+                raise
+            parser.feed(header)
+            length = struct.unpack("!I", header[:4])[0]
+            for chunk in parser.feed(source.read(length + 4)):
+                # the previous chunk is kept until now for the validations
+                # of this one (e.g. that IDAT chunks are consecutive)
+                if previous is not None:
+                    detach_issues(previous)
+                    parser.chunks.children.remove(previous)
+                    previous = None
+                if detach and chunk.type not in RETAINED_CHUNKS:
+                    previous = chunk
+                yield chunk
+        parser.close()
+    finally:
+        # also reached when the caller stops early and the generator is
+        # closed
+        if opened:
+            source.f.close()
+
+##############################################################################
+# Streaming summaries                                                        #
+##############################################################################
+
+# The record kept for each chunk by a streaming parse. offset is the offset
+# of the start of the chunk, length is its declared payload length,
+# crc_valid is the result of the CRC check (None if it was not checked) and
+# issues is a list of the validation issues recorded within the chunk.
+ChunkSummary = namedtuple("ChunkSummary", ["type", "offset", "length",
+                                           "crc_valid", "issues"])
+
+class CRCFileSource(FileSource):
+    """
+    FileSource which keeps a running CRC of the bytes read since the last
+    call to start_crc, so that a CRC can be checked from the bytes as they
+    are parsed rather than by reading them again. crc is None when no CRC
+    is being computed.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.crc = None
+
+    def start_crc(self):
+        self.crc = 0
+
+    def read(self, n=1):
+        data = super().read(n)
+        if self.crc is not None:
+            self.crc = zlib.crc32(data, self.crc)
+        return data
+
+class SummaryHandler(ConstructionHandler):
+    """
+    Treeless ConstructionHandler which appends a ChunkSummary to
+    self.summaries as each chunk is completed and then releases the chunk.
+    Only the chunks retained by png.is_retained and the most recent chunk
+    (which the IDAT sequence validation refers to) are kept in the tree, so
+    memory use does not grow with the size of the file. Issues recorded
+    outside of any chunk are collected in self.issues. If source is given
+    it should be the CRCFileSource being parsed, whose running CRC of the
+    type and payload of each chunk is checked against the chunk's CRC.
+    """
+    def __init__(self, source=None):
+        super().__init__(True, [is_retained])
+        self.source = source
+        self.summaries = []
+        self.issues = []
+        self.chunk = None
+        self.chunk_issues = None
+        self.crc = None
+
+    def on_node_start(self, definition, node, offset):
+        if node._name == "chunk":
+            self.chunk = node
+            self.chunk_issues = []
+            self.crc = None
+        elif self.source is not None and node._parent is self.chunk:
+            if node._name == "chunk_type":
+                self.source.start_crc()
+            elif node._name == "crc":
+                self.crc = self.source.crc
+                self.source.crc = None
+
+    def on_issue(self, node, issue):
+        if isinstance(issue, ValidationException):
+            # the chunk is released when it ends
+            issue.detach()
+        if self.chunk_issues is None:
+            self.issues.append(issue)
+        else:
+            self.chunk_issues.append(issue)
+
+    def on_node_discarded(self, node):
+        if node is self.chunk:
+            self.chunk = None
+            self.chunk_issues = None
+            if self.source is not None:
+                self.source.crc = None
+
+    def on_node_end(self, node, offset):
+        if node._name != "chunk":
+            return
+        crc_valid = None if self.crc is None else \
+            self.crc == node.crc.value
+        self.summaries.append(ChunkSummary(node.attributes.get("type"),
+            node.start_index, node.children[0].value, crc_valid,
+            self.chunk_issues))
+        self.chunk = None
+        self.chunk_issues = None
+        siblings = node._parent._children
+        kept = []
+        for chunk in siblings:
+            if chunk is node or self.retain(chunk):
+                kept.append(chunk)
+            elif chunk._context is not None:
+                chunk._context.node_released(chunk)
+        siblings[:] = kept
+
+def summarize(path):
+    """
+    Parse the PNG file at path in a single pass with a SummaryHandler and
+    return a tuple of the root node, which only contains the retained
+    chunks, and the handler holding the chunk summaries and other issues.
+    Peak memory is bounded by the largest chunk rather than the file.
+    """
+    root = Node("root", None)
+    source = CRCFileSource(path)
+    try:
+        handler = SummaryHandler(source)
+        PNG.construct(source, root, handler=handler)
+    finally:
+        source.f.close()
+    return root, handler
+
+##############################################################################
+# Asynchronous parsing                                                       #
+##############################################################################
+
+async def parse_async(source, name=None, max_chunk_length=MAX_CHUNK_LENGTH,
+                      handler=None, options=None):
+    """
+    Parse the PNG read from the asynchronous source (see AsyncStreamSource
+    and AsyncFileSource) and return the root node. Each chunk is awaited in
+    turn and constructed by a PushParser as soon as it has been read, so
+    that parses of several sources can interleave on one event loop while
+    they wait for data. handler and options are passed to the PushParser.
+    A source with a close coroutine (e.g. AsyncFileSource) is closed when
+    the parse ends, whether or not it succeeds.
+    """
+    name = name if name is not None else getattr(source, "name", None)
+    parser = PushParser(name, max_chunk_length, handler=handler,
+                        options=options)
+    try:
+        data = await source.read(len(PNG.children[0].staticbytes))
+        while data:
+            parser.feed(data)
+            header = await source.read(8)
+            if len(header) < 8:
+                parser.feed(header)
+                break
+            length = struct.unpack("!I", header[:4])[0]
+            parser.feed(header)
+            data = await source.read(length + 4)
+        return parser.close()
+    finally:
+        if hasattr(source, "close"):
+            await source.close()
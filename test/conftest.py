@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import glob
+import io
+import os
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from encoder import PNGEncoder
+from node import Node
+from source import BytesSource, FileSource
+from validation import ValidationException
+from writer import encode_chunk, SIGNATURE
+import png
+
+##############################################################################
+# Test images                                                                #
+##############################################################################
+
+def encode_image(width=8, height=8, bit_depth=8, color_type=2, **kwargs):
+    """
+    Return the bytes of a PNG image of a gradient, written by PNGEncoder
+    with the given IHDR fields and keyword arguments.
+    """
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    row_length = (width * channels * bit_depth + 7) // 8
+    fp = io.BytesIO()
+    with PNGEncoder(fp, width, height, bit_depth, color_type,
+                    **kwargs) as encoder:
+        for y in range(height):
+            encoder.write_row(bytes((x * 7 + y * 13) % 256
+                                    for x in range(row_length)))
+    return fp.getvalue()
+
+def split_chunks(data):
+    """
+    Return a list of (chunk_type, payload) for the chunks in the PNG data.
+    """
+    chunks = []
+    pos = len(SIGNATURE)
+    while pos < len(data):
+        length = int.from_bytes(data[pos:pos + 4], "big")
+        chunks.append((data[pos + 4:pos + 8].decode("latin-1"),
+                       data[pos + 8:pos + 8 + length]))
+        pos += length + 12
+    return chunks
+
+def join_chunks(chunks):
+    """
+    Return the bytes of a PNG made of the (chunk_type, payload) chunks.
+    """
+    return SIGNATURE + b"".join(encode_chunk(chunk_type, payload)
+                                for chunk_type, payload in chunks)
+
+def generated_images():
+    """
+    Return a dictionary of name: PNG bytes for the generated test images,
+    covering the colour types, several IDAT chunks, ancillary chunks and
+    chunks out of order.
+    """
+    palette = [(i, 255 - i, i // 2) for i in range(0, 256, 16)]
+    text = [("tEXt", {"keyword": "Title", "text": "Test"}),
+            ("tIME", {"year": 2020, "month": 1, "day": 2, "hour": 3,
+                      "minute": 4, "second": 5})]
+    images = {
+        "grey": encode_image(color_type=0, bit_depth=1),
+        "rgb": encode_image(16, 16, chunks=text),
+        "rgba16": encode_image(color_type=6, bit_depth=16),
+        "palette": encode_image(color_type=3, bit_depth=4, palette=palette),
+        "idats": encode_image(64, 64, idat_size=256, level=0),
+    }
+    # PLTE after the first IDAT and a second IDAT after another chunk
+    chunks = split_chunks(encode_image(32, 32, color_type=3, bit_depth=4,
+                                       palette=palette, idat_size=64,
+                                       level=0))
+    plte = [chunk for chunk in chunks if chunk[0] == "PLTE"]
+    chunks = [chunk for chunk in chunks if chunk[0] != "PLTE"]
+    chunks[2:2] = plte
+    chunks[4:4] = [("tEXt", b"Late\x00chunk")]
+    images["misordered"] = join_chunks(chunks)
+    # a second PLTE after the IDAT, which breaks two rules
+    chunks = split_chunks(encode_image(color_type=3, bit_depth=4,
+                                       palette=palette))
+    chunks.insert(3, chunks[1])
+    images["repeated"] = join_chunks(chunks)
+    # repeated chunks and an invalid tIME
+    chunks = split_chunks(encode_image(chunks=text))
+    chunks[1:1] = [chunks[1], ("tIME", b"\x07\xe4\x0d\x20\x19\x3c\x3d")]
+    images["invalid"] = join_chunks(chunks)
+    return images
+
+##############################################################################
+# Comparisons                                                                #
+##############################################################################
+
+def parse(path, options=None):
+    """
+    Return the root of the tree constructed by png.PNG from the file at
+    path (or bytes), with a PNGContext with the given options.
+    """
+    root = Node("root", None)
+    if options is not None:
+        root.context = png.PNGContext(options)
+    if isinstance(path, bytes):
+        png.PNG.construct(BytesSource(path), root)
+        return root
+    source = FileSource(path)
+    try:
+        png.PNG.construct(source, root)
+    finally:
+        source.f.close()
+    return root
+
+def tree_values(node):
+    """
+    Return a list of (depth, name, value) for node and its descendents in
+    document order, which identifies the parsed content of a tree.
+    """
+    result = []
+    stack = [(node, 0)]
+    while stack:
+        node, depth = stack.pop()
+        result.append((depth, node._name,
+                       repr(node.attributes.get("value"))))
+        stack.extend((child, depth + 1) for child in reversed(node.children))
+    return result
+
+def issue_keys(issues):
+    """
+    Return a sorted list identifying each issue by its class, rule and the
+    offset of its node, which do not depend on how much of the tree was
+    kept.
+    """
+    return sorted((issue.key, issue.offset)
+                  if isinstance(issue, ValidationException)
+                  else (str(issue), None) for issue in issues)
+
+@pytest.fixture(scope="session")
+def png_files(tmp_path_factory):
+    """
+    Return a list of paths of PNG files to test with: the generated images
+    and any PNG files (such as the PngSuite) in the test directory.
+    """
+    directory = tmp_path_factory.mktemp("png")
+    paths = []
+    for name, data in sorted(generated_images().items()):
+        path = str(directory / (name + ".png"))
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths + sorted(glob.glob(os.path.join(TEST_DIR, "*.png")))
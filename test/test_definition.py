@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from conftest import parse
+from definition import ConstructionHandler, DefinedChildrenDef
+from definition import DelegatingDef, IntegerDef
+from node import Node
+from path import Path
+from png import PNG, PNGPayloads
+from source import BytesSource
+from validation import Validation, ValidationError, iter_issues
+
+class RecordingHandler(ConstructionHandler):
+    """
+    ConstructionHandler recording every event in self.events as (kind,
+    node, detail) tuples.
+    """
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def on_node_start(self, definition, node, offset):
+        self.events.append(("start", node, offset))
+
+    def on_value(self, node, value):
+        self.events.append(("value", node, value))
+
+    def on_issue(self, node, issue):
+        self.events.append(("issue", node, issue))
+
+    def on_node_end(self, node, offset):
+        self.events.append(("end", node, offset))
+
+    def on_node_discarded(self, node):
+        self.events.append(("discarded", node, None))
+
+def record(data):
+    handler = RecordingHandler()
+    root = Node("root", None)
+    PNG.construct(BytesSource(data), root, handler=handler)
+    return root, handler.events
+
+def check_events(root, events, length):
+    """
+    Check that events are properly nested: each node is started, then has
+    its value and children, then its issues and its end, or is discarded.
+    length is the length of the data, where the chunks node (which has no
+    end_index) ends.
+    """
+    stack = []
+    started = []
+    discarded = set()
+    valued = []
+    issues = []
+    for kind, node, detail in events:
+        if kind == "start":
+            assert detail == node.start_index
+            stack.append(node)
+            started.append(node)
+        elif kind == "value":
+            assert stack[-1] is node and detail is node.value
+            valued.append(node)
+        elif kind == "issue":
+            assert stack[-1] is node
+            issues.append(detail)
+        else:
+            assert stack.pop() is node
+            if kind == "end":
+                assert detail == node.metadata.get("end_index", length)
+            else:
+                discarded.add(node)
+    assert stack == []
+    nodes = list(root.PNG)
+    assert [node for node in started if node not in discarded] == nodes
+    assert valued == [node for node in nodes if "value" in node.attributes]
+    assert issues == [issue for node in nodes for issue in
+                      iter_issues(node.metadata.get("validation", []))]
+    return discarded
+
+def test_event_order(png_files):
+    for path in png_files:
+        with open(path, "rb") as f:
+            data = f.read()
+        root, events = record(data)
+        # the chunk started at the end of the data is discarded
+        discarded = check_events(root, events, len(data))
+        assert sorted(node._name for node in discarded) == [
+            "chunk", "length"]
+
+def test_fused_events(png_files, monkeypatch):
+    with open(png_files[0], "rb") as f:
+        data = f.read()
+    root, fused = record(data)
+    # the IHDR fields are read in one unpack, with the same events as when
+    # they are constructed one by one
+    ihdr = PNGPayloads.defdict["IHDR_payload"]
+    assert ihdr.layout is not None
+    monkeypatch.setattr(ihdr, "layout", None)
+    generic_root, generic = record(data)
+    check_events(root, fused, len(data))
+    check_events(generic_root, generic, len(data))
+    summary = lambda events: [(kind, node._name, detail if kind != "issue"
+                               else detail.key) for kind, node, detail
+                              in events]
+    assert summary(fused) == summary(generic)
+    assert [name for kind, name, detail in summary(fused)[:40]
+            if kind == "end"][:9] == [
+        "signature", "length", "chunk_type", "width", "height", "bit_depth",
+        "color_type", "compression_method", "filter_method"]
+
+def test_delegating_issues():
+    check = Validation(Path().parent.children[0].value, "==", 1, stage="pre",
+                       error=ValidationError,
+                       description="First value must be 1")
+    for keyfunc in (Path().parent.children[0].value,
+                    lambda node: node.parent.children[0].value):
+        delegating = DelegatingDef({"default": IntegerDef("second", "!B")},
+                                   keyfunc, validation=[check])
+        definition = DefinedChildrenDef("pair", [IntegerDef("first", "!B"),
+                                                 delegating])
+        root = Node("root", None)
+        pair = definition.construct(BytesSource(b"\x02\x03"), root)
+        # the issue is recorded on the parent whether the rule is rebased
+        # to it or run against a placeholder node
+        assert [child._name for child in pair.children] == ["first",
+                                                            "second"]
+        issues = pair.metadata.get("validation", [])
+        assert [(issue.key, issue.offset)
+                for issue in iter_issues(issues)] == [
+            (("ValidationError", check.rule_id), 0)]
+        assert str(issues[0]).startswith(
+            "ValidationError: First value must be 1")
+        assert pair.context.count_named({"DelegatingDef"}) == 0
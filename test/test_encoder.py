@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import random
+
+from conftest import parse, split_chunks
+from decoder import read_image, pack_samples, unfilter_row
+from encoder import PNGEncoder, filter_row, payload_bytes
+import pytest
+
+# (color_type, bit_depth) pairs allowed by the PNG specification
+FORMATS = [(0, 1), (0, 2), (0, 4), (0, 8), (0, 16), (2, 8), (2, 16),
+           (3, 1), (3, 2), (3, 4), (3, 8), (4, 8), (4, 16), (6, 8), (6, 16)]
+
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def random_rows(width, height, bit_depth, color_type, seed=0):
+    """
+    Return rows of samples with a mixture of noise and flat runs, so that
+    every filter type is worth choosing somewhere.
+    """
+    rng = random.Random(seed)
+    top = 2**bit_depth - 1
+    count = width * CHANNELS[color_type]
+    rows = []
+    for y in range(height):
+        if y % 3 == 0:
+            rows.append([rng.randint(0, top) for x in range(count)])
+        else:
+            rows.append([(x * y) & top for x in range(count)])
+    return rows
+
+def encode_rows(rows, width, bit_depth, color_type, **kwargs):
+    fp = io.BytesIO()
+    if color_type == 3:
+        kwargs["palette"] = [(i, i, i) for i in range(2**bit_depth)]
+    with PNGEncoder(fp, width, len(rows), bit_depth, color_type,
+                    **kwargs) as encoder:
+        for row in rows:
+            encoder.write_row(pack_samples(row, bit_depth))
+    return fp.getvalue()
+
+@pytest.mark.parametrize("color_type, bit_depth", FORMATS)
+def test_round_trip(color_type, bit_depth):
+    width = 13
+    rows = random_rows(width, 9, bit_depth, color_type)
+    for filter_type in (0, 1, 2, 3, 4, "adaptive", "brute"):
+        data = encode_rows(rows, width, bit_depth, color_type,
+                           filter_type=filter_type, idat_size=100)
+        root = parse(data)
+        assert root.issues() == [], filter_type
+        image = read_image(root)
+        assert (image.width, image.height) == (width, len(rows))
+        assert image.rows == rows, filter_type
+
+def test_parallel_compression():
+    width = 200
+    rows = random_rows(width, 60, 8, 6, seed=1)
+    serial = encode_rows(rows, width, 8, 6, filter_type=1)
+    parallel = encode_rows(rows, width, 8, 6, filter_type=1, threads=4,
+                           block_size=4096)
+    assert read_image(parse(parallel)).rows == rows
+    assert read_image(parse(serial)).rows == rows
+
+@pytest.mark.parametrize("filter_type", [0, 1, 2, 3, 4])
+def test_filters(filter_type):
+    rng = random.Random(filter_type)
+    prev = bytes(rng.randrange(256) for i in range(40))
+    row = bytes(rng.randrange(256) for i in range(40))
+    for bpp in (1, 2, 3, 4, 6, 8):
+        filtered = filter_row(filter_type, row, prev, bpp)
+        assert filtered[0] == filter_type
+        assert bytes(unfilter_row(filter_type, filtered[1:], prev, bpp)) \
+            == row
+
+def test_payload_bytes():
+    value = {"year": 2021, "month": 12, "day": 31, "hour": 23,
+             "minute": 59, "second": 60}
+    fp = io.BytesIO()
+    with PNGEncoder(fp, 1, 1, chunks=[("tIME", value)]) as encoder:
+        encoder.write_row(b"\x00\x00\x00")
+    assert ("tIME", b"\x07\xe5\x0c\x1f\x17\x3b\x3c") in \
+        split_chunks(fp.getvalue())
+    payload = [node for node in parse(fp.getvalue())
+               if node._name == "tIME_payload"][0]
+    assert {child._name: child.value for child in payload.children} == value
+    with pytest.raises(ValueError):
+        payload_bytes("tIME", dict(value, month=13))
+
+def test_numpy_rows():
+    numpy = pytest.importorskip("numpy")
+    rows = random_rows(7, 5, 16, 2, seed=2)
+    for dtype in ("<u2", ">u2", "=u2"):
+        fp = io.BytesIO()
+        with PNGEncoder(fp, 7, 5, 16, 2) as encoder:
+            for row in rows:
+                encoder.write_row(numpy.array(row, dtype=dtype))
+        assert read_image(parse(fp.getvalue())).rows == rows, dtype
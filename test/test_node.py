@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import array
+import collections.abc
+import io
+import pickle
+import pytest
+
+from conftest import parse, encode_image, split_chunks, join_chunks
+from node import Node, Criterion, Name, NameIn, AttrEquals, All, Any, Not
+
+def text_image():
+    chunks = split_chunks(encode_image())
+    chunks[1:1] = [("tEXt", b"Title\x00Test"), ("tIME", bytes(7))]
+    return join_chunks(chunks)
+
+def chunk_types(root, criteria):
+    return [node.type for node in root.descendents(criteria)]
+
+def test_criteria():
+    root = parse(text_image())
+    text = AttrEquals("type", "tEXt")
+    chunk = Name("chunk")
+    assert chunk_types(root, [text]) == ["tEXt"]
+    assert chunk_types(root, [chunk & Not(text | AttrEquals("type", "IDAT"))]) \
+        == ["IHDR", "tIME", "IEND"]
+    assert chunk_types(root, [Any(text, AttrEquals("type", "tIME"))]) == [
+        "tEXt", "tIME"]
+    assert chunk_types(root, [All(chunk, ~text), AttrEquals("type", "IEND")]) \
+        == ["IEND"]
+    # metadata is not an attribute
+    assert root.descendents([AttrEquals("start_index", 8)]) == []
+    assert root.descendents([AttrEquals("type", "tEXt"), Name("crc")]) == []
+    # name sets are combined, and missing for other criteria
+    assert (Name("a") | NameIn("b", "c")).names == {"a", "b", "c"}
+    assert (NameIn("a", "b") & Name("b")).names == {"b"}
+    assert (Name("a") & text).names is None and (~Name("a")).names is None
+    # criteria compare by value and survive pickling
+    criterion = All(chunk, Not(text))
+    assert criterion == All(Name("chunk"), Not(AttrEquals("type", "tEXt")))
+    assert hash(criterion) == hash(pickle.loads(pickle.dumps(criterion)))
+    assert criterion != Any(chunk, Not(text))
+
+def test_criterion_abstract():
+    with pytest.raises(TypeError):
+        Criterion()
+    class Even(Criterion):
+        def __call__(self, node):
+            return node.value % 2 == 0
+    root = parse(text_image())
+    lengths = [node.value for node in root.descendents([Name("length")])]
+    assert [node.value for node in root.descendents([Name("length"), Even()])
+            ] == [length for length in lengths if length % 2 == 0]
+
+def test_name_index():
+    root = parse(text_image())
+    png = root.PNG
+    context = png.context
+    for name in ("tEXt_payload", "chunk", "missing"):
+        assert png.count_descendents([Name(name)]) == context.count_named(
+            {name})
+    first = png.first_descendent([Name("tEXt_payload")])
+    assert first is context.first_named({"tEXt_payload"})
+    assert png.first_descendent([NameIn("tIME_payload", "tEXt_payload")]) \
+        is first
+    # the index is not used for a node that has been removed
+    first._parent._parent.children.remove(first._parent)
+    assert png.count_descendents([Name("tEXt_payload")]) == 0
+    assert first._parent.count_descendents([Name("tEXt_payload")]) == 1
+
+class Samples(collections.abc.Sequence):
+    """
+    Sequence which fails if it is formatted with more than 32 items.
+    """
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Samples(len(range(*index.indices(self.length))))
+        return index
+
+    def __str__(self):
+        assert self.length <= 32
+        return "Samples({})".format(self.length)
+
+def tree_values(values):
+    root = Node("root", None)
+    for value in values:
+        Node("child", root).add_data({"value": value})
+    fp = io.StringIO()
+    root.write_tree(fp, max_value_len=32)
+    return [line.split(":", 1)[1] for line in fp.getvalue().splitlines()
+            if "value:" in line]
+
+def test_write_tree():
+    assert tree_values([array.array("I", range(100000)), Samples(10**9),
+                        {"key": "value"}, 12345]) == [
+        "array('I', [0, 1, 2, 3, 4, 5, 6,", "Samples(32)",
+        "{'key': 'value'}", "12345"]
+
+def test_write_tree_numpy():
+    numpy = pytest.importorskip("numpy")
+    value, = tree_values([numpy.arange(10**6).reshape(1000, 1000)])
+    assert value == str(numpy.arange(10**6).reshape(1000, 1000)[:32])[:32]
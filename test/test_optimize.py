@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+import struct
+import zlib
+
+from conftest import parse, encode_image, split_chunks, join_chunks
+from decoder import Image, read_image
+import decoder
+import encoder
+import optimize
+
+ITXT = [("iTXt", b"Comment\x00\x00\x00\x00\x00\xff\xfeinvalid"),
+        ("iTXt", b"Comment\x00\x01\x00\x00\x00" +
+         zlib.compress("compressed".encode("utf-8")))]
+
+def write_png(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+def read_png(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def run(path, out, **kwargs):
+    return optimize.optimize(path, out, filters=(0, "adaptive"),
+                             zlib_settings=((9, zlib.Z_DEFAULT_STRATEGY),),
+                             workers=2, **kwargs)
+
+def pixels(path):
+    return optimize.rgba_rows(read_image(parse(path)))
+
+def test_lossless(png_files, tmp_path):
+    for i, path in enumerate(png_files):
+        # the PngSuite names its corrupted files x*.png
+        if os.path.basename(path).startswith("x"):
+            continue
+        out = str(tmp_path / "{}.png".format(i))
+        before, after = run(path, out)
+        assert after <= before
+        assert pixels(out) == pixels(path), path
+
+def test_ancillary_chunks(tmp_path):
+    palette = [(i * 16, i * 16, i * 16) for i in range(16)]
+    chunks = split_chunks(encode_image(16, 16, color_type=3, bit_depth=8,
+                                       palette=palette, level=0))
+    colour = [("bKGD", b"\x02"),
+              ("hIST", struct.pack("!16H", *range(16)))]
+    chunks[1:1] = [("sBIT", b"\x05\x05\x05")]
+    chunks[3:3] = colour + ITXT
+    path = write_png(str(tmp_path / "in.png"), join_chunks(chunks))
+    out = str(tmp_path / "out.png")
+    run(path, out)
+    output = split_chunks(read_png(out))
+    # the optimized image is greyscale, so hIST is dropped and the palette
+    # index in bKGD becomes a grey level
+    assert read_image(parse(out)).color_type == 0
+    assert pixels(out) == pixels(path)
+    for chunk in ITXT + [("sBIT", b"\x05"), ("bKGD", b"\x00\x20")]:
+        assert chunk in output
+    assert "hIST" not in [chunk_type for chunk_type, payload in output]
+    run(path, out, strip=True)
+    output = split_chunks(read_png(out))
+    assert [chunk_type for chunk_type, payload in output] == [
+        "IHDR", "IDAT", "IEND"]
+
+def test_adapt_chunks():
+    image = Image(2, 1, 8, 3, [[0, 1]], [(1, 2, 3), (4, 5, 6), (1, 2, 3)],
+                  (0,))
+    chunks = [("hIST", struct.pack("!3H", 5, 6, 7)), ("bKGD", b"\x01"),
+              ("tEXt", b"a\x00b")]
+    same = optimize.Candidate(3, 8, [], image.palette, (0,))
+    assert optimize.adapt_chunks(chunks, image, same) == chunks
+    reordered = optimize.Candidate(3, 1, [], [(1, 2, 3), (4, 5, 6)], None)
+    assert optimize.adapt_chunks(chunks, image, reordered) == [
+        ("hIST", struct.pack("!2H", 7, 6)), ("bKGD", b"\x01"),
+        ("tEXt", b"a\x00b")]
+    truecolor = optimize.Candidate(6, 8, [], None, None)
+    assert optimize.adapt_chunks(chunks, image, truecolor) == [
+        ("bKGD", struct.pack("!3H", 4, 5, 6)), ("tEXt", b"a\x00b")]
+
+def test_unsafe_to_copy(tmp_path):
+    chunks = split_chunks(encode_image(16, 16, level=0))
+    chunks[1:1] = [("prVT", b"unsafe"), ("prvt", b"safe"),
+                   ("cHRM", bytes(32))]
+    path = write_png(str(tmp_path / "in.png"), join_chunks(chunks))
+    for keep_unsafe, expected in [(False, ["prvt", "cHRM"]),
+                                  (True, ["prVT", "prvt", "cHRM"])]:
+        root = parse(path)
+        assert [chunk_type for chunk_type, payload in
+                optimize.ancillary_chunks(root, keep_unsafe=keep_unsafe)] \
+            == expected
+
+def interlaced_png(width, height, bit_depth, color_type, transparency=None):
+    """
+    Return the bytes of an Adam7 interlaced PNG of noise, using every
+    filter type in turn.
+    """
+    length = encoder.bytes_per_pixel(bit_depth, color_type)
+    data = bytearray()
+    seed = 1
+    for xstart, ystart, xstep, ystep in decoder.ADAM7:
+        pass_width = (width - xstart + xstep - 1) // xstep
+        pass_height = (height - ystart + ystep - 1) // ystep
+        if pass_width <= 0 or pass_height <= 0:
+            continue
+        size = encoder.row_bytes(pass_width, bit_depth, color_type)
+        prev = bytes(size)
+        for y in range(pass_height):
+            row = bytearray()
+            for x in range(size):
+                seed = seed * 1103515245 + 12345 & 0x7fffffff
+                row.append(seed >> 16 & 0xff)
+            data += encoder.filter_row(y % 5, bytes(row), prev, length)
+            prev = bytes(row)
+    chunks = [("IHDR", struct.pack("!2I5B", width, height, bit_depth,
+                                   color_type, 0, 0, 1))]
+    if color_type == 3:
+        chunks.append(("PLTE", bytes(range(48))))
+    if transparency is not None:
+        chunks.append(("tRNS", transparency))
+    chunks += [("IDAT", zlib.compress(bytes(data))), ("IEND", b"")]
+    return join_chunks(chunks)
+
+def test_numpy_analysis(png_files, monkeypatch):
+    pytest.importorskip("numpy")
+    images = [parse(path) for path in png_files
+              if not os.path.basename(path).startswith("x")]
+    images += [parse(interlaced_png(13, 11, bit_depth, color_type, trns))
+               for bit_depth, color_type, trns in [
+                   (1, 0, None), (2, 0, b"\x00\x01"), (4, 3, b"\x00\x80"),
+                   (8, 3, None), (8, 2, b"\x00\x10\x00\x20\x00\x30"),
+                   (16, 4, None), (16, 6, None), (8, 0, None)]]
+    vectorised = []
+    for root in images:
+        image = read_image(root)
+        assert image.samples is not None
+        vectorised.append((image.rows, optimize.candidates(image)))
+    monkeypatch.setattr(decoder, "numpy", None)
+    monkeypatch.setattr(optimize, "numpy", None)
+    for root, expected in zip(images, vectorised):
+        image = read_image(root)
+        assert image.samples is None
+        assert (image.rows, optimize.candidates(image)) == expected
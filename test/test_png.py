@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import array
+import pytest
+
+from conftest import parse, encode_image, split_chunks, join_chunks
+from conftest import tree_values
+from definition import IntegerSequenceDef, encode_node
+import definition as definition_module
+from node import Node, Name
+from source import BytesSource
+import struct
+import zlib
+
+ENTRIES = [(1, 2, 3, 4, 5), (6, 7, 8, 9, 10)]
+
+def splt_image():
+    chunks = split_chunks(encode_image())
+    chunks[1:1] = [("sPLT", b"palette\x00\x08" + b"".join(
+        struct.pack("!4BH", *entry) for entry in ENTRIES))]
+    return join_chunks(chunks)
+
+def splt_entries(compact):
+    root = parse(splt_image(), {"compact_sPLT": compact})
+    assert root.issues() == []
+    entry = root.first_descendent([Name("sPLT_entry")])
+    if compact:
+        return [tuple(int(v) for v in record) for record in entry.value]
+    return [tuple(child.value for child in palette.children)
+            for palette in entry.children]
+
+def test_compact_sPLT():
+    assert splt_entries(False) == ENTRIES
+    assert splt_entries(True) == ENTRIES
+    # the option only applies to the parse it is given to
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(splt_entries, [False, True] * 8))
+    assert results == [ENTRIES] * 16
+
+def flatten(values):
+    return [v for item in values
+            for v in (item if isinstance(item, list) else [item])]
+
+def test_integer_sequence_array(monkeypatch):
+    data = struct.pack("!6H", *range(6))
+    cases = [(1, [0, 1]), (3, [[0, 1, 2], [3, 4, 5]]), (0, [[], []])]
+    for use_numpy in (True, False):
+        if use_numpy:
+            pytest.importorskip("numpy")
+        else:
+            monkeypatch.setattr(definition_module, "numpy", None)
+        for subseq_length, expected in cases:
+            definition = IntegerSequenceDef("values", "!H", 2, subseq_length,
+                                            as_array=True)
+            node = definition.construct(BytesSource(data),
+                                        Node("root", None))
+            value = node.attributes["value"]
+            flat = flatten(expected)
+            if use_numpy:
+                # a NumPy array with a row for each item
+                assert value.tolist() == expected
+            else:
+                # otherwise a flat array.array
+                assert isinstance(value, array.array)
+                assert value.tolist() == flat
+            assert definition.encode(node) == struct.pack(
+                "!{}H".format(len(flat)), *flat)
+
+def test_integer_arrays(monkeypatch):
+    palette = [(i, 255 - i, i // 2) for i in range(0, 256, 16)]
+    chunks = split_chunks(encode_image(color_type=3, bit_depth=4,
+                                       palette=palette))
+    chunks[2:2] = [("tRNS", bytes(range(4))),
+                   ("hIST", struct.pack("!16H", *range(16)))]
+    data = join_chunks(chunks)
+    payloads = dict(chunks)
+    expected = tree_values(parse(data))
+    for use_numpy in (True, False):
+        if use_numpy:
+            pytest.importorskip("numpy")
+        else:
+            monkeypatch.setattr(definition_module, "numpy", None)
+        root = parse(data, {"integer_arrays": True})
+        assert root.issues() == []
+        assert root.PNG.context.palette_length == 16
+        nodes = {chunk_type: root.first_descendent(
+                     [Name(chunk_type + "_payload")])
+                 for chunk_type in ("PLTE", "tRNS", "hIST")}
+        plte = nodes["PLTE"].value
+        if use_numpy:
+            assert plte.shape == (16, 3)
+            plte = plte.ravel()
+        assert list(plte) == flatten([list(entry) for entry in palette])
+        assert list(nodes["tRNS"].value) == list(range(4))
+        assert list(nodes["hIST"].value) == list(range(16))
+        for chunk_type, node in nodes.items():
+            assert encode_node(node) == payloads[chunk_type]
+    assert tree_values(parse(data, {"integer_arrays": False})) == expected
+
+def test_iTXt():
+    text = "Grüße"
+    for flag, data in [(0, text.encode("utf-8")),
+                       (1, zlib.compress(text.encode("utf-8")))]:
+        chunks = split_chunks(encode_image())
+        chunks[1:1] = [("iTXt", b"Comment\x00" + bytes([flag]) +
+                        b"\x00de\x00Kommentar\x00" + data)]
+        root = parse(join_chunks(chunks))
+        assert root.issues() == []
+        node = root.first_descendent([Name("iTXt_payload")])
+        assert node.translated_keyword.value == "Kommentar"
+        if flag:
+            assert node.text.value == data
+            assert node.text.decompressed_text == text.encode("utf-8")
+        else:
+            assert node.text.value == text
+
+def test_palette_length():
+    palette = [(i, i, i) for i in range(4)]
+    expected = [
+        ([("tRNS", bytes(4)), ("hIST", bytes(8))], []),
+        ([("tRNS", bytes(5))], ["tRNS chunk has more entries"]),
+        ([("hIST", bytes(6))], ["hIST chunk must have an entry"]),
+    ]
+    for extra, messages in expected:
+        chunks = split_chunks(encode_image(color_type=3, bit_depth=2,
+                                           palette=palette))
+        chunks[2:2] = extra
+        root = parse(join_chunks(chunks))
+        assert root.PNG.context.palette_length == 4
+        assert [str(issue).split(": ")[1][:len(message)] for issue, message
+                in zip(root.issues(), messages)] == messages
+        assert len(root.issues()) == len(messages)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from conftest import parse, encode_image, split_chunks, join_chunks
+from selector import parse_selector, select, select_first, select_many
+
+TEXT = [("tEXt", b"Title\x00First"), ("tEXt", b"Author\x00Second"),
+        ("tEXt", b"Title\x00Third")]
+
+def text_image():
+    chunks = split_chunks(encode_image(idat_size=64, level=0))
+    chunks[1:1] = TEXT
+    return join_chunks(chunks)
+
+def test_parse_selector():
+    steps = parse_selector("/PNG//chunk[type=tEXt][-1]/@type")
+    assert [step.axis for step in steps] == [
+        "root", "child", "descendent", "attribute"]
+    assert steps[1].names == {"PNG"} and steps[3].names == "type"
+    assert steps[2].predicates[1] == -1
+    assert [step.axis for step in parse_selector("a/../*/.")] == [
+        "child", "parent", "child", "self"]
+    assert parse_selector("") == []
+    for invalid in ("/", "a/", "a//", "a/@b/c", "[0]", "a b", "a[=x]",
+                    "@b[0]", "//.."):
+        with pytest.raises(ValueError):
+            parse_selector(invalid)
+
+def test_predicates():
+    root = parse(text_image())
+    values = lambda selector: [node.text.value for node in
+                               select(root, selector)]
+    assert values("//tEXt_payload") == ["First", "Second", "Third"]
+    assert values("//keyword[value=Title]/..") == ["First", "Third"]
+    assert values("//keyword[value!='Title']/..") == ["Second"]
+    assert values("//keyword[value=Title][1]/..") == ["Third"]
+    assert values("//tEXt_payload[-1]") == ["Third"]
+    assert values("//tEXt_payload[-2][0]") == ["Second"]
+    assert values("//tEXt_payload[5]") == []
+    assert values("//tEXt_payload[missing]") == []
+    assert len(values("//tEXt_payload[start_index]")) == 3
+    # integer comparisons and attribute values
+    assert select(root, "//chunk[type=tEXt]/length/@value") == [11, 13, 11]
+    assert select(root, "//chunk/length[value=13]/../@type") == [
+        "IHDR", "tEXt"]
+    assert select(root, "/PNG/chunks/chunk[0]/@type") == ["IHDR"]
+    assert select(root, "//chunk[-1]/@type") == ["IEND"]
+    assert select_first(root, "//chunk[type=IDAT]/@type") == "IDAT"
+    assert select_first(root, "//chunk[type=sRGB]", "none") == "none"
+
+def test_removed_nodes():
+    root = parse(text_image())
+    chunks = root.PNG.chunks
+    context = chunks.context
+    first, second, third = select(root, "//chunk[type=tEXt]")
+    # the first chunk removed without updating the index, and the others
+    # removed and discarded from it
+    chunks.children.remove(first)
+    for chunk in (second, third):
+        chunks.children.remove(chunk)
+        context.node_discarded(chunk)
+    assert context.count_named({"tEXt_payload"}) == 1
+    assert select(root, "/PNG//tEXt_payload") == []
+    # a chunk grafted from another tree, which the index does not know, is
+    # found by walking the tree (the index is used below PNG)
+    grafted = select(parse(text_image()), "//chunk[type=tEXt]")[1]
+    grafted._parent = chunks
+    chunks.children.insert(1, grafted)
+    assert [node.text.value for node in
+            select(root, "/PNG//tEXt_payload")] == ["Second"]
+    assert select(root, "//IHDR_payload/width/@value") == [8]
+
+def test_select_many():
+    roots = [parse(data) for data in (text_image(), encode_image())]
+    assert select_many(roots, "//tEXt_payload/keyword/@value") == [
+        ["Title", "Author", "Title"], []]
+    assert select_many(roots, "/PNG/chunks/chunk[0]/@type") == [
+        ["IHDR"], ["IHDR"]]
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pytest
+import struct
+
+from conftest import parse, tree_values, issue_keys
+from conftest import encode_image, split_chunks, join_chunks
+from definition import ConstructionHandler
+from source import AsyncFileSource
+from validation import ValidationFatal
+import stream
+
+def test_summarize_issues(png_files):
+    for path in png_files:
+        root, handler = stream.summarize(path)
+        issues = list(handler.issues)
+        for summary in handler.summaries:
+            issues.extend(summary.issues)
+        assert issue_keys(issues) == issue_keys(parse(path).issues()), path
+
+def push_parse(data, size):
+    parser = stream.PushParser()
+    for i in range(0, len(data), size):
+        parser.feed(data[i:i + size])
+    return parser, parser.close()
+
+def test_push_parser(png_files):
+    for path in png_files:
+        with open(path, "rb") as f:
+            data = f.read()
+        expected = parse(path)
+        for size in (1, 7, len(data)):
+            parser, root = push_parse(data, size)
+            assert tree_values(root) == tree_values(expected), (path, size)
+            assert issue_keys(issue for node, issue in parser.issues) == \
+                issue_keys(expected.issues()), (path, size)
+            assert all(chunk.crc_valid for chunk in root.PNG.chunks.children)
+
+def test_iterchunks(png_files):
+    for path in png_files:
+        expected = parse(path)
+        chunks = expected.PNG.chunks.children
+        for detach in (False, True):
+            values = []
+            issues = []
+            for chunk in stream.iterchunks(path, detach=detach):
+                values.extend(tree_values(chunk))
+                issues.extend(chunk.issues())
+            assert values == [value for chunk in chunks
+                              for value in tree_values(chunk)], path
+            assert issue_keys(issues) == issue_keys(expected.issues()), path
+            # released chunks can still be named in the issue text
+            assert all(str(issue) for issue in issues)
+
+def test_iterchunks_closes(png_files, monkeypatch):
+    sources = []
+    class RecordingSource(stream.FileSource):
+        def __init__(self, path):
+            super().__init__(path)
+            sources.append(self)
+    monkeypatch.setattr(stream, "FileSource", RecordingSource)
+    path = png_files[0]
+    assert len(list(stream.iterchunks(path))) > 1
+    chunks = stream.iterchunks(path)
+    next(chunks)
+    assert not sources[-1].f.closed
+    # stopping early closes the file once the generator is closed
+    chunks.close()
+    assert [source.f.closed for source in sources] == [True, True]
+    # a source passed in is left open
+    source = stream.FileSource(path)
+    list(stream.iterchunks(source))
+    assert not source.f.closed
+    source.f.close()
+
+def test_summarize_crc(tmp_path):
+    chunks = split_chunks(encode_image(64, 64, idat_size=256, level=0))
+    data = bytearray(join_chunks(chunks))
+    # damage the CRC of the second IDAT chunk
+    second = data.index(b"IDAT", data.index(b"IDAT") + 1)
+    data[second + 4 + 256] ^= 0xff
+    path = str(tmp_path / "crc.png")
+    with open(path, "wb") as f:
+        f.write(data)
+    root, handler = stream.summarize(path)
+    assert [summary.crc_valid for summary in handler.summaries] == [
+        summary.type != "IDAT" or i != 2
+        for i, summary in enumerate(handler.summaries)]
+    # the chunk started at the end of the file was discarded
+    assert handler.chunk is None and handler.chunk_issues is None
+    # released payloads are not kept alive by the name index
+    context = root.PNG.context
+    assert context.name_counts["IDAT_payload"] == len(chunks) - 2
+    assert "IDAT_payload" not in context.first_nodes
+
+class LoggingSource(AsyncFileSource):
+    """
+    AsyncFileSource recording the order of its reads in log.
+    """
+    def __init__(self, path, log):
+        super().__init__(path)
+        self.log = log
+
+    async def read(self, n=1):
+        self.log.append(self.path)
+        data = await super().read(n)
+        # let the other parse run before this one continues
+        await asyncio.sleep(0)
+        return data
+
+class ChunkCounter(ConstructionHandler):
+    def __init__(self):
+        super().__init__()
+        self.chunks = 0
+
+    def on_node_end(self, node, offset):
+        if node._name == "chunk":
+            self.chunks += 1
+
+def test_parse_async(png_files):
+    paths = list(png_files)
+    log = []
+    sources = [LoggingSource(path, log) for path in paths]
+    handlers = [ChunkCounter() for path in paths]
+    async def parse_all():
+        return await asyncio.gather(*[
+            stream.parse_async(source, handler=handler,
+                               options={"min_severity": "error"})
+            for source, handler in zip(sources, handlers)])
+    roots = asyncio.run(parse_all())
+    for path, root, handler in zip(paths, roots, handlers):
+        expected = parse(path, {"min_severity": "error"})
+        assert tree_values(root) == tree_values(expected), path
+        assert issue_keys(root.issues()) == issue_keys(expected.issues())
+        assert handler.chunks == len(expected.PNG.chunks.children)
+    # the reads of the parses interleaved, and every file was closed
+    assert log[:len(paths)] == paths
+    assert all(source.f.closed for source in sources)
+
+def test_max_chunk_length():
+    header = join_chunks(split_chunks(encode_image())[:1])
+    huge = struct.pack("!I", stream.MAX_CHUNK_LENGTH + 1) + b"IDAT"
+    parser = stream.PushParser()
+    parser.feed(header)
+    with pytest.raises(ValidationFatal):
+        parser.feed(huge)
+    # the limit can be raised, and the chunk is then buffered
+    parser = stream.PushParser(max_chunk_length=2**31 - 1)
+    parser.feed(header)
+    assert parser.feed(huge) == []
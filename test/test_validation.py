@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pickle
+
+from conftest import parse, tree_values, issue_keys
+from validation import (Validation, ValidationWarning, ValidationError,
+                        ValidationFatal, ValidationException, count_issues,
+                        severity_level, rule_level, compile_stages,
+                        deferrable)
+import pytest
+
+def test_deferred_issues(png_files):
+    for path in png_files:
+        inline = parse(path)
+        deferred = parse(path, {"validation": "deferred"})
+        assert tree_values(deferred) == tree_values(inline), path
+        assert issue_keys(deferred.issues()) == \
+            issue_keys(inline.issues()), path
+        # the deferred rules are only run once
+        assert issue_keys(deferred.issues()) == \
+            issue_keys(inline.issues()), path
+
+def test_skipped_issues(png_files):
+    for path in png_files:
+        inline = issue_keys(parse(path).issues())
+        skipped = issue_keys(parse(path, {"validation": "skip"}).issues())
+        assert all(key in inline for key in skipped), path
+
+@pytest.mark.parametrize("severity", ["Warning", ValidationError, "Fatal"])
+def test_min_severity(png_files, severity):
+    level = severity_level(severity)
+    for path in png_files:
+        issues = parse(path).issues()
+        expected = [issue for issue in issues if issue.level >= level]
+        for mode in ("inline", "deferred"):
+            root = parse(path, {"min_severity": severity, "validation": mode})
+            assert issue_keys(root.issues()) == issue_keys(expected), path
+
+def test_issue_records(png_files):
+    for path in png_files:
+        issues = parse(path).issues()
+        texts = [str(issue) for issue in issues]
+        assert count_issues(issues) == count_issues(
+            [pickle.loads(pickle.dumps(issue)) for issue in issues])
+        for issue, text in zip(issues, texts):
+            assert isinstance(issue, ValidationException)
+            issue.detach()
+            assert issue.node is None
+            assert str(issue) == text
+
+def test_compound_level():
+    rule = (Validation("value", "==", 1, error=ValidationWarning) &
+            Validation("value", "==", 2, error=ValidationFatal))
+    assert rule_level(rule) == ValidationFatal.level
+    stages = compile_stages([rule], ValidationError.level)
+    assert len(stages[rule.stage]) == 1
+    assert compile_stages([rule], ValidationFatal.level + 1) == {}
+
+def test_compound_not_deferrable():
+    warning = Validation("value", "==", 1, error=ValidationWarning)
+    fatal = Validation("value", "==", 2, error=ValidationFatal)
+    assert deferrable(warning)
+    assert not deferrable(warning & fatal)
+    assert not deferrable(warning | fatal)
+    assert compile_stages([warning & fatal], subset="deferred") == {}
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+
+from conftest import parse, generated_images, split_chunks, join_chunks
+from node import Name
+import stream
+import writer
+
+def serialized(root):
+    fp = io.BytesIO()
+    writer.serialize(root, fp)
+    return fp.getvalue()
+
+def test_serialize_unmodified(png_files):
+    for path in png_files:
+        with open(path, "rb") as f:
+            data = f.read()
+        assert serialized(parse(path)) == data, path
+        assert serialized(parse(data)) == data, path
+        parser = stream.PushParser()
+        parser.feed(data)
+        assert serialized(parser.close()) == data, path
+
+def test_serialize_damaged():
+    # an iTXt chunk whose text is not valid UTF-8 and a chunk with a bad CRC
+    # are copied as they are unless they are modified
+    chunks = split_chunks(generated_images()["rgb"])
+    itxt = ("iTXt", b"Comment\x00\x00\x00\x00\x00\xff\xfebad")
+    chunks.insert(1, itxt)
+    data = bytearray(join_chunks(chunks))
+    data[-20] ^= 0xff
+    data = bytes(data)
+    parser = stream.PushParser()
+    for i in range(0, len(data), 5):
+        parser.feed(data[i:i + 5])
+    for root in (parse(data), parser.close()):
+        assert serialized(root) == data
+        text = root.first_descendent([Name("tEXt_payload")])
+        text.text.set_value("Changed")
+        chunks = split_chunks(serialized(root))
+        assert chunks[1] == itxt
+        assert ("tEXt", b"Title\x00Changed") in chunks
+
+def test_serialize_modified():
+    data = generated_images()["rgb"]
+    root = parse(data)
+    chunks = root.PNG.chunks
+    text = root.first_descendent([Name("tEXt_payload")])
+    text.text.set_value("Changed")
+    writer.new_chunk(chunks, "tEXt", b"New\x00chunk", 1)
+    output = serialized(root)
+    expected = split_chunks(data)
+    expected[expected.index(("tEXt", b"Title\x00Test"))] = (
+        "tEXt", b"Title\x00Changed")
+    expected.insert(1, ("tEXt", b"New\x00chunk"))
+    assert output == join_chunks(expected)
+    texts = parse(output).descendents([Name("tEXt_payload")])
+    assert [(text.keyword.value, text.text.value) for text in texts] == [
+        ("New", "chunk"), ("Title", "Changed")]
+
+def test_rewrite(tmp_path):
+    data = generated_images()["rgb"]
+    src = str(tmp_path / "src.png")
+    dst = str(tmp_path / "dst.png")
+    with open(src, "wb") as f:
+        f.write(data)
+    writer.rewrite(src, dst, drop=["tIME"],
+                   replace={"tEXt": lambda payload: payload + b"!"},
+                   insert_after={"IHDR": [("gAMA", b"\x00\x00\xb1\x8f")]})
+    expected = [(chunk_type, payload + b"!" if chunk_type == "tEXt"
+                 else payload) for chunk_type, payload in split_chunks(data)
+                if chunk_type != "tIME"]
+    expected.insert(1, ("gAMA", b"\x00\x00\xb1\x8f"))
+    with open(dst, "rb") as f:
+        assert f.read() == join_chunks(expected)
@@ -3,7 +3,7 @@
 
 import operator
 import re
-from collections import namedtuple
+from collections import Counter, namedtuple
 
 DEBUG = False 
 
@@ -35,7 +35,7 @@ class OpInfo(object):
 class Validation(object):
     known_stages = ["pre", "per_child", "pre_derivation", "post"]
     def __init__(self, value, func, comparison, stage="post",
-                 error=None, description=""):
+                 error=None, description="", rule_id=None):
         self.value = value
         if callable(func):
             self.func = func
@@ -47,8 +47,35 @@ class Validation(object):
         self.stage = stage
         self.error = error if error else ValidationWarning
         self.description = description if description else ""
+        self._rule_id = rule_id
         self.is_validation = True
 
+    @property
+    def rule_id(self):
+        """
+        A string identifying the rule in the issues it raises, which is the
+        same in every parse. By default this is made from the description,
+        value, operator and comparison of the rule.
+        """
+        if getattr(self, "_rule_id", None) is None:
+            opinfo = OpInfo.op_func_dict.get(self.func)
+            op = opinfo.symbol if opinfo else getattr(self.func, "__name__",
+                                                      self.func)
+            self._rule_id = "{}{} {} {}".format(
+                self.description + ": " if self.description else "",
+                self.value, op, self.comparison)
+        return self._rule_id
+
+    def raise_issue(self, node, value, comparison):
+        """
+        Raise self.error for node. Validation exceptions are raised as
+        records whose text is formatted when it is used.
+        """
+        if issubclass(self.error, ValidationException):
+            raise self.error(rule=self, node=node, value=value,
+                             comparison=comparison)
+        raise self.error(self.error_message(node, value, comparison))
+
     def __str__(self):
         return ("{cls}({value}, {func}, {comparison}, stage={stage}, " +
                 "error={error})").format(
@@ -121,9 +148,76 @@ class Validation(object):
         if DEBUG:
             print("validation called", value, comparison, result)
         if not result:
-            raise self.error(
-                self.error_message(node, value, comparison)
-            )
+            self.raise_issue(node, value, comparison)
+
+    def compile_resolver(self, path_or_val):
+        """
+        Return a function node -> value equivalent to calling resolve with
+        path_or_val, with the kind of path_or_val decided in advance.
+        """
+        if isinstance(path_or_val, (tuple, list)):
+            if len(path_or_val) == 0:
+                return lambda node: path_or_val
+            resolvers = [self.compile_resolver(el) for el in path_or_val]
+            return lambda node: tuple([r(node) for r in resolvers])
+        if hasattr(path_or_val, "resolve_path"):
+            return path_or_val.resolve_path
+        if isinstance(path_or_val, str):
+            def resolve_attr(node):
+                try:
+                    return getattr(node, path_or_val)
+                except AttributeError:
+                    return path_or_val
+            return resolve_attr
+        return lambda node: path_or_val
+
+    def compile(self):
+        """
+        Return a function (definition, node, descendent=None) which does
+        the same as calling this validation, with the operator, the order
+        of its arguments and the resolution of the value and comparison
+        bound in advance. Subclasses which override __call__, validate or
+        resolve are returned unchanged.
+        """
+        cls = type(self)
+        if (cls.__call__ is not Validation.__call__ or
+                cls.validate is not Validation.validate or
+                cls.resolve is not Validation.resolve):
+            return self
+        get_value = self.compile_resolver(self.value)
+        get_comparison = self.compile_resolver(self.comparison)
+        func = self.func
+        raise_issue = self.raise_issue
+        opinfo = OpInfo.op_func_dict.get(func)
+        if opinfo is None:
+            def check(definition, node, descendent=None):
+                value = get_value(node)
+                comparison = get_comparison(node)
+                if not func(value, comparison):
+                    raise_issue(node, value, comparison)
+            return check
+        reverse = opinfo.reversed
+        pass_node = opinfo.pass_node
+        symbol = opinfo.symbol
+        def check(definition, node, descendent=None):
+            value = get_value(node)
+            comparison = get_comparison(node)
+            if reverse:
+                arg1, arg2 = comparison, value
+            else:
+                arg1, arg2 = value, comparison
+            try:
+                if pass_node:
+                    res = func(arg1, arg2, node)
+                else:
+                    res = func(arg1, arg2)
+            except TypeError as err:
+                raise TypeError(
+                    "Error applying '{}' to '{}' and '{}': {}".format(
+                    symbol, arg1, arg2, err.args[0]))
+            if not res:
+                raise_issue(node, value, comparison)
+        return check
 
     def _validate_and_or(self, other):
         if not isinstance(other, Validation):
@@ -155,7 +249,7 @@ class CompoundValidation(Validation):
             self.v1 = v2
             self.v2 = v1
         # set our error to that of the validation with the highest error level
-        self.error = v1.error
+        self.error = self.v1.error
         # set our stage to the latest stage of the child validations
         self.stage = self.known_stages[max(
             self.known_stages.index(v1.stage),
@@ -172,6 +266,14 @@ class AndValidation(CompoundValidation):
         self.v1(definition, node, descendent)
         self.v2(definition, node, descendent)
 
+    def compile(self):
+        v1 = compile_validation(self.v1)
+        v2 = compile_validation(self.v2)
+        def check(definition, node, descendent=None):
+            v1(definition, node, descendent)
+            v2(definition, node, descendent)
+        return check
+
     def validate(self, node):
         return (None, None, v1.validate(node)[2] and v2.validate(node)[2])
 
@@ -189,8 +291,51 @@ class OrValidation(CompoundValidation):
                 else:
                     error = err
 
+    def compile(self):
+        rules = (compile_validation(self.v1), compile_validation(self.v2))
+        def check(definition, node, descendent=None):
+            error = None
+            for rule in rules:
+                try:
+                    rule(definition, node, descendent)
+                except ValidationException as err:
+                    if error:
+                        raise error
+                    else:
+                        error = err
+        return check
+
     def validate(self, node):
         return (None, None, v1.validate(node)[2] or v2.validate(node)[2])
+
+def compile_validation(validation):
+    """
+    Return the compiled form of validation (see Validation.compile), or
+    validation itself if it is a plain validation method.
+    """
+    if isinstance(validation, Validation):
+        return validation.compile()
+    return validation
+
+def compile_stages(validation, min_level=0, subset=None):
+    """
+    Return a dictionary mapping each validation stage that has rules in
+    the list validation to a tuple of the compiled rules (see
+    compile_validation) for that stage, in order. Rules whose error level
+    is below min_level (see rule_level) are dropped. If subset is
+    "deferred" only the rules that can be run after construction (see
+    deferrable) are kept, and if it is "inline" only the others. Stages
+    without rules are left out.
+    """
+    stages = {}
+    for v in validation:
+        level = rule_level(v)
+        if level is not None and level < min_level:
+            continue
+        if subset is not None and deferrable(v) != (subset == "deferred"):
+            continue
+        stages.setdefault(v.stage, []).append(compile_validation(v))
+    return {stage: tuple(rules) for stage, rules in stages.items()}
         
           
 
@@ -203,11 +348,27 @@ class ValidationException(Exception):
     Base class for Validation exceptions, which are raised by validation
     methods. Validation exceptions are classed by 'level', from Info to
     Fatal.
+
+    Exceptions raised by Validation rules are records of the rule, the
+    node, the value found and the comparison, and their text is only
+    formatted from these when it is first used (e.g. by str()). key
+    identifies the kind of issue by its class and rule_id (or its text if
+    it was not raised by a rule), so that issues can be counted and merged
+    across files without formatting them (see count_issues). detach drops
+    the reference to the node, so that the issue does not keep the tree
+    alive.
     """
     levels = ["Info", "Warning", "Error", "Fatal"]
-    def __init__(self, text, recovery_func=None, recovery_args=None,
-                 recovery_kwargs=None):
-        self.text = text
+    def __init__(self, text=None, recovery_func=None, recovery_args=None,
+                 recovery_kwargs=None, rule=None, node=None, value=None,
+                 comparison=None):
+        self._text = text
+        self.rule = rule
+        self.rule_id = rule.rule_id if rule is not None else None
+        self.node = node
+        self.value = value
+        self.comparison = comparison
+        self._offset = None
         self.recovery_func = recovery_func
         self.recovery_args = recovery_args if recovery_args else []
         self.recovery_kwargs = recovery_kwargs if recovery_kwargs else {}
@@ -215,10 +376,54 @@ class ValidationException(Exception):
             raise ValueError("recovery_func provided for validation" +
                 "exception with a level other than 'Error'")
 
+    @property
+    def text(self):
+        if self._text is None and self.rule is not None:
+            self._text = self.rule.error_message(self.node, self.value,
+                                                 self.comparison)
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+
+    @property
+    def offset(self):
+        """
+        The offset in the source of the start of the node the issue was
+        raised on, or None if it is not known.
+        """
+        if self.node is not None:
+            return self.node._metadata.get("start_index")
+        return self._offset
+
+    @property
+    def key(self):
+        return (self.__class__.__name__,
+                self.rule_id if self.rule_id is not None else self.text)
+
+    def detach(self):
+        """
+        Format the text of the issue and record the offset of its node,
+        then drop the reference to the node.
+        """
+        self._text = self.text
+        self._offset = self.offset
+        self.node = None
+
+    def __reduce__(self):
+        # rules may hold functions that cannot be pickled, so pickled
+        # issues are detached and keep only the rule_id of their rule
+        state = dict(self.__dict__, _text=self.text, _offset=self.offset,
+                     node=None, rule=None)
+        return (self.__class__, (), state)
 
     def __str__(self):
         return "{}: {}".format(self.__class__.__name__, self.text)
 
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.text)
+
 class ValidationInfo(ValidationException):
     """
     Exception representing Info level validation issues. An Info level
@@ -249,3 +454,93 @@ class ValidationFatal(ValidationException):
 
 
     
+
+
+
+##############################################################################
+# Severity                                                                   #
+##############################################################################
+
+def severity_level(severity):
+    """
+    Return the level of severity, which may be a ValidationException class
+    or instance, its name with or without the "Validation" prefix (e.g.
+    "Error" or "ValidationError"), a level number, or None for level 0.
+    """
+    if severity is None:
+        return 0
+    if isinstance(severity, int):
+        return severity
+    if isinstance(severity, str):
+        name = severity if severity.startswith("Validation") else \
+            "Validation" + severity.capitalize()
+        for cls in (ValidationInfo, ValidationWarning, ValidationError,
+                    ValidationFatal):
+            if cls.__name__ == name:
+                return cls.level
+        raise ValueError("Unknown severity '{}'".format(severity))
+    return severity.level
+
+def rule_level(validation):
+    """
+    Return the level of the error raised by the validation rule, or None
+    for validation methods, which may raise any error. The level of a
+    compound rule is the highest level of its parts.
+    """
+    if isinstance(validation, CompoundValidation):
+        levels = [rule_level(validation.v1), rule_level(validation.v2)]
+        return None if None in levels else max(levels)
+    error = getattr(validation, "error", None)
+    return getattr(error, "level", None)
+
+# stages whose rules can be run after the tree has been constructed
+DEFERRABLE_STAGES = ("per_child", "post")
+
+def deferrable(validation):
+    """
+    Return True if validation can be run after construction, i.e. it is a
+    "per_child" or "post" rule that cannot raise ValidationFatal (which
+    stops construction), in any of its parts if it is a compound rule (see
+    rule_level).
+    """
+    level = rule_level(validation)
+    return (validation.stage in DEFERRABLE_STAGES and level is not None and
+            level < ValidationFatal.level)
+
+def iter_issues(issues):
+    """
+    Yield the issues in issues, which may contain nested lists of issues
+    (as in the "validation" metadata of a node), in order.
+    """
+    pending = [issues]
+    while pending:
+        issue = pending.pop()
+        if isinstance(issue, list):
+            pending.extend(reversed(issue))
+        else:
+            yield issue
+
+def detach_issues(node):
+    """
+    Detach (see ValidationException.detach) the issues recorded on node
+    and its descendents, so that their text is formatted while node is
+    still in the tree. This is called before a subtree is removed from
+    the tree.
+    """
+    for n in node:
+        for issue in iter_issues(n._metadata.get("validation", [])):
+            if isinstance(issue, ValidationException):
+                issue.detach()
+
+def count_issues(issues, counts=None):
+    """
+    Return a Counter of the keys (see ValidationException.key) of the
+    issues in issues (see iter_issues), added to the Counter counts if it
+    is given. Other exceptions recorded as issues are counted by their
+    class and text. Counts for several files can be merged by adding them.
+    """
+    counts = counts if counts is not None else Counter()
+    counts.update(getattr(issue, "key", None) or
+                  (issue.__class__.__name__, str(issue))
+                  for issue in iter_issues(issues))
+    return counts
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from node import Node, Name
+from definition import encode_node
+from validation import ValidationFatal
+import os
+import struct
+import zlib
+
+COPY_BUFFER_SIZE = 2**20
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+##############################################################################
+# Chunk encoding                                                             #
+##############################################################################
+
+def encode_chunk(chunk_type, payload):
+    """
+    Return the bytes of a complete chunk (length, type, payload and CRC)
+    with the given chunk type and payload.
+    """
+    if isinstance(chunk_type, str):
+        chunk_type = chunk_type.encode("ascii")
+    return (struct.pack("!I", len(payload)) + chunk_type + payload +
+            struct.pack("!I", zlib.crc32(chunk_type + payload)))
+
+def chunk_bytes(chunk):
+    """
+    Return the bytes of the given chunk node, encoded from its type and
+    payload nodes with the length and CRC recomputed.
+    """
+    return encode_chunk(chunk.chunk_type.value,
+                        encode_node(chunk.children[2]))
+
+def new_chunk(parent, chunk_type, payload, index=None):
+    """
+    Create and return a chunk node with the given chunk type and bytestring
+    payload as a child of parent (normally the chunks node). The chunk is
+    appended to the children of parent unless index is given, in which case
+    it is inserted at that position.
+    """
+    chunk = Node("chunk", None)
+    chunk._parent = parent
+    chunk._context = parent._context
+    if chunk._context is not None:
+        chunk._context.index_node(chunk)
+    if index is None:
+        parent._children.append(chunk)
+    else:
+        parent._children.insert(index, chunk)
+    Node("length", chunk).add_data({"value": len(payload)})
+    Node("chunk_type", chunk).add_data({"value": chunk_type})
+    Node(chunk_type + "_payload", chunk).add_data({"value": payload})
+    Node("crc", chunk).add_data({"value": zlib.crc32(
+        chunk_type.encode("ascii") + payload)})
+    chunk.add_data({"type": chunk_type})
+    chunk.mark_modified()
+    return chunk
+
+def source_span(node):
+    """
+    Return a (source, start, end) tuple giving the location of node in the
+    file or BytesSource it was read from, or None if node has been modified
+    or was not read from a source.
+    """
+    metadata = node.metadata
+    if metadata.get("modified") or metadata.get("source") is None:
+        return None
+    try:
+        return (metadata["source"], metadata["start_index"],
+                metadata["end_index"])
+    except KeyError:
+        return None
+
+def read_span(span, files):
+    """
+    Return the bytes of the (source, start, end) span given by source_span,
+    read from the BytesSource or from the file at the source path. files is
+    a dictionary of the files opened so far, by path, which the caller
+    closes.
+    """
+    source, start, end = span
+    if hasattr(source, "read_span"):
+        return source.read_span(start, end)
+    if source not in files:
+        files[source] = open(source, "rb")
+    files[source].seek(start)
+    return files[source].read(end - start)
+
+def find_png(root):
+    """
+    Return the PNG node in the tree containing root, which may be the PNG
+    node itself.
+    """
+    if root._name == "PNG":
+        return root
+    png = root.first_descendent([Name("PNG")])
+    if png is not None:
+        return png
+    raise ValueError("No PNG node found in tree")
+
+##############################################################################
+# Serialization                                                              #
+##############################################################################
+
+def copy_span(src, dst, start, end, bufsize=COPY_BUFFER_SIZE):
+    """
+    Copy the bytes between the start and end offsets of the file object
+    src to the file object dst.
+    """
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = src.read(min(bufsize, remaining))
+        if not data:
+            raise EOFError()
+        dst.write(data)
+        remaining -= len(data)
+
+def copy_range(src, dst, start, end):
+    """
+    Copy the bytes between the start and end offsets of the file object
+    src to the current position of the file object dst. The copy is done
+    in the kernel with os.copy_file_range or, failing that, os.sendfile,
+    and falls back to a buffered copy. dst must be unbuffered so that
+    writes made through it and through its file descriptor stay in order.
+    """
+    offset = start
+    for copy_func in (_copy_file_range, _sendfile):
+        try:
+            while offset < end:
+                copied = copy_func(src.fileno(), dst.fileno(), offset,
+                                   end - offset)
+                if copied == 0:
+                    raise EOFError()
+                offset += copied
+            return
+        except (AttributeError, OSError):
+            continue
+    copy_span(src, dst, offset, end)
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+def gen_chunk_spans(png):
+    """
+    Return a generator yielding, for each run of chunks of the PNG node,
+    either a (source, start, end) tuple for a run of adjacent unmodified
+    chunks in the same source, or the bytes of a modified chunk.
+    """
+    pending = None
+    for chunk in png.chunks.children:
+        span = source_span(chunk)
+        if span is None:
+            if pending:
+                yield pending
+                pending = None
+            yield chunk_bytes(chunk)
+        elif pending and pending[0] == span[0] and pending[2] == span[1]:
+            pending = (pending[0], pending[1], span[2])
+        else:
+            if pending:
+                yield pending
+            pending = span
+    if pending:
+        yield pending
+
+def serialize(root, fp):
+    """
+    Write the PNG in the tree containing root to the file object fp.
+    Chunks that have not been modified are copied verbatim from their
+    source file or BytesSource (including the PushParser's), while modified
+    or new chunks are re-encoded with their length and CRC recomputed. fp
+    must not be one of the source files.
+    """
+    png = find_png(root)
+    sources = {}
+    try:
+        fp.write(SIGNATURE)
+        for span in gen_chunk_spans(png):
+            if isinstance(span, bytes):
+                fp.write(span)
+                continue
+            path, start, end = span
+            if hasattr(path, "read_span"):
+                fp.write(path.read_span(start, end))
+                continue
+            if path not in sources:
+                sources[path] = open(path, "rb")
+            copy_span(sources[path], fp, start, end)
+    finally:
+        for f in sources.values():
+            f.close()
+
+##############################################################################
+# Chunk-level rewriting                                                      #
+##############################################################################
+
+def scan_chunks(f):
+    """
+    Return a generator yielding a (chunk_type, start, end) tuple for each
+    chunk in the PNG file object f. Only the chunk headers are read, so the
+    offsets match the start_index and end_index metadata of the chunk nodes
+    without reading the payloads.
+    """
+    f.seek(0)
+    if f.read(len(SIGNATURE)) != SIGNATURE:
+        raise ValidationFatal("Invalid PNG signature")
+    start = len(SIGNATURE)
+    while True:
+        header = f.read(8)
+        if not header:
+            return
+        if len(header) < 8:
+            raise EOFError()
+        length, chunk_type = struct.unpack("!I4s", header)
+        end = start + length + 12
+        yield (chunk_type.decode("latin1"), start, end)
+        start = end
+        f.seek(start)
+
+def read_payload(f, start, end):
+    """
+    Return the payload of the chunk between the start and end offsets of
+    the file object f.
+    """
+    f.seek(start + 8)
+    return f.read(end - start - 12)
+
+def gen_rewrite_spans(f, drop=None, replace=None, insert_after=None):
+    """
+    Return a generator yielding the output of rewrite for the PNG file
+    object f, as (start, end) tuples for runs of chunks to copy from f and
+    bytes for new or replaced chunks. See rewrite for the arguments.
+    """
+    drop = set(drop) if drop else set()
+    replace = replace if replace else {}
+    insert_after = dict(insert_after) if insert_after else {}
+    pending = None
+    for chunk_type, start, end in scan_chunks(f):
+        if chunk_type in drop or chunk_type in replace:
+            if pending:
+                yield pending
+                pending = None
+            if chunk_type in replace:
+                payload = replace[chunk_type]
+                if callable(payload):
+                    payload = payload(read_payload(f, start, end))
+                if payload is not None:
+                    yield encode_chunk(chunk_type, payload)
+        elif pending and pending[1] == start:
+            pending = (pending[0], end)
+        else:
+            if pending:
+                yield pending
+            pending = (start, end)
+        if chunk_type in insert_after:
+            if pending:
+                yield pending
+                pending = None
+            for new_type, payload in insert_after.pop(chunk_type):
+                yield encode_chunk(new_type, payload)
+    if pending:
+        yield pending
+
+def rewrite(src, dst, drop=None, replace=None, insert_after=None):
+    """
+    Copy the PNG file at path src to path dst, changing it at the chunk
+    level. drop is a list of chunk types to remove. replace is a dictionary
+    mapping chunk types to a new payload for each chunk of that type, or
+    to a function that returns the new payload when called with the old
+    one (None drops the chunk). insert_after is a dictionary mapping chunk
+    types to a list of (chunk_type, payload) tuples, which are inserted
+    after the first chunk of that type. Runs of unchanged chunks are
+    copied in the kernel where the platform allows it.
+    """
+    with open(src, "rb") as fin, open(dst, "wb", buffering=0) as fout:
+        fout.write(SIGNATURE)
+        for span in gen_rewrite_spans(fin, drop, replace, insert_after):
+            if isinstance(span, bytes):
+                fout.write(span)
+            else:
+                copy_range(fin, fout, span[0], span[1])